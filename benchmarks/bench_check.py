@@ -0,0 +1,286 @@
+#! /usr/bin/python3
+"""
+End to end latency of the instance flavor check.
+
+Every scenario runs check_payg_byos in process, and the
+instance-flavor-check command in a fresh interpreter when run as
+root, against a local stand-in RMT server and a fake data provider.
+The results are written as JSON; pass the results of an earlier
+run with --compare to print the change per scenario.
+
+Example:
+    python3 benchmarks/bench_check.py --output before.json
+    git checkout topic
+    python3 benchmarks/bench_check.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import select
+import shutil
+import socket
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import bench_env
+from instance_billing_flavor_check import utils
+from rmt_stub import RMTStub
+
+# Addresses of update servers that never answer and of one that does
+DEAD_IPS = ('127.0.0.2', '127.0.0.3')
+LIVE_IP = '127.0.0.1'
+
+
+class Blackhole:
+    """
+    **Update server that never answers**
+    Connections are accepted by the kernel and left hanging in the
+    listen backlog, just like a server behind a dropping firewall
+    once the TCP handshake went through
+    """
+    def __init__(self, address, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((address, port))
+        self.socket.listen(128)
+
+    def close(self):
+        self.socket.close()
+
+
+class ConnectHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            request += data
+        target = request.split(b' ')[1].decode()
+        host, port = target.rsplit(':', 1)
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=2)
+        except OSError:
+            self.request.sendall(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+            return
+        self.request.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        peers = {self.request: upstream, upstream: self.request}
+        with upstream:
+            while True:
+                readable, _, _ = select.select(list(peers), [], [], 10)
+                if not readable:
+                    return
+                for stream in readable:
+                    data = stream.recv(65536)
+                    if not data:
+                        return
+                    peers[stream].sendall(data)
+
+
+class ConnectProxy(socketserver.ThreadingTCPServer):
+    """**HTTP proxy tunneling CONNECT requests**"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ConnectHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@contextmanager
+def nothing():
+    yield
+
+
+def proxy_environment():
+    proxy = ConnectProxy()
+    environment = patch.dict(os.environ, {'https_proxy': proxy.url})
+
+    @contextmanager
+    def both():
+        with proxy, environment:
+            yield
+    return both()
+
+
+# name: (update server IPs, warm flavor cache, repeats, context)
+SCENARIOS = {
+    'cold_start': ((LIVE_IP,), False, 10, nothing),
+    'cache_hit': ((LIVE_IP,), True, 50, nothing),
+    'one_dead_ip': ((DEAD_IPS[0], LIVE_IP), False, 10, nothing),
+    'all_dead': (DEAD_IPS, False, 1, nothing),
+    'proxy': ((LIVE_IP,), False, 10, proxy_environment),
+}
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def run_in_process(workdir, warm, repeats):
+    samples = []
+    for _ in range(repeats):
+        if not warm:
+            bench_env.clear_caches(workdir)
+        bench_env.reset(utils)
+        start = time.perf_counter()
+        utils.check_payg_byos()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_command(workdir, port, warm, repeats):
+    command = [
+        sys.executable, os.path.join(bench_env.BENCH_DIR, 'bench_env.py'),
+        workdir, str(port)
+    ]
+    samples = []
+    for _ in range(repeats):
+        if not warm:
+            bench_env.clear_caches(workdir)
+        start = time.perf_counter()
+        subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_scenario(name, stub, with_command, repeat_factor):
+    rmt_ips_addr, warm, repeats, context = SCENARIOS[name]
+    repeats = max(1, int(repeats * repeat_factor))
+    workdir = tempfile.mkdtemp(prefix='bench-flavor-check-')
+    blackholes = [
+        Blackhole(ip, stub.port) for ip in rmt_ips_addr if ip in DEAD_IPS
+    ]
+    results = {}
+    try:
+        bench_env.prepare(workdir, rmt_ips_addr)
+        bench_env.configure(workdir, stub.port)
+        with context():
+            if warm:
+                bench_env.reset(utils)
+                utils.check_payg_byos()
+            results[name] = summarize(
+                run_in_process(workdir, warm, repeats)
+            )
+            if with_command:
+                results['cli_' + name] = summarize(
+                    run_command(workdir, stub.port, warm, repeats)
+                )
+    finally:
+        for blackhole in blackholes:
+            blackhole.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=bench_env.ROOT_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    print('{:<20} {:>12} {:>12} {:>8}'.format(
+        'scenario', 'before [ms]', 'after [ms]', 'change'
+    ))
+    for name, result in sorted(results['scenarios'].items()):
+        before = baseline.get('scenarios', {}).get(name)
+        after = result['median'] * 1000
+        if not before:
+            print('{:<20} {:>12} {:>12.2f}'.format(name, '-', after))
+            continue
+        before = before['median'] * 1000
+        print('{:<20} {:>12.2f} {:>12.2f} {:>+7.1f}%'.format(
+            name, before, after, (after - before) / before * 100
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the latency of the instance flavor check'
+    )
+    parser.add_argument(
+        '--output',
+        default=os.path.join(tempfile.gettempdir(), 'bench-check.json'),
+        help='File to write the JSON results to (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--compare', help='JSON results of an earlier run to compare with'
+    )
+    parser.add_argument(
+        '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='Scenario to run, may be given more than once, default all'
+    )
+    parser.add_argument(
+        '--repeat-factor', type=float, default=1.0,
+        help='Scale the number of runs of every scenario'
+    )
+    args = parser.parse_args()
+
+    # failed attempts are part of some scenarios, keep them quiet
+    utils.logger.addHandler(logging.NullHandler())
+    with_command = os.geteuid() == 0
+    if not with_command:
+        print('Not root, the instance-flavor-check command is skipped')
+    results = {
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'scenarios': {},
+    }
+    with RMTStub() as stub:
+        for name in args.scenario or SCENARIOS:
+            results['scenarios'].update(
+                run_scenario(name, stub, with_command, args.repeat_factor)
+            )
+    with open(args.output, 'w') as stream:
+        json.dump(results, stream, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as stream:
+            compare(results, json.load(stream))
+    else:
+        for name, result in sorted(results['scenarios'].items()):
+            print('{:<20} median {:>9.2f} ms  p95 {:>9.2f} ms'.format(
+                name, result['median'] * 1000, result['p95'] * 1000
+            ))
+
+
+if __name__ == '__main__':
+    main()
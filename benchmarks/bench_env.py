@@ -0,0 +1,100 @@
+"""
+Stand-in instance environment for the benchmarks.
+
+configure points the module paths of utils at files in a work
+directory: a regionserverclnt.cfg with a fake dataProvider, a
+baseproduct, an /etc/hosts naming the update servers and the caches.
+"""
+
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'lib'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+
+BASEPRODUCT = """<?xml version="1.0" encoding="UTF-8"?>
+<product schemeversion="0">
+  <vendor>SUSE</vendor>
+  <name>SLES</name>
+  <version>15.6</version>
+</product>
+"""
+# Size of the signed document printed by the fake data provider
+METADATA_SIZE = 4096
+
+
+def prepare(workdir, rmt_ips_addr):
+    """Write the stand-in files naming the given update server IPs."""
+    provider = os.path.join(workdir, 'data-provider')
+    with open(provider, 'w') as stream:
+        stream.write(
+            '#!/bin/sh\nprintf "<document>%s</document>"\n' %
+            ('x' * METADATA_SIZE)
+        )
+    os.chmod(provider, 0o755)
+    with open(os.path.join(workdir, 'regionserverclnt.cfg'), 'w') as stream:
+        stream.write('[instance]\ndataProvider = {}\n'.format(provider))
+    with open(os.path.join(workdir, 'baseproduct'), 'w') as stream:
+        stream.write(BASEPRODUCT)
+    with open(os.path.join(workdir, 'hosts'), 'w') as stream:
+        stream.write('127.0.0.1 localhost\n')
+        for rmt_ip_addr in rmt_ips_addr:
+            stream.write('{} smt-bench.susecloud.net smt-bench\n'.format(
+                rmt_ip_addr
+            ))
+    open(os.path.join(workdir, 'proxy'), 'w').close()
+
+
+def clear_caches(workdir):
+    """Remove the on disk caches of a previous check."""
+    for name in os.listdir(workdir):
+        if name.startswith('cache'):
+            os.unlink(os.path.join(workdir, name))
+
+
+def configure(workdir, port):
+    """Point utils at the work directory and the update server port."""
+    from instance_billing_flavor_check import utils
+    utils.REGION_SRV_CLIENT_CONFIG_PATH = os.path.join(
+        workdir, 'regionserverclnt.cfg'
+    )
+    utils.BASEPRODUCT_PATH = os.path.join(workdir, 'baseproduct')
+    utils.ETC_HOSTS_PATH = os.path.join(workdir, 'hosts')
+    utils.PROXY_CONFIG_PATH = os.path.join(workdir, 'proxy')
+    utils.CACHE_FILE_PATH = os.path.join(workdir, 'cache')
+    utils.METADATA_CACHE_FILE_PATH = os.path.join(workdir, 'cache.metadata')
+    utils.IDENTIFIER_CACHE_FILE_PATH = os.path.join(
+        workdir, 'cache.identifier'
+    )
+    utils.METRICS_STATE_PATH = os.path.join(workdir, 'cache.metrics')
+    utils.LOCK_FILE_PATH = os.path.join(workdir, 'cache.lock')
+    utils.HEALTH_FILE_PATH = os.path.join(workdir, 'cache.health')
+    utils.BUDGET_FILE_PATH = os.path.join(workdir, 'cache.budget')
+    utils.REFRESH_FILE_PATH = os.path.join(workdir, 'cache.refresh')
+    utils.CONNECTIVITY_CACHE_FILE_PATH = os.path.join(
+        workdir, 'cache.connectivity'
+    )
+    utils.RMT_HTTPS_PORT = port
+    utils.has_ipv4_access = lambda: True
+    utils.has_ipv6_access = lambda: False
+    utils.setup_logging = lambda: None
+    return utils
+
+
+def reset(utils):
+    """Forget the in process state of previous checks."""
+    utils._parsed_files.clear()
+    utils._network_access_cache.clear()
+    utils._post_unsupported.clear()
+    utils._session = None
+
+
+if __name__ == '__main__':
+    # run the instance-flavor-check command in the stand-in environment:
+    # bench_env.py WORKDIR PORT
+    import runpy
+    configure(sys.argv[1], int(sys.argv[2]))
+    sys.argv = [os.path.join(ROOT_DIR, 'instance-flavor-check')]
+    runpy.run_path(sys.argv[0], run_name='__main__')
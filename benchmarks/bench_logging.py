@@ -0,0 +1,155 @@
+#! /usr/bin/python3
+"""
+Cost of the logging of the instance flavor check.
+
+The log calls of the request hot path are timed with the messages
+formatted eagerly, as with '...'.format(...), and lazily with %-style
+arguments. Each variant runs at INFO, where the debug records are
+dropped, and at DEBUG, where all of them are written. The records go
+to a log file directly or through the queue and listener thread set
+up by setup_logging. A file write can be slowed down with
+--disk-latency to see how a contended disk at boot stalls the caller.
+
+Example:
+    python3 benchmarks/bench_logging.py --disk-latency 5
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import statistics
+import tempfile
+import time
+
+import bench_env  # noqa: F401, sets up the module path
+from instance_billing_flavor_check import utils
+
+# Answer of the update server logged at debug level
+ANSWER = {'flavor': 'PAYG'}
+SERVER = '203.0.113.1'
+
+
+class SlowFileHandler(logging.FileHandler):
+    """**File handler taking latency seconds per record written**"""
+    def __init__(self, filename, latency=0):
+        super().__init__(filename)
+        self.latency = latency
+
+    def emit(self, record):
+        if self.latency:
+            time.sleep(self.latency)
+        super().emit(record)
+
+
+def eager_calls(logger):
+    logger.debug('Update server {} answered: {}'.format(SERVER, ANSWER))
+    logger.info('Successful server query: {}'.format(ANSWER['flavor']))
+
+
+def lazy_calls(logger):
+    logger.debug('Update server %s answered: %s', SERVER, ANSWER)
+    logger.info('Successful server query: %s', ANSWER['flavor'])
+
+
+VARIANTS = (('eager', eager_calls), ('lazy', lazy_calls))
+
+
+def measure(calls, pipeline, level, path, latency, repeats):
+    """
+    Return the seconds per iteration of calls, logging at level to
+    path through the file or queue pipeline. Only the time spent by
+    the caller counts, the queue is drained after the measurement.
+    """
+    logger = logging.getLogger('bench_logging')
+    logger.propagate = False
+    logger.setLevel(level)
+    file_handler = SlowFileHandler(path, latency)
+    file_handler.setFormatter(logging.Formatter(utils.LOG_FORMAT))
+    listener = None
+    if pipeline == 'queue':
+        log_queue = queue.Queue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        handler = logging.handlers.QueueHandler(log_queue)
+        listener.start()
+    else:
+        handler = file_handler
+    logger.addHandler(handler)
+    try:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            calls(logger)
+        elapsed = time.perf_counter() - start
+    finally:
+        logger.removeHandler(handler)
+        if listener:
+            listener.stop()
+        file_handler.close()
+    return elapsed / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of the flavor check logging'
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=20000,
+        help='Iterations of the log calls per run (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--runs', type=int, default=5,
+        help='Runs per variant, the median is reported (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--disk-latency', type=float, default=0,
+        help='Milliseconds a log file write takes (default: %(default)s)'
+    )
+    parser.add_argument('--output', help='File to write the JSON results to')
+    args = parser.parse_args()
+
+    latency = args.disk_latency / 1000
+    repeats = args.repeats
+    if latency:
+        # every write sleeps, keep the run short
+        repeats = max(1, min(repeats, int(0.5 / latency)))
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='bench-flavor-logging-')
+    path = os.path.join(workdir, 'flavor.log')
+    try:
+        for level in ('INFO', 'DEBUG'):
+            for pipeline in ('file', 'queue'):
+                for name, calls in VARIANTS:
+                    samples = [
+                        measure(
+                            calls, pipeline, getattr(logging, level), path,
+                            latency, repeats
+                        )
+                        for _ in range(args.runs)
+                    ]
+                    results['{}_{}_{}'.format(level, pipeline, name)] = (
+                        statistics.median(samples)
+                    )
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rmdir(workdir)
+
+    print('{:<8} {:<8} {:>14} {:>14}'.format(
+        'level', 'pipeline', 'eager [us]', 'lazy [us]'
+    ))
+    for level in ('INFO', 'DEBUG'):
+        for pipeline in ('file', 'queue'):
+            print('{:<8} {:<8} {:>14.2f} {:>14.2f}'.format(
+                level, pipeline,
+                results['{}_{}_eager'.format(level, pipeline)] * 1e6,
+                results['{}_{}_lazy'.format(level, pipeline)] * 1e6
+            ))
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#! /usr/bin/python3
+"""
+Load generator for the /api/instance/check endpoint of an RMT server.
+
+Sends instance checks built by the same code as make_request, at a
+given rate and concurrency, and reports the throughput, the mix of
+answers and errors and the latency percentiles. The metadata and
+identifier pairs are read from a JSON lines file, the input format of
+instance-flavor-batch-check, or made up. Without --server the checks
+go to a local stand-in RMT server.
+
+With a rate, every request has a scheduled send time and its latency
+is measured from that time, requests waiting for a free worker count
+as slow instead of being left out of the percentiles.
+
+Example:
+    python3 benchmarks/load_check.py --rate 200 --requests 2000
+    python3 benchmarks/load_check.py --server 10.0.0.5 \\
+        --records instances.jsonl --rate 500 --concurrency 128
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import bench_env
+from instance_billing_flavor_check import utils
+from rmt_stub import RMTStub
+
+# Distinct made up metadata and identifier pairs replayed
+SYNTHETIC_RECORDS = 100
+# Percentiles reported of the request latency
+PERCENTILES = (50, 95, 99)
+
+
+def read_records(path):
+    """Return the (metadata, identifier) pairs of the JSON lines file."""
+    records = []
+    with open(path) as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            records.append((record['metadata'], record['identifier']))
+    return records
+
+
+def make_records(count, metadata_size):
+    """Return count made up (metadata, identifier) pairs."""
+    return [
+        (
+            '<document>{}</document>'.format(
+                os.urandom(metadata_size // 2).hex()
+            ),
+            'SLES'
+        )
+        for _ in range(count)
+    ]
+
+
+class Sender:
+    """
+    **Sends single instance check attempts**
+    The URL, the query and the compressed body are built as
+    make_request does. Every worker thread keeps its own HTTP session,
+    unless new_connections is set, then every request opens a new
+    connection like a freshly booted instance does.
+    """
+    def __init__(
+        self, rmt_ip_addr, records, mode='get', timeout=None,
+        proxies=None, new_connections=False
+    ):
+        self.rmt_ip_addr = rmt_ip_addr
+        self.url = utils._get_instance_check_url(rmt_ip_addr)
+        self.timeout = timeout or utils.REQUEST_TIMEOUT
+        self.proxies = proxies
+        self.new_connections = new_connections
+        self.requests = utils._import_requests()
+        self.checks = []
+        for metadata, identifier in records:
+            query = utils._get_query(metadata, identifier)
+            body = None
+            if mode == 'post':
+                body = utils._get_compressed_body(rmt_ip_addr, query)
+            self.checks.append((query, body))
+        self._local = threading.local()
+
+    def _get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None or self.new_connections:
+            session = self.requests.Session()
+            session.verify = False
+            self._local.session = session
+        return session
+
+    def send(self, index):
+        """Send the check of record index, return the outcome."""
+        query, body = self.checks[index % len(self.checks)]
+        session = self._get_session()
+        try:
+            response = utils._send_check(
+                session, self.rmt_ip_addr, self.url, query, body,
+                self.timeout, self.proxies
+            )
+            outcome = str(response.status_code)
+            if response.status_code == 200 and \
+                    response.json().get('flavor') not in utils.FLAVOUR_CODES:
+                outcome = 'no_flavor'
+        except self.requests.exceptions.Timeout:
+            outcome = 'timeout'
+        except self.requests.exceptions.ConnectionError:
+            outcome = 'connection_error'
+        except Exception:
+            outcome = 'error'
+        finally:
+            if self.new_connections:
+                session.close()
+        return outcome
+
+
+def run(send, total, concurrency, rate=None):
+    """
+    Call send with the indexes 0 to total - 1 from concurrency threads,
+    starting at most rate calls per second. Return the (latency,
+    outcome) of every call and the seconds all calls took.
+    """
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+    start = time.monotonic()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            began = time.monotonic()
+            if rate:
+                scheduled = start + index / rate
+                if scheduled > began:
+                    time.sleep(scheduled - began)
+                began = scheduled
+            outcome = send(index)
+            latency = time.monotonic() - began
+            with lock:
+                results.append((latency, outcome))
+
+    workers = [
+        threading.Thread(target=worker, daemon=True)
+        for _ in range(concurrency)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, time.monotonic() - start
+
+
+def percentile(samples, percent):
+    """Return the nearest rank percentile of the sorted samples."""
+    rank = max(1, -(-len(samples) * percent // 100))
+    return samples[int(rank) - 1]
+
+
+def summarize(results, elapsed, rate, concurrency):
+    latencies = sorted(latency for latency, _ in results)
+    outcomes = {}
+    for _, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    summary = {
+        'requests': len(results),
+        'seconds': elapsed,
+        'throughput': len(results) / elapsed if elapsed else None,
+        'rate': rate,
+        'concurrency': concurrency,
+        'outcomes': outcomes,
+        'errors': len(results) - outcomes.get('200', 0),
+        'latency': {},
+    }
+    if latencies:
+        for percent in PERCENTILES:
+            summary['latency']['p{}'.format(percent)] = percentile(
+                latencies, percent
+            )
+        summary['latency']['max'] = latencies[-1]
+    return summary
+
+
+def report(summary):
+    print('requests     {} in {:.2f} s, {:.1f} per second{}'.format(
+        summary['requests'], summary['seconds'], summary['throughput'] or 0,
+        ' (target {})'.format(summary['rate']) if summary['rate'] else ''
+    ))
+    print('concurrency  {}'.format(summary['concurrency']))
+    print('latency      {}'.format('  '.join(
+        '{} {:.1f} ms'.format(name, value * 1000)
+        for name, value in summary['latency'].items()
+    )))
+    print('outcomes     {}'.format(', '.join(
+        '{}: {}'.format(outcome, count)
+        for outcome, count in sorted(summary['outcomes'].items())
+    )))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the instance check of an update server'
+    )
+    parser.add_argument(
+        '--server',
+        help='IP address of the update server, default a local stand-in'
+    )
+    parser.add_argument(
+        '--port', type=int, default=443,
+        help='HTTPS port of the update server (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--records',
+        help=(
+            'JSON lines file with the metadata and identifier of the '
+            'instances, default made up ones'
+        )
+    )
+    parser.add_argument(
+        '--metadata-size', type=int, default=bench_env.METADATA_SIZE,
+        help='Bytes of made up metadata (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--requests', type=int, default=1000,
+        help='Number of checks to send (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--rate', type=float,
+        help='Checks started per second, default as fast as possible'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=32,
+        help='Checks in flight at once (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--mode', choices=('get', 'post'), default='get',
+        help='How the check is sent (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=utils.REQUEST_TIMEOUT,
+        help='Seconds a single check may take (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--new-connections', action='store_true',
+        help='Open a new connection for every check'
+    )
+    parser.add_argument(
+        '--stub-delay', type=float, default=0,
+        help='Seconds the local stand-in takes to answer'
+    )
+    parser.add_argument('--output', help='File to write the JSON summary to')
+    args = parser.parse_args()
+
+    # failed checks are counted, keep them quiet
+    utils.logger.addHandler(logging.NullHandler())
+    records = read_records(args.records) if args.records else make_records(
+        SYNTHETIC_RECORDS, args.metadata_size
+    )
+    stub = None
+    server, proxies = args.server, None
+    utils.RMT_HTTPS_PORT = args.port
+    if not server:
+        stub = RMTStub(post=True, delay=args.stub_delay).__enter__()
+        server, proxies = '127.0.0.1', {}
+        utils.RMT_HTTPS_PORT = stub.port
+    if proxies is None:
+        proxies = utils._get_proxies()
+    try:
+        sender = Sender(
+            server, records, args.mode, args.timeout, proxies,
+            args.new_connections
+        )
+        results, elapsed = run(
+            sender.send, args.requests, args.concurrency, args.rate
+        )
+    finally:
+        if stub:
+            stub.__exit__()
+    summary = summarize(results, elapsed, args.rate, args.concurrency)
+    summary['server'] = args.server or 'stand-in'
+    summary['mode'] = args.mode
+    report(summary)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(summary, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
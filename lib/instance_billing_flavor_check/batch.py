@@ -0,0 +1,209 @@
+# Copyright 2024 SUSE LLC
+#
+# This file is part of instance-billing-flavor-check
+#
+# instance-billing-flavor-check is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# instance-billing-flavor-check is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bulk verification of instance metadata and identifier pairs.
+
+Every input line is a JSON record with the metadata, identifier and
+rmt_ip of an instance. The records are checked with make_request by a
+bounded pool of workers and the results are produced in completion
+order, one JSON record per input line.
+"""
+
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from instance_billing_flavor_check import utils
+
+logger = logging.getLogger(__name__)
+
+# Requests in flight at once
+WORKERS = 32
+# Requests in flight to a single update server at once
+PER_SERVER = 8
+# Input lines read ahead of the workers, per worker
+READ_AHEAD = 2
+
+
+def parse_record(line):
+    """
+    Parse the JSON record of the input line.
+
+    Return the result record to fill in and the metadata to check, the
+    result record with the error and None for an invalid record.
+    """
+    result = {'flavor': None, 'code': 12, 'error': None}
+    try:
+        record = json.loads(line)
+        result['rmt_ip'] = record['rmt_ip']
+        result['identifier'] = record['identifier']
+        if 'id' in record:
+            result['id'] = record['id']
+        metadata = record['metadata']
+        if not isinstance(result['rmt_ip'], str):
+            raise TypeError('rmt_ip is not a string')
+    except (ValueError, TypeError, KeyError) as err:
+        result['error'] = 'Invalid record: {}'.format(err)
+        return result, None
+    return result, metadata
+
+
+def check_record(line, timeout=None, proxies=None, session=None):
+    """
+    Check the JSON record of the input line with make_request.
+
+    Return the result record with the flavor and its code, or the
+    error and code 12 when no flavour was answered.
+    """
+    result, metadata = parse_record(line)
+    if result['error']:
+        return result
+    return _check_parsed(result, metadata, timeout, proxies, session)
+
+
+def _check_parsed(result, metadata, timeout, proxies, session=None):
+    deadline = None
+    if timeout:
+        deadline = time.monotonic() + timeout
+    try:
+        flavour = utils.make_request(
+            result['rmt_ip'], metadata, result['identifier'],
+            deadline=deadline, proxies=proxies, session=session
+        )
+    except Exception as err:
+        result['error'] = 'Unexpected error: {}'.format(err)
+        return result
+    if flavour in utils.FLAVOUR_CODES:
+        result['flavor'] = flavour
+        result['code'] = utils.FLAVOUR_CODES[flavour]
+    else:
+        result['error'] = 'No flavor answered'
+    return result
+
+
+def check_records(
+    lines, workers=WORKERS, per_server=PER_SERVER, timeout=None
+):
+    """
+    Check the JSON records of the input lines.
+
+    Yield the result records in completion order, each one carries the
+    number of its input line. Only a bounded number of lines is read
+    ahead of the workers. The records wait in a queue per update
+    server and are handed to a worker only while less than per_server
+    requests go to their server, a worker never waits for a server.
+
+    The requests are sent through an HTTP session of their own with a
+    connection pool sized for the workers, the shared session of the
+    process is left as it is.
+    """
+    requests = utils._import_requests()
+    session = requests.Session()
+    session.verify = False
+    session.mount(
+        'https://',
+        requests.adapters.HTTPAdapter(pool_maxsize=max(workers, per_server))
+    )
+    proxies = utils._get_proxies()
+    results = queue.Queue()
+    read_ahead = threading.BoundedSemaphore(workers * READ_AHEAD)
+    # records waiting for their server and requests in flight to it
+    pending = {}
+    in_flight = {}
+    lock = threading.Lock()
+
+    def done(number, result):
+        result['line'] = number
+        results.put(result)
+        read_ahead.release()
+
+    def submit(executor, number, result, metadata):
+        try:
+            executor.submit(check, executor, number, result, metadata)
+        except RuntimeError as err:
+            # the pool was shut down, the results are no longer read
+            result['error'] = 'Unexpected error: {}'.format(err)
+            done(number, result)
+
+    def check(executor, number, result, metadata):
+        queued = None
+        try:
+            result = _check_parsed(
+                result, metadata, timeout, proxies, session
+            )
+        finally:
+            with lock:
+                rmt_ip_addr = result['rmt_ip']
+                if pending[rmt_ip_addr]:
+                    queued = pending[rmt_ip_addr].popleft()
+                else:
+                    in_flight[rmt_ip_addr] -= 1
+            done(number, result)
+            if queued is not None:
+                submit(executor, *queued)
+
+    def dispatch(executor, number, result, metadata):
+        with lock:
+            rmt_ip_addr = result['rmt_ip']
+            waiting = pending.setdefault(rmt_ip_addr, collections.deque())
+            start = in_flight.get(rmt_ip_addr, 0) < per_server
+            if start:
+                in_flight[rmt_ip_addr] = in_flight.get(rmt_ip_addr, 0) + 1
+            else:
+                waiting.append((number, result, metadata))
+        if start:
+            submit(executor, number, result, metadata)
+
+    def feed(executor):
+        submitted = 0
+        try:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                read_ahead.acquire()
+                submitted += 1
+                result, metadata = parse_record(line)
+                if result['error']:
+                    done(number, result)
+                    continue
+                dispatch(executor, number, result, metadata)
+        finally:
+            results.put(submitted)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            feeder = threading.Thread(
+                target=feed, args=(executor,), daemon=True
+            )
+            feeder.start()
+            total = None
+            produced = 0
+            while total is None or produced < total:
+                result = results.get()
+                if isinstance(result, int):
+                    total = result
+                    continue
+                produced += 1
+                yield result
+    finally:
+        session.close()
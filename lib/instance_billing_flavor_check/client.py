@@ -0,0 +1,49 @@
+# Copyright 2024 SUSE LLC
+#
+# This file is part of instance-billing-flavor-check
+#
+# instance-billing-flavor-check is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# instance-billing-flavor-check is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Client side of the flavor check service.
+
+This module is imported by the instance-flavor-check command before
+anything else, keep it free of heavy imports.
+"""
+
+import json
+import socket
+
+SOCKET_PATH = '/run/instance-flavor-check.sock'
+# Seconds to wait for the service to answer
+CLIENT_TIMEOUT = 60
+
+
+def query_service(socket_path=SOCKET_PATH, timeout=CLIENT_TIMEOUT):
+    """
+    Ask the flavor check service for the instance flavour.
+
+    Return the (flavour, code) tuple answered by the service, None if
+    the service is not available or does not answer properly.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall(b'check\n')
+            response = client.makefile('rb').readline()
+        result = json.loads(response.decode())
+        return (result['flavor'], int(result['code']))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
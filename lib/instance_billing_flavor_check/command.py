@@ -1,10 +1,35 @@
+import functools
 import logging
 import os
+import selectors
+import signal
 import subprocess
+import time
 from collections import namedtuple
 
 logger = logging.getLogger('instance-flavor-check')
 
+# Bytes read from the command pipes at once
+READ_CHUNK_SIZE = 65536
+
+
+class command_type(
+    namedtuple('command', ['raw_output', 'raw_error', 'returncode'])
+):
+    """
+    Call results of a command. stdout and stderr are kept as
+    bytes and only decoded when output and error are accessed
+    """
+    __slots__ = ()
+
+    @property
+    def output(self):
+        return self.raw_output.decode()
+
+    @property
+    def error(self):
+        return self.raw_error.decode()
+
 
 class Command:
     """
@@ -14,61 +39,215 @@ class Command:
     stdout and stderr is given to the caller
     """
     @staticmethod
-    def run(command, custom_env=None, raise_on_error=True):
+    def run(
+        command, custom_env=None, raise_on_error=True, timeout=None,
+        max_output=None
+    ):
         """
         Execute a program and block the caller. The return value
         is a hash containing the stdout, stderr and return code
         information. Unless raise_on_error is set to false an
         exception is thrown if the command exits with an error
-        code not equal to zero
+        code not equal to zero. A command running longer than
+        the timeout in seconds or writing more than max_output
+        bytes is killed and an exception is thrown
         Example:
         .. code:: python
             result = Command.run(['ls', '-l'])
         :param list command: command and arguments
         :param list custom_env: custom os.environ
         :param bool raise_on_error: control error behaviour
+        :param float timeout: seconds the command may run
+        :param int max_output: bytes the command may write
         :return:
-            Contains call results in command type
+            Contains call results in command type, output and
+            error are decoded from raw_output and raw_error on access
             .. code:: python
-                command(output='string', error='string', returncode=int)
+                command(raw_output=b'bytes', raw_error=b'bytes', returncode=int)
         :rtype: namedtuple
         """
-        command_type = namedtuple(
-            'command', ['output', 'error', 'returncode']
+        return Command.start(command, custom_env).wait(
+            timeout=timeout,
+            raise_on_error=raise_on_error,
+            max_output=max_output
         )
+
+    @staticmethod
+    def start(command, custom_env=None):
+        """
+        Execute a program and return to the caller right away.
+        The returned CommandCall is used to poll, wait for or
+        kill the program. The program runs in its own process
+        group, killing it kills the processes it started too
+        Example:
+        .. code:: python
+            call = Command.start(['ls', '-l'])
+            result = call.wait(timeout=2)
+        :param list command: command and arguments
+        :param list custom_env: custom os.environ
+        :return: handle of the running program
+        :rtype: CommandCall
+        """
         environment = os.environ
         if custom_env:
             environment = custom_env
         try:
-            logger.debug('Calling: {0}'.format(command))
+            logger.debug('Calling: %s', command)
             process = subprocess.Popen(
                 command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                env=environment
+                env=environment,
+                start_new_session=True
             )
         except Exception as issue:
             raise Exception(
                 '{0}: {1}: {2}'.format(command[0], type(issue).__name__, issue)
             )
-        output, error = process.communicate()
-        if process.returncode != 0 and not error:
+        return CommandCall(command, process)
+
+
+class CommandCall:
+    """
+    **Implements a command running in non blocking mode**
+    Returned by Command.start, provides methods to poll,
+    wait for and kill the running command
+    """
+    def __init__(self, command, process):
+        self.command = command
+        self.process = process
+
+    def poll(self):
+        """
+        Return the exit code of the command, None while it runs
+        :rtype: int
+        """
+        return self.process.poll()
+
+    def kill(self):
+        """
+        Kill the process group of the command and reap it, also when
+        the command exited but left processes behind holding its pipes
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        except OSError:
+            if self.process.poll() is None:
+                self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream and not stream.closed:
+                stream.close()
+
+    def _read(self, deadline, max_output):
+        """
+        Read stdout and stderr until the command closes them. Return
+        None if the deadline passed, False if more than max_output
+        bytes were written, the output and error bytes otherwise
+        """
+        chunks = {self.process.stdout: [], self.process.stderr: []}
+        size = 0
+        with selectors.DefaultSelector() as selector:
+            for stream in chunks:
+                selector.register(stream, selectors.EVENT_READ)
+            while selector.get_map():
+                time_left = None
+                if deadline is not None:
+                    time_left = deadline - time.monotonic()
+                    if time_left <= 0:
+                        return None
+                for key, _ in selector.select(time_left):
+                    data = os.read(key.fd, READ_CHUNK_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+                    chunks[key.fileobj].append(data)
+                    size += len(data)
+                    if max_output is not None and size > max_output:
+                        return False
+        return (
+            b''.join(chunks[self.process.stdout]),
+            b''.join(chunks[self.process.stderr])
+        )
+
+    def wait(self, timeout=None, raise_on_error=True, max_output=None):
+        """
+        Block the caller until the command exits, at most for the
+        timeout in seconds. The output is read while the command
+        runs. A command running longer or writing more than
+        max_output bytes to stdout and stderr is killed and an
+        exception is thrown. Otherwise the result is the same as
+        the one of Command.run
+        :param float timeout: seconds to wait for the command
+        :param bool raise_on_error: control error behaviour
+        :param int max_output: bytes the command may write
+        :return:
+            Contains call results in command type
+            .. code:: python
+                command(raw_output=b'bytes', raw_error=b'bytes', returncode=int)
+        :rtype: namedtuple
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        streams = self._read(deadline, max_output)
+        if streams:
+            output, error = streams
+            try:
+                self.process.wait(
+                    None if deadline is None
+                    else max(0, deadline - time.monotonic())
+                )
+            except subprocess.TimeoutExpired:
+                streams = None
+        if not streams:
+            self.kill()
+            if streams is None:
+                message = 'timed out after {0}s'.format(timeout)
+            else:
+                message = 'output exceeds {0} bytes'.format(max_output)
+            logger.error('EXEC: %s %s', self.command[0], message)
+            raise Exception('{0}: {1}'.format(self.command[0], message))
+        if self.process.returncode != 0 and not error:
             error = bytes(b'(no output on stderr)')
-        if process.returncode != 0 and not output:
+        if self.process.returncode != 0 and not output:
             output = bytes(b'(no output on stdout)')
-        if process.returncode != 0 and raise_on_error:
+        if self.process.returncode != 0 and raise_on_error:
             logger.error(
-                'EXEC: Failed with stderr: {0}, stdout: {1}'.format(
-                    error.decode(), output.decode()
-                )
+                'EXEC: Failed with stderr: %s, stdout: %s',
+                error.decode(), output.decode()
             )
             raise Exception(
                 '{0}: stderr: {1}, stdout: {2}'.format(
-                    command[0], error.decode(), output.decode()
+                    self.command[0], error.decode(), output.decode()
                 )
             )
         return command_type(
-            output=output.decode(),
-            error=error.decode(),
-            returncode=process.returncode
+            raw_output=output,
+            raw_error=error,
+            returncode=self.process.returncode
+        )
+
+    async def wait_async(
+        self, timeout=None, raise_on_error=True, max_output=None
+    ):
+        """
+        Awaitable variant of wait, the waiting is done in the
+        default executor of the running event loop
+        Example:
+        .. code:: python
+            result = await Command.start(['ls', '-l']).wait_async()
+        :param float timeout: seconds to wait for the command
+        :param bool raise_on_error: control error behaviour
+        :param int max_output: bytes the command may write
+        :rtype: namedtuple
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(self.wait, timeout, raise_on_error, max_output)
         )
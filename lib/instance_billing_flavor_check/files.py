@@ -0,0 +1,163 @@
+# Copyright 2024 SUSE LLC
+#
+# This file is part of instance-billing-flavor-check
+#
+# instance-billing-flavor-check is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# instance-billing-flavor-check is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers for the files shared by concurrent flavor checks.
+"""
+
+import fcntl
+import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+# Seconds between the attempts to take a lock held by another check
+LOCK_POLL_INTERVAL = 0.05
+
+
+def write_atomic(path, content, mode=0o644):
+    """
+    Replace the file at path with the content in one step.
+
+    The content is written to a temporary file next to it, synced to
+    disk and renamed over the file, readers see either the old or the
+    new content, never a partially written file.
+    """
+    directory = os.path.dirname(path) or '.'
+    descriptor, temp_path = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(path))
+    )
+    try:
+        with os.fdopen(descriptor, 'w') as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _take_lock(descriptor, timeout):
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        pass
+    if timeout is None:
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        return False
+    deadline = time.monotonic() + timeout
+    while True:
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            return None
+        time.sleep(min(LOCK_POLL_INTERVAL, time_left))
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            pass
+
+
+@contextmanager
+def exclusive_lock(path, timeout=None):
+    """
+    Hold an exclusive lock on the file at path for the block, waiting
+    at most timeout seconds for another holder, forever if None.
+
+    The block is entered with True if the lock was free, False if it
+    was taken after waiting for another holder and None if it could
+    not be taken in time or the lock file could not be opened.
+    Example:
+    .. code:: python
+        with exclusive_lock('/run/foo.lock', timeout=5) as locked:
+            if locked is False:
+                # another process just did the work
+                pass
+    """
+    try:
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        descriptor = None
+    if descriptor is None:
+        yield None
+        return
+    try:
+        yield _take_lock(descriptor, timeout)
+    finally:
+        # closing the last descriptor releases the lock
+        os.close(descriptor)
+
+
+class AsyncExclusiveLock:
+    """
+    **Asynchronous variant of exclusive_lock**
+    The lock is tried without blocking the event loop, every
+    LOCK_POLL_INTERVAL seconds while another holder has it. The block
+    is entered with True, False or None like exclusive_lock.
+    Example:
+    .. code:: python
+        async with AsyncExclusiveLock('/run/foo.lock', timeout=5) as locked:
+            if locked is False:
+                # another process just did the work
+                pass
+    """
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.descriptor = None
+
+    async def __aenter__(self):
+        import asyncio
+        try:
+            self.descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        waited = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(self.descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return not waited
+                except BlockingIOError:
+                    pass
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                waited = True
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        except BaseException:
+            # the block is not entered when cancelled while waiting
+            self._close()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self._close()
+
+    def _close(self):
+        if self.descriptor is not None:
+            # closing the descriptor releases the lock
+            os.close(self.descriptor)
+            self.descriptor = None
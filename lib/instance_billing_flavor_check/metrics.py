@@ -0,0 +1,325 @@
+# Copyright 2024 SUSE LLC
+#
+# This file is part of instance-billing-flavor-check
+#
+# instance-billing-flavor-check is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# instance-billing-flavor-check is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timing spans and counters of a flavor check.
+
+The check code records into the current Timings through span and
+count. Unless a check installs a Timings with use, the current one
+is a recorder dropping everything, so the instrumentation costs next
+to nothing when disabled. The current Timings is kept per thread,
+threads started by a check record into it through bind.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from instance_billing_flavor_check import files
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for another check updating the metrics state
+STATE_LOCK_TIMEOUT = 2
+# Upper bounds in seconds of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+METRIC_PREFIX = 'instance_flavor_check_'
+METRIC_HELP = {
+    'checks_total': ('counter', 'Flavor checks by result code'),
+    'cache_hits_total': (
+        'counter', 'Checks answered from a fresh cache record'
+    ),
+    'cache_misses_total': (
+        'counter', 'Checks without a fresh cache record'
+    ),
+    'refreshes_total': (
+        'counter', 'Background cache refreshes started'
+    ),
+    'budget_spent_total': (
+        'counter', 'Checks not asking the update server, budget spent'
+    ),
+    'requests_total': ('counter', 'Update server request attempts'),
+    'retries_total': ('counter', 'Update server request attempts retried'),
+    'duration_seconds': ('histogram', 'Duration of the flavor check'),
+    'request_duration_seconds': (
+        'histogram', 'Duration of the update server request attempts'
+    ),
+    'last_check_timestamp_seconds': (
+        'gauge', 'Time of the last flavor check'
+    ),
+}
+
+
+class _Span:
+    """Times the block it is entered for, see Timings.span."""
+    __slots__ = ('timings', 'name', 'attrs', 'start')
+
+    def __init__(self, timings, name, attrs):
+        self.timings = timings
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self.attrs
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, self.start, time.monotonic(), self.attrs)
+
+
+class _NullSpan:
+    """Span of a disabled recorder, times nothing."""
+    __slots__ = ('attrs',)
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+
+    def __enter__(self):
+        return self.attrs
+
+    def __exit__(self, *args):
+        pass
+
+
+class Timings:
+    """
+    **Spans and counters of one flavor check**
+    Spans hold the name, the start relative to the creation of the
+    Timings, the duration and the attributes set by the timed code.
+    Spans and counters may be recorded from several threads.
+    """
+    def __init__(self):
+        self.created = time.monotonic()
+        self.spans = []
+        self.counters = {}
+        self.result = None
+        self._lock = threading.Lock()
+
+    def span(self, name, **attrs):
+        """
+        Return a context manager timing its block as the named span.
+        Entering it returns the attributes of the span for the timed
+        code to add to
+        Example:
+        .. code:: python
+            with timings.span('request', server=ip) as attrs:
+                attrs['status'] = 200
+        """
+        return _Span(self, name, attrs)
+
+    def add(self, name, start, end, attrs=None):
+        span = {
+            'name': name,
+            'start': round(start - self.created, 6),
+            'duration': round(end - start, 6)
+        }
+        span.update(attrs or {})
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        result = {'spans': self.spans, 'counters': self.counters}
+        if self.result:
+            result['flavor'], result['code'] = self.result
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+
+class _NullTimings:
+    """Recorder installed while no check records timings."""
+    def span(self, name, **attrs):
+        return _NullSpan(attrs)
+
+    def count(self, name, value=1):
+        pass
+
+
+_null_timings = _NullTimings()
+# Recorder of the check running in the thread
+_local = threading.local()
+
+
+def _get_current():
+    return getattr(_local, 'timings', _null_timings)
+
+
+def span(name, **attrs):
+    """Time a block as the named span of the current check."""
+    return _get_current().span(name, **attrs)
+
+
+def count(name, value=1):
+    """Add to the named counter of the current check."""
+    _get_current().count(name, value)
+
+
+def use(timings):
+    """
+    Make timings the recorder of the current check in this thread,
+    None disables recording. Return the recorder used so far.
+    """
+    previous = _get_current()
+    _local.timings = timings or _null_timings
+    return previous if isinstance(previous, Timings) else None
+
+
+def bind(function):
+    """
+    Return function recording into the Timings current in the calling
+    thread, to run in a thread or executor started by the check. A
+    thread outliving the check records into its Timings, never into
+    the one of a later check.
+    """
+    timings = _get_current()
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        previous = use(timings)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            use(previous)
+    return bound
+
+
+def _read_state(state_path):
+    try:
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        state = {}
+    if not isinstance(state, dict):
+        state = {}
+    state.setdefault('counters', {})
+    state.setdefault('histograms', {})
+    state.setdefault('gauges', {})
+    return state
+
+
+def _series(name, **labels):
+    """Return the series key of the metric with the labels."""
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join(
+        '{}="{}"'.format(label, str(value).replace('"', '\\"'))
+        for label, value in sorted(labels.items())
+    ))
+
+
+def _observe(histograms, series, value):
+    histogram = histograms.setdefault(series, {
+        'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0, 'count': 0
+    })
+    for index, bound in enumerate(HISTOGRAM_BUCKETS):
+        if value <= bound:
+            histogram['buckets'][index] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+def update_state(state, timings):
+    """Add the counters and spans of the check to the metrics state."""
+    counters = state['counters']
+
+    def increment(series, value=1):
+        counters[series] = counters.get(series, 0) + value
+
+    if timings.result:
+        increment(_series('checks_total', code=timings.result[1]))
+    increment('cache_hits_total', timings.counters.get('cache_hit', 0))
+    increment('cache_misses_total', timings.counters.get('cache_miss', 0))
+    increment('refreshes_total', timings.counters.get('refresh_ahead', 0))
+    increment('budget_spent_total', timings.counters.get('budget_spent', 0))
+    increment('retries_total', timings.counters.get('retries', 0))
+    for span in timings.spans:
+        if span['name'] == 'check':
+            _observe(
+                state['histograms'], 'duration_seconds', span['duration']
+            )
+        elif span['name'] == 'request':
+            increment(_series(
+                'requests_total',
+                server=span.get('server'),
+                outcome=span.get('outcome', 'unknown')
+            ))
+            _observe(
+                state['histograms'],
+                _series('request_duration_seconds', server=span.get('server')),
+                span['duration']
+            )
+    state['gauges']['last_check_timestamp_seconds'] = time.time()
+    return state
+
+
+def format_textfile(state):
+    """Return the metrics state in the Prometheus text format."""
+    lines = []
+    described = set()
+
+    def describe(series):
+        name = series.split('{')[0]
+        if name not in described:
+            described.add(name)
+            kind, text = METRIC_HELP[name]
+            lines.append('# HELP {0}{1} {2}'.format(METRIC_PREFIX, name, text))
+            lines.append('# TYPE {0}{1} {2}'.format(METRIC_PREFIX, name, kind))
+
+    for group in ('counters', 'gauges'):
+        for series, value in sorted(state[group].items()):
+            describe(series)
+            lines.append('{0}{1} {2}'.format(METRIC_PREFIX, series, value))
+    for series, histogram in sorted(state['histograms'].items()):
+        describe(series)
+        name, _, labels = series.partition('{')
+        labels = labels.rstrip('}')
+        for bound, bucket in zip(
+            HISTOGRAM_BUCKETS + ('+Inf',),
+            histogram['buckets'] + [histogram['count']]
+        ):
+            lines.append('{0}{1}_bucket{{{2}le="{3}"}} {4}'.format(
+                METRIC_PREFIX, name, labels + ',' if labels else '',
+                bound, bucket
+            ))
+        for suffix in ('sum', 'count'):
+            lines.append('{0}{1}_{2}{3} {4}'.format(
+                METRIC_PREFIX, name, suffix,
+                '{' + labels + '}' if labels else '', histogram[suffix]
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(timings, path, state_path):
+    """
+    Add the check to the metrics kept in state_path and write them
+    as node exporter textfile to path. Concurrent checks update the
+    state one after another.
+    """
+    with files.exclusive_lock(state_path + '.lock', STATE_LOCK_TIMEOUT):
+        state = update_state(_read_state(state_path), timings)
+        try:
+            files.write_atomic(state_path, json.dumps(state))
+            files.write_atomic(path, format_textfile(state))
+        except OSError as err:
+            logger.error('Could not write the metrics to %s: %s', path, err)
@@ -0,0 +1,129 @@
+# Copyright 2024 SUSE LLC
+#
+# This file is part of instance-billing-flavor-check
+#
+# instance-billing-flavor-check is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# instance-billing-flavor-check is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resident flavor check service answering over a Unix socket.
+
+Every connection is answered with one JSON line holding the flavor and
+the code as returned by check_payg_byos. The service keeps the result
+in a utils.FlavorChecker, a verified answer until it is older than the
+cacheTTL, a fallback or unreliable one for RECHECK_INTERVAL seconds.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+
+from instance_billing_flavor_check import utils
+from instance_billing_flavor_check.client import SOCKET_PATH
+
+logger = logging.getLogger(__name__)
+
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+# Seconds an unreliable result is kept before checking again
+RECHECK_INTERVAL = 60
+# Seconds a client may take to send its query or read the answer
+HANDLER_TIMEOUT = 10
+
+
+class FlavorCheckHandler(socketserver.StreamRequestHandler):
+    """Answer a single flavor query."""
+    timeout = HANDLER_TIMEOUT
+
+    def handle(self):
+        try:
+            self.rfile.readline()
+        except socket.timeout:
+            logger.warning('Client did not send its query in time')
+            return
+        flavour, code = self.server.get_flavour()
+        self.wfile.write(
+            json.dumps({'flavor': flavour, 'code': code}).encode() + b'\n'
+        )
+
+
+class FlavorCheckServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """
+    **Implements the flavor check service**
+    Holds the last check result in memory, only one check
+    runs at a time no matter how many clients ask.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH, listen_socket=None):
+        self.checker = utils.FlavorChecker(recheck_interval=RECHECK_INTERVAL)
+        if listen_socket is None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, FlavorCheckHandler
+            )
+            os.chmod(socket_path, 0o600)
+        else:
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, FlavorCheckHandler,
+                bind_and_activate=False
+            )
+            # the socket created by the constructor is not used
+            self.socket.close()
+            self.socket = listen_socket
+
+    def get_flavour(self):
+        """Return the (flavour, code), check again if the result expired."""
+        return tuple(self.checker.check())
+
+
+def get_activation_socket():
+    """
+    Return the listening socket passed by systemd socket activation,
+    None if the service was not socket activated.
+    """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return None
+    try:
+        listen_fds = int(os.environ.get('LISTEN_FDS', '0'))
+    except ValueError:
+        return None
+    if listen_fds < 1:
+        return None
+    return socket.socket(
+        socket.AF_UNIX, socket.SOCK_STREAM, fileno=SD_LISTEN_FDS_START
+    )
+
+
+def serve(socket_path=SOCKET_PATH):
+    """Run the flavor check service until interrupted."""
+    listen_socket = get_activation_socket()
+    server = FlavorCheckServer(socket_path, listen_socket)
+    logger.info(
+        'Flavor check service listening on %s%s',
+        socket_path,
+        ' (socket activated)' if listen_socket else ''
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if listen_socket is None and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -15,133 +15,787 @@
 # You should have received a copy of the GNU General Public License along with
 # instance-billing-flavor-check. If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import base64
 import csv
 import configparser
+import contextlib
+import email.utils
+import functools
+import gzip
+import hashlib
 import ipaddress
+import json
 import logging
+import logging.handlers
 import os
-import requests
+import queue
+import random
+import re
+import subprocess
 import sys
+import threading
 import time
+import types
+import urllib.parse
 
+from collections import namedtuple
+from instance_billing_flavor_check import files, metrics
 from instance_billing_flavor_check.command import Command
-from lxml import etree
 
+# requests, lxml and cloudregister are slow to import, they are only
+# imported by the code paths needing them so that answering from the
+# cache starts fast
 logger = logging.getLogger(__name__)
-log_filename = '/var/log/{}'.format(__name__.split('.')[0])
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    format="%(asctime)s: %(message)s"
-)
-try:
-    from cloudregister.registerutils import (
-        get_smt, has_ipv4_access, has_ipv6_access
+
+# Set on first use by _import_cloudregister
+get_smt = None
+has_ipv4_access = None
+has_ipv6_access = None
+
+# IP families the instance can reach the internet through
+NetworkAccess = namedtuple('NetworkAccess', ['ipv4', 'ipv6'])
+# Network access probed per network state signature, see
+# _get_network_access
+_network_access_cache = {}
+
+
+class FlavorResult:
+    """
+    **Result of a flavor check**
+    Holds the flavor and code as returned by check_payg_byos, where
+    the answer came from, the update server that answered, the
+    time.time() it answered at and the seconds the check took. The
+    source is one of
+
+    - server: answered by the update server
+    - cache: taken from a recent check
+    - fallback: the cached flavor or BYOS when the update server
+      could not be asked
+    """
+    __slots__ = (
+        'flavor', 'code', 'source', 'server', 'timestamp', 'elapsed'
     )
-except ImportError:
-    get_smt = None
-    has_ipv4_access = None
-    has_ipv6_access = None
 
+    def __init__(
+        self, flavor, code, source, server=None, timestamp=None,
+        elapsed=None
+    ):
+        self.flavor = flavor
+        self.code = code
+        self.source = source
+        self.server = server
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+
+    def __iter__(self):
+        return iter((self.flavor, self.code))
+
+    def __repr__(self):
+        return (
+            'FlavorResult(flavor={0!r}, code={1!r}, source={2!r}, '
+            'server={3!r}, timestamp={4!r}, elapsed={5!r})'.format(
+                self.flavor, self.code, self.source, self.server,
+                self.timestamp, self.elapsed
+            )
+        )
+
+    @property
+    def verified(self):
+        """True if the flavor was reliably determined."""
+        return self.code in FLAVOUR_CODES.values()
+
+
+# Metadata fetch started by start_metadata, holds the cached metadata
+# or the running data provider call
+MetadataFetch = namedtuple('MetadataFetch', ['command', 'metadata', 'call'])
+
+# HTTP session shared by all update server requests, see _get_session
+_session = None
+_session_lock = threading.Lock()
+# Marks a request option not given by the caller
+_NOT_SET = object()
+# Marks a lookup that did not return before the deadline
+_TIMED_OUT = object()
+# Update servers that answered the compressed POST check as unsupported
+# and the time.monotonic() they did
+_post_unsupported = {}
+
+# Parsed configuration files, the regionserverclnt.cfg, proxy, hosts
+# and baseproduct, see _get_parsed_file
+_parsed_files = {}
+
+LOG_FILE_PATH = '/var/log/{}'.format(__name__.split('.')[0])
 REGION_SRV_CLIENT_CONFIG_PATH = '/etc/regionserverclnt.cfg'
 BASEPRODUCT_PATH = '/etc/products.d/baseproduct'
 CACHE_FILE_PATH='/var/cache/instance-billing-flavor-check'
+METADATA_CACHE_FILE_PATH = '/var/cache/instance-billing-flavor-check.metadata'
+IDENTIFIER_CACHE_FILE_PATH = (
+    '/var/cache/instance-billing-flavor-check.identifier'
+)
+METRICS_STATE_PATH = '/var/cache/instance-billing-flavor-check.metrics'
+LOCK_FILE_PATH = '/var/cache/instance-billing-flavor-check.lock'
+HEALTH_FILE_PATH = '/var/cache/instance-billing-flavor-check.health'
+CONNECTIVITY_CACHE_FILE_PATH = (
+    '/var/cache/instance-billing-flavor-check.connectivity'
+)
+BUDGET_FILE_PATH = '/var/cache/instance-billing-flavor-check.budget'
+REFRESH_FILE_PATH = '/var/cache/instance-billing-flavor-check.refresh'
+# Kernel network interface and route tables, the network access is
+# probed again once they changed. Listed with the columns holding use
+# counters that are left out
+NETWORK_STATE_FILES = (
+    ('/proc/net/route', (4, 5)),
+    ('/proc/net/ipv6_route', (6, 7)),
+    ('/proc/net/if_inet6', ()),
+)
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
 ETC_HOSTS_PATH = '/etc/hosts'
 PROXY_CONFIG_PATH = '/etc/sysconfig/proxy'
-
-requests.packages.urllib3.disable_warnings(
-    requests.packages.urllib3.exceptions.InsecureRequestWarning
+# Delay before the IPv4 candidates join the race when IPv6 candidates
+# exist, similar to the "happy eyeballs" connection attempt delay
+IPV4_STAGGER_DELAY = 0.25
+# Section of the regionserverclnt.cfg with the flavor check settings
+FLAVOR_CHECK_CONFIG_SECTION = 'flavorCheck'
+# Version of the cache record layout
+CACHE_VERSION = 1
+# Seconds a verified flavour is served from the cache without asking
+# the update server, set cacheTTL in the flavorCheck section to change
+CACHE_TTL = 3600
+# Seconds after which a fresh cached flavour is still returned but
+# refreshed in the background, set cacheRefreshAge in the flavorCheck
+# section to enable, 0 waits for the cacheTTL to expire
+CACHE_REFRESH_AGE = 0
+# Command refreshing the cache in the background
+REFRESH_COMMAND = ['/usr/bin/instance-flavor-check', '--refresh']
+# Seconds a started background refresh is waited for before another
+# one may be started, in case it died without finishing
+REFRESH_TIMEOUT = 300
+# Seconds the instance metadata is reused, set metadataCacheTTL in the
+# flavorCheck section to change, 0 disables the metadata cache
+METADATA_CACHE_TTL = 3600
+# Seconds before the expiry of a signed metadata document it is fetched
+# again
+METADATA_REFRESH_MARGIN = 300
+# Bytes the data provider may write before it is stopped
+METADATA_MAX_SIZE = 1024 * 1024
+# Signed JSON web tokens, e.g. the GCE identity document
+JWT_PATTERN = re.compile(
+    r'[A-Za-z0-9_-]{10,}\.([A-Za-z0-9_-]{10,})\.[A-Za-z0-9_-]+'
 )
+# Seconds the whole check may take before falling back to the cache,
+# set timeout in the flavorCheck section to bound the check
+CHECK_TIMEOUT = 0
+# Seconds a check waits for another one running at the same time to
+# finish and reuse its answer, it checks on its own after that
+LOCK_TIMEOUT = 60
+# Seconds the network access probed is reused while the interfaces
+# and routes do not change, set connectivityCacheTTL in the flavorCheck
+# section to change, 0 probes on every check
+CONNECTIVITY_CACHE_TTL = 60
+# Seconds a FlavorChecker keeps a fallback or unreliable result in
+# memory before checking again, a verified answer is kept until it is
+# older than the cacheTTL
+RECHECK_INTERVAL = 60
+# Seconds a single request attempt may take
+REQUEST_TIMEOUT = 2
+# Number of request attempts per update server
+REQUEST_ATTEMPTS = 3
+# Base and maximum seconds of the exponential backoff between attempts
+BACKOFF_BASE = 1
+BACKOFF_MAX = 8
+# Answers of a busy update server, it is asked again after the seconds
+# of its Retry-After header unless they are more than RETRY_AFTER_MAX
+RETRY_AFTER_STATUS = (429, 503)
+RETRY_AFTER_MAX = 30
+# Upper bound in seconds of the random wait before the update servers
+# are asked, spreading the checks of instances booted at the same time,
+# set startupJitter in the flavorCheck section to enable
+STARTUP_JITTER = 0
+# Update server checks a host may make per window of seconds, set
+# queryBudget and queryBudgetWindow in the flavorCheck section to
+# limit them, 0 does not limit. The cached flavour is used once the
+# budget is spent
+QUERY_BUDGET = 0
+QUERY_BUDGET_WINDOW = 3600
+FLAVOUR_CODES = {'PAYG': 10, 'BYOS': 11}
+# Weight of the latest answer time in the moving average kept per
+# update server
+HEALTH_LATENCY_WEIGHT = 0.3
+# Checks in a row an update server failed in before it is skipped, and
+# seconds it is skipped for before it is tried again
+CIRCUIT_FAILURES = 3
+CIRCUIT_COOL_OFF = 300
+# Seconds the health of an update server not asked any more is kept
+HEALTH_MAX_AGE = 7 * 24 * 3600
+# HTTPS port of the update servers
+RMT_HTTPS_PORT = 443
+# How the instance check is sent, 'get' with the metadata in the URL or
+# 'post' with a compressed body, set requestMode in the flavorCheck
+# section to change. Servers not supporting 'post' are sent 'get'
+REQUEST_MODES = ('get', 'post')
+REQUEST_MODE = 'get'
+# Answers of a server not supporting the compressed POST check
+POST_UNSUPPORTED_STATUS = (400, 404, 405, 411, 413, 415, 501)
+# Seconds a server not supporting the compressed POST check is sent GET
+# before POST is tried again, e.g. after the server was upgraded
+POST_RETRY_INTERVAL = 3600
+# Set timings in the flavorCheck section to log the timing spans of
+# every check as JSON line, set metricsFile to the path of a node
+# exporter textfile to export the check metrics to
+LOG_TIMINGS = False
+METRICS_FILE = ''
 
+LOG_FORMAT = '%(asctime)s: %(message)s'
+# Listener thread writing the queued log records, see setup_logging
+_log_listener = None
 
-def get_instance_data_command():
+
+def setup_logging(filename=LOG_FILE_PATH, level=logging.INFO):
+    """
+    Log to the given file, called by the entry points.
+
+    The log records are put on a queue and written to the file by a
+    listener thread, a check never waits for the disk. The records
+    still queued are written at exit. Like logging.basicConfig nothing
+    is done if the root logger has handlers already.
+    """
+    global _log_listener
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.Queue()
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+
+def _import_cloudregister():
+    """
+    Import the cloudregister helpers on first use.
+
+    Helpers already set, e.g. by tests, are kept.
+    """
+    global get_smt, has_ipv4_access, has_ipv6_access
+    if get_smt and has_ipv4_access and has_ipv6_access:
+        return
+    try:
+        from cloudregister import registerutils
+    except ImportError:
+        return
+    get_smt = get_smt or registerutils.get_smt
+    has_ipv4_access = has_ipv4_access or registerutils.has_ipv4_access
+    has_ipv6_access = has_ipv6_access or registerutils.has_ipv6_access
+
+
+def _import_requests():
+    """Import requests on first use, without insecure request warnings."""
+    import requests
+    requests.packages.urllib3.disable_warnings(
+        requests.packages.urllib3.exceptions.InsecureRequestWarning
+    )
+    return requests
+
+
+def _get_session():
+    """
+    Return the HTTP session shared by the update server requests.
+
+    The connections in its pool are kept alive and reused across the
+    attempts of a check and, in long running processes, across checks.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            requests = _import_requests()
+            _session = requests.Session()
+            _session.verify = False
+        return _session
+
+
+def _get_file_signature(path):
+    """
+    Return the (inode, mtime, size) signature of the file, it changes
+    whenever the file is modified or replaced. None if there is no file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _get_parsed_file(path, parse):
+    """
+    Return the result of parse(path), None if there is no file.
+
+    The result is kept with the signature of the file, the file is only
+    read and parsed again once it changed. Results are shared by all
+    callers and must not be modified.
+    """
+    signature = _get_file_signature(path)
+    if signature is None:
+        return None
+    cached = _parsed_files.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    try:
+        result = parse(path)
+    except OSError:
+        return None
+    _parsed_files[path] = (signature, result)
+    return result
+
+
+def _parse_region_config(path):
+    """
+    Return the sections of the regionserverclnt.cfg as read only
+    mappings of the lower case option names to the values.
+    """
     config = configparser.ConfigParser()
-    if config.read(REGION_SRV_CLIENT_CONFIG_PATH):
+    try:
+        with open(path, 'r') as config_file:
+            config.read_file(config_file)
+        sections = {
+            section: types.MappingProxyType(dict(config.items(section)))
+            for section in config.sections()
+        }
+    except configparser.Error as err:
+        logger.error("Could not parse %s: %s", path, err)
+        sections = {}
+    return types.MappingProxyType(sections)
+
+
+def _get_region_config():
+    """Return the parsed regionserverclnt.cfg, None if not readable."""
+    return _get_parsed_file(
+        REGION_SRV_CLIENT_CONFIG_PATH, _parse_region_config
+    )
+
+
+def _get_config_value(section, option, default):
+    config = _get_region_config() or {}
+    return config.get(section, {}).get(option.lower(), default)
+
+
+def get_instance_data_command():
+    config = _get_region_config()
+    if config is None:
+        logger.error("Could not read file %s", REGION_SRV_CLIENT_CONFIG_PATH)
+        return None
+    try:
+        return config['instance']['dataprovider']
+    except KeyError as err:
+        logger.error(
+            "Could not parse %s: %s", REGION_SRV_CLIENT_CONFIG_PATH, err
+        )
+
+
+def _get_config_float(option, default):
+    """
+    Return the float value of the given option from the flavorCheck
+    section of the regionserverclnt.cfg, default if not set.
+    """
+    value = _get_config_value(FLAVOR_CHECK_CONFIG_SECTION, option, None)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError as err:
+        logger.error(
+            "Could not parse %s: %s", REGION_SRV_CLIENT_CONFIG_PATH, err
+        )
+        return default
+
+
+def _get_config_string(option, default):
+    """
+    Return the value of the given option from the flavorCheck
+    section of the regionserverclnt.cfg, default if not set.
+    """
+    return _get_config_value(FLAVOR_CHECK_CONFIG_SECTION, option, default)
+
+
+def _get_config_boolean(option, default):
+    """
+    Return the boolean value of the given option from the flavorCheck
+    section of the regionserverclnt.cfg, default if not set.
+    """
+    value = _get_config_value(FLAVOR_CHECK_CONFIG_SECTION, option, None)
+    if value is None:
+        return default
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        logger.error(
+            "Could not parse %s: not a boolean: %s",
+            REGION_SRV_CLIENT_CONFIG_PATH, value
+        )
+        return default
+
+
+def _get_metrics_config():
+    """
+    Return the timings and metricsFile settings of the flavorCheck
+    section of the regionserverclnt.cfg, see LOG_TIMINGS.
+    """
+    return (
+        _get_config_boolean('timings', LOG_TIMINGS),
+        _get_config_string('metricsFile', METRICS_FILE)
+    )
+
+
+def _get_request_mode():
+    """Return the configured request mode, see REQUEST_MODE."""
+    mode = _get_config_string('requestMode', REQUEST_MODE).lower()
+    if mode not in REQUEST_MODES:
+        logger.error(
+            "Unknown requestMode '%s' in %s, using '%s'",
+            mode, REGION_SRV_CLIENT_CONFIG_PATH, REQUEST_MODE
+        )
+        mode = REQUEST_MODE
+    return mode
+
+
+def _get_time_left(deadline):
+    """Return the seconds left until the deadline, None without deadline."""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def _is_expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _call_until(deadline, function, *args):
+    """
+    Return function(*args), _TIMED_OUT if it does not return before
+    the deadline.
+
+    With a deadline the function runs in a daemon thread left behind
+    when the time is up, otherwise in the calling thread.
+    """
+    if deadline is None:
+        return function(*args)
+    outcome = {}
+
+    def call():
         try:
-            return config['instance']['dataProvider']
-        except Exception as err:
-            logger.error(
-                "Could not parse %s: %s", REGION_SRV_CLIENT_CONFIG_PATH, err
+            outcome['result'] = function(*args)
+        except BaseException as err:
+            outcome['error'] = err
+
+    worker = threading.Thread(target=metrics.bind(call), daemon=True)
+    worker.start()
+    worker.join(_get_time_left(deadline))
+    if worker.is_alive():
+        return _TIMED_OUT
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def _get_metadata_expiry(metadata):
+    """
+    Return the time the signed documents in the metadata expire,
+    None if no expiry is found.
+    """
+    expiry = None
+    for match in JWT_PATTERN.finditer(metadata):
+        payload = match.group(1)
+        try:
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
             )
-    else:
-        logger.error("Could not read file %s", REGION_SRV_CLIENT_CONFIG_PATH)
+            exp = float(claims['exp'])
+        except (ValueError, TypeError, KeyError):
+            continue
+        if expiry is None or exp < expiry:
+            expiry = exp
+    return expiry
+
+
+def _get_cached_metadata(command):
+    """
+    Return the cached metadata of the data provider command.
+
+    The cache is only valid for the boot and command it was written
+    for and until it expires, otherwise return None.
+    """
+    try:
+        with open(METADATA_CACHE_FILE_PATH, 'r') as cache:
+            record = json.load(cache)
+        if record['version'] != CACHE_VERSION:
+            return None
+        if record['boot_id'] != _get_boot_id():
+            return None
+        if record['command'] != command:
+            return None
+        if not record['timestamp'] <= time.time() < record['expires']:
+            return None
+        return record['metadata']
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
 
 
-def get_metadata():
-    """Return instance metadata."""
-    command = get_instance_data_command()
-    if not command:
+def _write_metadata_cache(command, metadata):
+    """
+    Cache the metadata fetched with the data provider command.
+
+    The cache expires after the metadataCacheTTL or shortly before
+    the signed documents in the metadata expire.
+    """
+    ttl = _get_config_float('metadataCacheTTL', METADATA_CACHE_TTL)
+    if ttl <= 0:
+        return
+    now = time.time()
+    expires = now + ttl
+    signed_expiry = _get_metadata_expiry(metadata)
+    if signed_expiry is not None:
+        expires = min(expires, signed_expiry - METADATA_REFRESH_MARGIN)
+    if expires <= now:
         return
+    record = {
+        'version': CACHE_VERSION,
+        'boot_id': _get_boot_id(),
+        'command': command,
+        'timestamp': now,
+        'expires': expires,
+        'metadata': metadata
+    }
+    try:
+        # the metadata holds signed instance documents, keep them private
+        files.write_atomic(
+            METADATA_CACHE_FILE_PATH, json.dumps(record), mode=0o600
+        )
+    except OSError as err:
+        logger.warning('Could not cache the metadata: %s', err)
+
+
+def invalidate_metadata_cache():
+    """Drop the cached metadata, the next check fetches it again."""
+    try:
+        os.unlink(METADATA_CACHE_FILE_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def start_metadata():
+    """
+    Start fetching the instance metadata without waiting for it.
+
+    Return a MetadataFetch to pass to get_metadata. It holds the cached
+    metadata if there is any, the running data provider command
+    otherwise.
+    """
+    command_line = get_instance_data_command()
+    if not command_line:
+        return MetadataFetch(command_line, None, None)
+
+    metadata = _get_cached_metadata(command_line)
+    if metadata:
+        logger.debug('Using cached metadata')
+        return MetadataFetch(command_line, metadata, None)
+
+    try:
+        call = Command.start(command_line.split(' '))
+    except Exception as err:
+        logger.error("Could not fetch the metadata: %s", err)
+        call = None
+    return MetadataFetch(command_line, None, call)
 
-    command = command.split(' ')
-    result = Command.run(command)
+
+def get_metadata(deadline=None, fetch=None):
+    """
+    Return instance metadata.
+
+    Metadata cached during the current boot for the same data
+    provider command is reused until it expires. The data provider
+    command is stopped when it runs past the deadline.
+
+    The fetch is the MetadataFetch of start_metadata, a new one is
+    started if not given.
+    """
+    if fetch is None:
+        fetch = start_metadata()
+    if fetch.call is None:
+        return fetch.metadata
+
+    try:
+        result = fetch.call.wait(
+            timeout=_get_time_left(deadline), max_output=METADATA_MAX_SIZE
+        )
+    except Exception as err:
+        logger.error("Could not fetch the metadata: %s", err)
+        return
     if result.returncode == 0:
-        return result.output
+        # decode the possibly large metadata only once
+        metadata = result.output
+        _write_metadata_cache(fetch.command, metadata)
+        return metadata
 
     logger.error(
         "Could not fetch the metadata after running the command '%s': '%s' with status '%s'",
-        ' '.join(command),
+        fetch.command,
         result.error,
         result.returncode
     )
 
 
-def get_identifier():
-    """Return the identifier found in /etc/products.d/baseproduct."""
+def _parse_identifier():
+    """
+    Return the name of the base product.
+
+    The file is parsed incrementally and parsing stops at the
+    name element of the product.
+    """
+    from lxml import etree
+    depth = 0
     try:
-        with open(BASEPRODUCT_PATH, encoding='utf-8') as stream:
-            base_prod_xml = stream.read()
-            prod_def_start = base_prod_xml.index('<product')
-            product_tree = etree.fromstring(base_prod_xml[prod_def_start:])
+        for event, element in etree.iterparse(
+            BASEPRODUCT_PATH, events=('start', 'end')
+        ):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and element.tag == 'name':
+                if element.text and element.text.strip():
+                    return element.text.strip().lower()
+                break
+    except (OSError, etree.XMLSyntaxError) as err:
+        logger.error("Could not parse '%s' file: %s", BASEPRODUCT_PATH, err)
+        return None
+    logger.error("No product name in '%s' file", BASEPRODUCT_PATH)
 
-        return product_tree.find('name').text.lower()
-    except FileNotFoundError:
-        logger.error("Could not open '%s' file", BASEPRODUCT_PATH)
 
+def _read_identifier_cache(signature):
+    """Return the identifier cached for the baseproduct file signature."""
+    try:
+        with open(IDENTIFIER_CACHE_FILE_PATH, 'r') as cache:
+            record = json.load(cache)
+        if tuple(record['signature']) == signature:
+            return record['identifier']
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    return None
 
-def _get_ips_from_etc_hosts():
+
+def _write_identifier_cache(signature, identifier):
     try:
-        with open(ETC_HOSTS_PATH, encoding='utf-8') as etc_hosts:
-            etc_hosts_lines = etc_hosts.readlines()
-    except FileNotFoundError:
-        logger.error("Could not open '%s' file", ETC_HOSTS_PATH)
-        return
+        files.write_atomic(
+            IDENTIFIER_CACHE_FILE_PATH,
+            json.dumps({'signature': signature, 'identifier': identifier})
+        )
+    except OSError as err:
+        logger.warning('Could not cache the identifier: %s', err)
 
-    # use present RMT server IP first if registered
-    rmt_ips_addr = []
-    for etc_hosts_line in etc_hosts_lines:
-        if 'susecloud.net' in etc_hosts_line and not etc_hosts_line.startswith('#'):
+
+def _load_identifier(path):
+    """Return the identifier of the baseproduct, cached on disk."""
+    signature = _get_file_signature(path)
+    identifier = _read_identifier_cache(signature)
+    if not identifier:
+        identifier = _parse_identifier()
+        if identifier:
+            _write_identifier_cache(signature, identifier)
+    return identifier
+
+
+def get_identifier():
+    """
+    Return the identifier found in /etc/products.d/baseproduct.
+
+    The identifier is remembered in process and on disk for as long
+    as the baseproduct file does not change.
+    """
+    if _get_file_signature(BASEPRODUCT_PATH) is None:
+        logger.error("Could not open '%s' file", BASEPRODUCT_PATH)
+        return None
+    return _get_parsed_file(BASEPRODUCT_PATH, _load_identifier)
+
+
+def _is_update_server_name(hostname):
+    return hostname == 'susecloud.net' or hostname.endswith('.susecloud.net')
+
+
+def _parse_etc_hosts(path):
+    """
+    Return the IPs of the susecloud.net names in the /etc/hosts file,
+    IPv6 first, each IP once in the order found.
+
+    The file is scanned line by line once.
+    """
+    ipv6_addrs = {}
+    ipv4_addrs = {}
+    with open(path, encoding='utf-8', errors='replace') as etc_hosts:
+        for etc_hosts_line in etc_hosts:
+            # most lines are of no interest, skip them before tokenizing
+            if 'susecloud.net' not in etc_hosts_line:
+                continue
+            fields = etc_hosts_line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+            if not any(_is_update_server_name(name) for name in fields[1:]):
+                continue
             # save all the IPs for susecloud.net
             # as with IPv6 enabled there will be more than one line
-            etc_hosts_ip_addr = etc_hosts_line.split()[0]
             try:
-                ipaddress.ip_address(etc_hosts_ip_addr)
-                if etc_hosts_ip_addr not in rmt_ips_addr:
-                    rmt_ips_addr.append(etc_hosts_ip_addr)
+                ip_addr = ipaddress.ip_address(fields[0])
             except ValueError:
-                pass
+                continue
+            if isinstance(ip_addr, ipaddress.IPv6Address):
+                ipv6_addrs.setdefault(fields[0])
+            else:
+                ipv4_addrs.setdefault(fields[0])
+    return tuple(ipv6_addrs) + tuple(ipv4_addrs)
 
-    return rmt_ips_addr
+
+def _get_ips_from_etc_hosts():
+    """
+    Return the update server IPs registered in /etc/hosts.
+
+    The IPs are remembered in process for as long as the file does
+    not change.
+    """
+    rmt_ips_addr = _get_parsed_file(ETC_HOSTS_PATH, _parse_etc_hosts)
+    if rmt_ips_addr is None:
+        logger.error("Could not open '%s' file", ETC_HOSTS_PATH)
+        return
+    return list(rmt_ips_addr)
 
 
-def _get_ips_from_cloudregister(): # pragma: no cover
+def _get_ips_from_cloudregister(network_access=None): # pragma: no cover
     # get a new RMT IP
     server = get_smt(False)
+    network_access = network_access or _get_network_access()
     rmt_ips_addr = []
-    if has_ipv6_access() and server.get_ipv6():
+    if network_access.ipv6 and server.get_ipv6():
         rmt_ips_addr.append('[{}]'.format(server.get_ipv6()))
-    if has_ipv4_access():
+    if network_access.ipv4:
         rmt_ips_addr.append(server.get_ipv4())
 
     return rmt_ips_addr
 
 
-def get_rmt_ip_addr():
-    """Return the RMT update server IP the instance is registered to."""
+def get_rmt_ip_addr(network_access=None):
+    """
+    Return the RMT update server IP the instance is registered to.
+
+    The network access probed by the check is passed on to avoid
+    probing it again.
+    """
     rmt_ips_addr = _get_ips_from_etc_hosts()
 
+    if not rmt_ips_addr:
+        _import_cloudregister()
     if not rmt_ips_addr and 'cloudregister' in sys.modules:
-        rmt_ips_addr = _get_ips_from_cloudregister()
+        rmt_ips_addr = _get_ips_from_cloudregister(network_access)
 
     if rmt_ips_addr:
         return rmt_ips_addr
@@ -149,14 +803,131 @@ def get_rmt_ip_addr():
     logger.info('Could not determine update server IP address')
 
 
+def _get_boot_id():
+    """Return the ID of the current boot, None if not available."""
+    try:
+        with open(BOOT_ID_PATH, 'r') as boot_id:
+            return boot_id.read().strip()
+    except OSError:
+        return None
+
+
+def _get_digest(metadata, identifier):
+    """Return the digest identifying the instance metadata and identifier."""
+    return hashlib.sha256(
+        '{}\n{}'.format(metadata, identifier).encode()
+    ).hexdigest()
+
+
+def _get_instance_digest():
+    """
+    Return the digest of the cached instance metadata and the
+    identifier, None if the metadata is not cached.
+
+    Used to tell whether a cache record was written for the instance
+    as it is now without running the data provider.
+    """
+    command_line = get_instance_data_command()
+    if not command_line:
+        return None
+    metadata = _get_cached_metadata(command_line)
+    identifier = get_identifier()
+    if not metadata or not identifier:
+        return None
+    return _get_digest(metadata, identifier)
+
+
+def _read_cache():
+    """
+    Return the cache record, None if there is no cache.
+
+    A cache written by an older version holds only the flavour, it is
+    returned as a record of version 0.
+    """
+    try:
+        with open(CACHE_FILE_PATH, 'r') as cache:
+            content = cache.read()
+    except OSError:
+        return None
+    try:
+        record = json.loads(content)
+    except ValueError:
+        record = None
+    if not isinstance(record, dict):
+        record = {'version': 0, 'flavor': content.strip()}
+    return record
+
+
+def _get_fresh_cache_value(max_age=None):
+    """
+    Return the FlavorResult from the cache if the record is fresh.
+
+    A record is fresh when it holds a verified flavour, was written
+    during the current boot for the current instance metadata and
+    identifier and is not older than max_age seconds, the cacheTTL by
+    default. Otherwise return None.
+    """
+    record = _read_cache()
+    if not record or record.get('version') != CACHE_VERSION:
+        return None
+    if record.get('code') not in (10, 11):
+        return None
+    boot_id = _get_boot_id()
+    if not boot_id or record.get('boot_id') != boot_id:
+        return None
+    try:
+        age = time.time() - float(record.get('timestamp'))
+    except (TypeError, ValueError):
+        return None
+    if max_age is None:
+        max_age = _get_config_float('cacheTTL', CACHE_TTL)
+    if not 0 <= age <= max_age:
+        return None
+    digest = record.get('digest')
+    if not digest or digest != _get_instance_digest():
+        return None
+    return FlavorResult(
+        record.get('flavor'), record.get('code'), 'cache',
+        server=record.get('server'), timestamp=record.get('timestamp')
+    )
+
+
+def _get_recent_cache_value(since):
+    """
+    Return the FlavorResult from the cache if the record was written
+    during the current boot at or after since, a time.time() value.
+    Otherwise return None.
+    """
+    record = _read_cache()
+    if not record or record.get('version') != CACHE_VERSION:
+        return None
+    try:
+        if float(record.get('timestamp')) < since:
+            return None
+    except (TypeError, ValueError):
+        return None
+    boot_id = _get_boot_id()
+    if not boot_id or record.get('boot_id') != boot_id:
+        return None
+    return FlavorResult(
+        record.get('flavor'), record.get('code'), 'cache',
+        server=record.get('server'), timestamp=record.get('timestamp')
+    )
+
+
+def _get_cache_record():
+    """Return the cache record, an unreliable BYOS one if there is none."""
+    record = _read_cache()
+    if not record:
+        record = _write_cache('BYOS')
+    return record
+
+
 def _get_cache_value():
     """
     Get the flavour status from the cache
     """
-    flavour = 'BYOS'
-    if not os.path.exists(CACHE_FILE_PATH):
-        _write_cache(flavour)
-    return open(CACHE_FILE_PATH, 'r').read()
+    return _get_cache_record().get('flavor')
 
 
 def _get_proxies():
@@ -174,82 +945,304 @@ def _get_proxies():
         # HTTP_PROXY and HTTPS_PROXY
         return {}
 
-    proxies = {}
-    proxy_config = []
-    try:
-        with open(PROXY_CONFIG_PATH, 'r') as proxy_file:
-            proxy_config = proxy_file.readlines()
-    except FileNotFoundError:
-        pass
+    settings = _get_parsed_file(PROXY_CONFIG_PATH, _parse_proxy_config)
+    proxies = dict(settings or ())
+    if not proxies.pop('enabled', True):
+        return None
+    return proxies
 
-    for entry in proxy_config:
-        if 'PROXY_ENABLED' in entry and 'no' in entry:
-            return None
-        if 'HTTP_PROXY' in entry:
-            proxies['http_proxy'] = entry.split('"')[1]
-        if 'HTTPS_PROXY' in entry:
-            proxies['https_proxy'] = entry.split('"')[1]
-        if 'NO_PROXY' in entry:
-            proxies['no_proxy'] = entry.split('"')[1]
 
-    return proxies
+def _parse_proxy_config(path):
+    """
+    Return the proxy settings of the sysconfig proxy file as
+    (key, value) tuples, disabled proxies as ('enabled', False).
+    """
+    settings = []
+    with open(path, 'r') as proxy_file:
+        for entry in proxy_file:
+            name, separator, value = entry.strip().partition('=')
+            if not separator or name.startswith('#'):
+                continue
+            value = value.strip().strip('"\'')
+            if name == 'PROXY_ENABLED' and value == 'no':
+                return (('enabled', False),)
+            if name in ('HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY') and value:
+                settings.append((name.lower(), value))
+    return tuple(settings)
 
 
-def _write_cache(flavour):
-    """Cache the instance flavour"""
-    cache = open(CACHE_FILE_PATH, 'w')
-    cache.write(flavour)
-    cache.close()
+def _write_cache(flavour, code=12, server=None, digest=None):
+    """
+    Cache the instance flavour
+
+    The record holds the flavour and exit code, the time of the check,
+    the update server that answered, the digest of the instance metadata
+    and identifier and the ID of the boot the check was made in.
+    """
+    record = {
+        'version': CACHE_VERSION,
+        'flavor': flavour,
+        'code': code,
+        'timestamp': time.time(),
+        'server': server,
+        'digest': digest,
+        'boot_id': _get_boot_id()
+    }
+    with metrics.span('write_cache'):
+        files.write_atomic(CACHE_FILE_PATH, json.dumps(record))
+    return record
 
 
-def make_request(rmt_ip_addr, metadata, identifier):
-    """Return the flavour from the RMT server request."""
+def _is_ipv6(rmt_ip_addr):
     try:
-        ip_addr = ipaddress.ip_address(rmt_ip_addr)
+        ip_addr = ipaddress.ip_address(rmt_ip_addr.strip('[]'))
     except ValueError:
-        logging.error(
-            'The RMT IP address {} is not valid.'.format(rmt_ip_addr)
-        )
-        return
+        return False
+    return isinstance(ip_addr, ipaddress.IPv6Address)
 
-    if isinstance(ip_addr, ipaddress.IPv6Address):
+
+def _get_backoff(attempt, deadline=None):
+    """
+    Return the seconds to wait before the next attempt.
+
+    The wait grows exponentially with the attempt number, half of it
+    is randomized, and never goes past the deadline.
+    """
+    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    backoff = backoff / 2 + random.uniform(0, backoff / 2)
+    time_left = _get_time_left(deadline)
+    if time_left is not None:
+        backoff = min(backoff, time_left)
+    return backoff
+
+
+def _get_retry_after(response, attempt, deadline=None):
+    """
+    Return the seconds to wait before asking the busy server again,
+    None if it is not asked again in this check.
+
+    The Retry-After header is honored, in seconds or as HTTP date, with
+    up to BACKOFF_BASE seconds added at random so that the instances
+    told to wait do not ask again at the same time. Without the header
+    the backoff of the attempt is used. A server asking to wait longer
+    than RETRY_AFTER_MAX or past the deadline is given up.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return _get_backoff(attempt, deadline)
+    try:
+        wait = float(retry_after)
+    except ValueError:
+        try:
+            wait = (
+                email.utils.parsedate_to_datetime(retry_after).timestamp() -
+                time.time()
+            )
+        except (TypeError, ValueError, IndexError):
+            return _get_backoff(attempt, deadline)
+    wait = max(wait, 0) + random.uniform(0, BACKOFF_BASE)
+    time_left = _get_time_left(deadline)
+    if wait > RETRY_AFTER_MAX or (time_left is not None and wait > time_left):
+        return None
+    return wait
+
+
+def _wait(seconds, cancel_event=None):
+    """Sleep for the given seconds, return early if the event gets set."""
+    if cancel_event is None:
+        time.sleep(seconds)
+    else:
+        cancel_event.wait(seconds)
+
+
+def _get_instance_check_url(rmt_ip_addr):
+    """Return the instance check URL of the server, None if the IP is invalid."""
+    try:
+        ip_addr = ipaddress.ip_address(rmt_ip_addr)
+    except ValueError:
+        logger.error('The RMT IP address %s is not valid.', rmt_ip_addr)
+        return None
+
+    if isinstance(ip_addr, ipaddress.IPv6Address):
         rmt_ip_addr = '[{}]'.format(rmt_ip_addr)
-    instance_check_url = 'https://{}/api/instance/check'.format(rmt_ip_addr)
-    billing_check_params = {
+    if RMT_HTTPS_PORT != 443:
+        rmt_ip_addr = '{}:{}'.format(rmt_ip_addr, RMT_HTTPS_PORT)
+    return 'https://{}/api/instance/check'.format(rmt_ip_addr)
+
+
+def _get_query(metadata, identifier):
+    """Return the encoded query string of the instance check."""
+    return urllib.parse.urlencode({
         'metadata': metadata,
         'identifier': identifier
-    }
-    proxies = _get_proxies()
+    })
+
+
+def _is_post_unsupported(rmt_ip_addr):
+    """
+    Return True if the server answered the compressed POST check as
+    unsupported less than POST_RETRY_INTERVAL seconds ago.
+    """
+    since = _post_unsupported.get(rmt_ip_addr)
+    if since is None:
+        return False
+    if time.monotonic() - since < POST_RETRY_INTERVAL:
+        return True
+    _post_unsupported.pop(rmt_ip_addr, None)
+    return False
+
+
+def _get_compressed_body(rmt_ip_addr, query):
+    """
+    Return the gzip compressed query as POST body for the server, None
+    if the server is known not to support it.
+    """
+    if _is_post_unsupported(rmt_ip_addr):
+        return None
+    body = gzip.compress(query.encode())
+    logger.debug(
+        'Compressed POST body of %d bytes for a query of %d bytes, '
+        '%d bytes saved', len(body), len(query), len(query) - len(body)
+    )
+    return body
+
+
+def _get_request_timeout(deadline):
+    """Return the timeout of a request, bounded by the deadline."""
+    time_left = _get_time_left(deadline)
+    if time_left is None:
+        return REQUEST_TIMEOUT
+    return min(REQUEST_TIMEOUT, time_left)
+
+
+def _send_check(
+    session, rmt_ip_addr, instance_check_url, query, body, timeout, proxies,
+    deadline=None
+):
+    """
+    Send the instance check, as compressed POST if a body is given.
+
+    A server answering the POST as unsupported is remembered and
+    sent the GET right away, with the timeout bounded by the time
+    left until the deadline.
+    """
+    if body is not None:
+        response = session.post(
+            instance_check_url,
+            data=body,
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Encoding': 'gzip'
+            },
+            timeout=timeout,
+            verify=False,
+            proxies=proxies
+        )
+        if response.status_code not in POST_UNSUPPORTED_STATUS:
+            return response
+        logger.info(
+            'Update server %s does not support the compressed check, '
+            'using GET', rmt_ip_addr
+        )
+        _post_unsupported[rmt_ip_addr] = time.monotonic()
+        if deadline is not None:
+            if _is_expired(deadline):
+                raise _import_requests().exceptions.Timeout(
+                    'The check ran out of time before the GET'
+                )
+            timeout = _get_request_timeout(deadline)
+    return session.get(
+        instance_check_url,
+        timeout=timeout,
+        verify=False,
+        params=query,
+        proxies=proxies
+    )
+
+
+def make_request(
+    rmt_ip_addr, metadata, identifier, cancel_event=None, deadline=None,
+    proxies=_NOT_SET, query=None, mode='get', session=None
+):
+    """
+    Return the flavour from the RMT server request.
+
+    If a cancel_event is given, no further attempt is made once
+    the event is set. No attempt runs past the deadline, a
+    time.monotonic() value.
+
+    The proxies and the encoded query string are looked up and built
+    once per check by the caller and passed in, otherwise they are
+    computed here.
+
+    With the 'post' mode the metadata and identifier are sent as gzip
+    compressed POST body, falling back to the GET for servers not
+    supporting it.
+
+    The request is sent through the given HTTP session, the shared
+    one of _get_session by default.
+    """
+    instance_check_url = _get_instance_check_url(rmt_ip_addr)
+    if not instance_check_url:
+        return
+
+    if query is None:
+        query = _get_query(metadata, identifier)
+    if proxies is _NOT_SET:
+        proxies = _get_proxies()
+    requests = _import_requests()
+    if session is None:
+        session = _get_session()
+    body = None
+    if mode == 'post':
+        body = _get_compressed_body(rmt_ip_addr, query)
     retry_count = 1
     result = {}
-    while retry_count != 4:
+    while retry_count <= REQUEST_ATTEMPTS:
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        if _is_expired(deadline):
+            logger.warning(
+                'Request to %s stopped, the check ran out of time',
+                rmt_ip_addr
+            )
+            return
+        timeout = _get_request_timeout(deadline)
         message = None
         response = None
-        try:
-            response = requests.get(
-                instance_check_url,
-                timeout=2,
-                verify=False,
-                params=billing_check_params,
-                proxies=proxies
-            )
-        except requests.exceptions.HTTPError as err:
-            message = 'Http Error:{}'.format(err)
-        except requests.exceptions.ConnectionError as err:
-            message = 'Error Connecting:{}'.format(err)
-        except requests.exceptions.Timeout as err:
-            message = 'Timeout Error:{}'.format(err)
-        except requests.exceptions.RequestException as err:
-            message = 'Request error:{}'.format(err)
-        except Exception as err:
-            message = 'Unexpected error: {}'.format(err)
+        with metrics.span(
+            'request', server=rmt_ip_addr, attempt=retry_count
+        ) as span:
+            try:
+                response = _send_check(
+                    session, rmt_ip_addr, instance_check_url, query, body,
+                    timeout, proxies, deadline=deadline
+                )
+                span['outcome'] = response.status_code
+                if _is_post_unsupported(rmt_ip_addr):
+                    body = None
+            except requests.exceptions.HTTPError as err:
+                message = 'Http Error:{}'.format(err)
+                span['outcome'] = 'http_error'
+            except requests.exceptions.ConnectionError as err:
+                message = 'Error Connecting:{}'.format(err)
+                span['outcome'] = 'connection_error'
+            except requests.exceptions.Timeout as err:
+                message = 'Timeout Error:{}'.format(err)
+                span['outcome'] = 'timeout'
+            except requests.exceptions.RequestException as err:
+                message = 'Request error:{}'.format(err)
+                span['outcome'] = 'request_error'
+            except Exception as err:
+                message = 'Unexpected error: {}'.format(err)
+                span['outcome'] = 'error'
 
         if message:
             if 'Timeout' in message or 'Connecting' in message:
-                logger.warning(
-                    'Attempt {}: failed: {}'.format(retry_count, message)
-                )
-                time.sleep(2)
+                logger.warning('Attempt %d: failed: %s', retry_count, message)
+                if retry_count < REQUEST_ATTEMPTS:
+                    metrics.count('retries')
+                    _wait(_get_backoff(retry_count, deadline), cancel_event)
                 retry_count += 1
                 continue
             else:
@@ -258,11 +1251,26 @@ def make_request(rmt_ip_addr, metadata, identifier):
                     'Request to check if instance is PAYG/BYOS failed: %s',
                     message
                 )
-        elif response:
+        elif response is not None:
             if response.status_code == 200:
                 result = response.json()
-                logger.debug(result)
+                logger.debug(
+                    'Update server %s answered: %s', rmt_ip_addr, result
+                )
             else:
+                wait = None
+                if response.status_code in RETRY_AFTER_STATUS and \
+                        retry_count < REQUEST_ATTEMPTS:
+                    wait = _get_retry_after(response, retry_count, deadline)
+                if wait is not None:
+                    logger.warning(
+                        'Attempt %d: update server %s is busy, asking again '
+                        'in %.1fs', retry_count, rmt_ip_addr, wait
+                    )
+                    metrics.count('retries')
+                    _wait(wait, cancel_event)
+                    retry_count += 1
+                    continue
                 logger.warning(
                     'Request to check if instance is PAYG/BYOS failed: %s',
                     response.reason
@@ -271,7 +1279,578 @@ def make_request(rmt_ip_addr, metadata, identifier):
         return result.get('flavor')
 
 
-def check_payg_byos():
+def query_rmt_servers(
+    rmt_ips_addr, metadata, identifier, deadline=None, outcomes=None
+):
+    """
+    Query all the given RMT server IPs concurrently.
+
+    The IPv6 addresses are queried first, the IPv4 addresses join after
+    IPV4_STAGGER_DELAY seconds or as soon as all IPv6 queries failed.
+    The first server answering with a flavour wins and the queries still
+    in flight are cancelled.
+
+    Return a (flavour, rmt_ip_addr) tuple, (None, None) if no server
+    answered before the deadline. The answer time of every server
+    asked, None if it failed, is recorded into the outcomes dict.
+    """
+    ipv6_addrs = [ip_addr for ip_addr in rmt_ips_addr if _is_ipv6(ip_addr)]
+    ipv4_addrs = [
+        ip_addr for ip_addr in rmt_ips_addr if not _is_ipv6(ip_addr)
+    ]
+    answered = threading.Event()
+    ipv6_failed = threading.Event()
+    if not ipv6_addrs:
+        ipv6_failed.set()
+    ipv6_pending = [len(ipv6_addrs)]
+    lock = threading.Lock()
+    results = queue.Queue()
+    proxies = _get_proxies()
+    query_string = _get_query(metadata, identifier)
+    mode = _get_request_mode()
+
+    def query(rmt_ip_addr, ipv6):
+        flavour = None
+        try:
+            if not ipv6:
+                ipv6_failed.wait(IPV4_STAGGER_DELAY)
+            if not answered.is_set():
+                started = time.monotonic()
+                flavour = _get_valid_flavour(make_request(
+                    rmt_ip_addr, metadata, identifier,
+                    cancel_event=answered, deadline=deadline,
+                    proxies=proxies, query=query_string, mode=mode
+                ), rmt_ip_addr)
+                with lock:
+                    _record_outcome(
+                        outcomes, rmt_ip_addr, flavour, started,
+                        answered.is_set() or _is_expired(deadline)
+                    )
+        except Exception as err:
+            logger.warning(
+                'Query to %s failed unexpectedly: %s', rmt_ip_addr, err
+            )
+        finally:
+            if ipv6 and not flavour:
+                with lock:
+                    ipv6_pending[0] -= 1
+                    if not ipv6_pending[0]:
+                        ipv6_failed.set()
+            results.put((flavour, rmt_ip_addr))
+
+    # daemon threads, an abandoned request in flight must not
+    # hold back the exit of the process
+    for rmt_ip_addr in ipv6_addrs + ipv4_addrs:
+        threading.Thread(
+            target=metrics.bind(query),
+            args=(rmt_ip_addr, rmt_ip_addr in ipv6_addrs),
+            daemon=True
+        ).start()
+
+    try:
+        for _ in range(len(ipv6_addrs) + len(ipv4_addrs)):
+            flavour, rmt_ip_addr = results.get(
+                timeout=_get_time_left(deadline)
+            )
+            if flavour in FLAVOUR_CODES:
+                return (flavour, rmt_ip_addr)
+    except queue.Empty:
+        logger.warning('No update server answered in time')
+    finally:
+        answered.set()
+
+    return (None, None)
+
+
+async def _query_rmt_servers_async(
+    rmt_ips_addr, metadata, identifier, deadline=None, outcomes=None
+):
+    """
+    Asynchronous variant of query_rmt_servers.
+
+    Every server is queried in its own task, the tasks still running
+    are cancelled once a server answered or the deadline passed.
+    """
+    import asyncio
+    loop = asyncio.get_event_loop()
+    ipv6_addrs = [ip_addr for ip_addr in rmt_ips_addr if _is_ipv6(ip_addr)]
+    ipv4_addrs = [
+        ip_addr for ip_addr in rmt_ips_addr if not _is_ipv6(ip_addr)
+    ]
+    # stops the request attempts running in the executor threads
+    answered = threading.Event()
+    ipv6_failed = asyncio.Event()
+    if not ipv6_addrs:
+        ipv6_failed.set()
+    ipv6_pending = [len(ipv6_addrs)]
+    proxies = _get_proxies()
+    query_string = _get_query(metadata, identifier)
+    mode = _get_request_mode()
+
+    async def query(rmt_ip_addr, ipv6):
+        flavour = None
+        try:
+            if not ipv6:
+                try:
+                    await asyncio.wait_for(
+                        ipv6_failed.wait(), IPV4_STAGGER_DELAY
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            started = time.monotonic()
+            flavour = await loop.run_in_executor(None, functools.partial(
+                metrics.bind(make_request), rmt_ip_addr, metadata, identifier,
+                cancel_event=answered, deadline=deadline,
+                proxies=proxies, query=query_string, mode=mode
+            ))
+            flavour = _get_valid_flavour(flavour, rmt_ip_addr)
+            _record_outcome(
+                outcomes, rmt_ip_addr, flavour, started,
+                answered.is_set() or _is_expired(deadline)
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(
+                'Query to %s failed unexpectedly: %s', rmt_ip_addr, err
+            )
+        finally:
+            if ipv6 and not flavour:
+                ipv6_pending[0] -= 1
+                if not ipv6_pending[0]:
+                    ipv6_failed.set()
+        return (flavour, rmt_ip_addr)
+
+    tasks = [
+        asyncio.ensure_future(query(rmt_ip_addr, rmt_ip_addr in ipv6_addrs))
+        for rmt_ip_addr in ipv6_addrs + ipv4_addrs
+    ]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=_get_time_left(deadline),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                logger.warning('No update server answered in time')
+                break
+            for task in done:
+                flavour, rmt_ip_addr = task.result()
+                if flavour in FLAVOUR_CODES:
+                    return (flavour, rmt_ip_addr)
+    finally:
+        answered.set()
+        for task in tasks:
+            task.cancel()
+
+    return (None, None)
+
+
+def _read_health():
+    """
+    Return the health table of the update servers, a dict of the
+    server IPs to their answer time moving average in seconds, the
+    number of checks in a row they failed in and the time of their
+    last success and failure.
+    """
+    try:
+        with open(HEALTH_FILE_PATH, 'r') as health_file:
+            health = json.load(health_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(health, dict):
+        return {}
+    return {
+        rmt_ip_addr: entry for rmt_ip_addr, entry in health.items()
+        if isinstance(entry, dict)
+    }
+
+
+def _write_health(health):
+    try:
+        files.write_atomic(HEALTH_FILE_PATH, json.dumps(health))
+    except OSError as err:
+        logger.warning('Could not save the update server health: %s', err)
+
+
+def _is_circuit_open(entry, now):
+    """Return True if the server failed too often to be asked now."""
+    return (
+        entry.get('failures', 0) >= CIRCUIT_FAILURES and
+        now - entry.get('last_failure', 0) < CIRCUIT_COOL_OFF
+    )
+
+
+def _order_by_health(rmt_ips_addr, health):
+    """
+    Return the update server IPs, the healthiest first.
+
+    Servers answering are ordered by their answer time, followed by
+    servers without history and servers that failed. Servers failing
+    CIRCUIT_FAILURES checks in a row are left out until CIRCUIT_COOL_OFF
+    seconds passed, unless all of them are.
+    """
+    now = time.time()
+
+    def rank(rmt_ip_addr):
+        entry = health.get(rmt_ip_addr, {})
+        latency = entry.get('latency')
+        return (
+            entry.get('failures', 0),
+            float('inf') if latency is None else latency
+        )
+
+    ordered = sorted(rmt_ips_addr, key=rank)
+    available = [
+        rmt_ip_addr for rmt_ip_addr in ordered
+        if not _is_circuit_open(health.get(rmt_ip_addr, {}), now)
+    ]
+    for rmt_ip_addr in ordered:
+        if rmt_ip_addr not in available and available:
+            logger.info(
+                'Skipping update server %s, it failed %d checks in a row',
+                rmt_ip_addr, health[rmt_ip_addr]['failures']
+            )
+    return available or ordered
+
+
+def _get_valid_flavour(flavour, rmt_ip_addr):
+    """
+    Return the flavour answered by the server, None if it is neither
+    PAYG nor BYOS and the server is counted as failed.
+    """
+    if flavour is not None and flavour not in FLAVOUR_CODES:
+        logger.warning(
+            'Update server %s answered an unknown flavor: %s',
+            rmt_ip_addr, flavour
+        )
+        return None
+    return flavour
+
+
+def _record_outcome(outcomes, rmt_ip_addr, flavour, started, cancelled):
+    """
+    Record the answer time of the server into outcomes, None if it
+    failed. Requests cancelled or out of time are not recorded.
+    """
+    if outcomes is None:
+        return
+    if flavour:
+        outcomes[rmt_ip_addr] = time.monotonic() - started
+    elif not cancelled:
+        outcomes[rmt_ip_addr] = None
+
+
+def _update_health(health, outcomes):
+    """Add the outcomes of a check to the health table and return it."""
+    now = time.time()
+    for rmt_ip_addr, latency in outcomes.items():
+        entry = health.setdefault(rmt_ip_addr, {'failures': 0})
+        if latency is None:
+            entry['failures'] = entry.get('failures', 0) + 1
+            entry['last_failure'] = now
+            continue
+        average = entry.get('latency')
+        if average is not None:
+            latency = (
+                HEALTH_LATENCY_WEIGHT * latency +
+                (1 - HEALTH_LATENCY_WEIGHT) * average
+            )
+        entry['latency'] = round(latency, 6)
+        entry['failures'] = 0
+        entry['last_success'] = now
+    for rmt_ip_addr, entry in list(health.items()):
+        last_seen = max(
+            entry.get('last_success', 0), entry.get('last_failure', 0)
+        )
+        if now - last_seen > HEALTH_MAX_AGE:
+            del health[rmt_ip_addr]
+    return health
+
+
+def _get_network_signature():
+    """
+    Return a digest of the network interfaces and routes, it changes
+    whenever an address or route is added or removed.
+    """
+    digest = hashlib.sha256()
+    for path, counters in NETWORK_STATE_FILES:
+        try:
+            with open(path, 'r') as state:
+                for line in state:
+                    fields = line.split()
+                    digest.update(' '.join(
+                        field for index, field in enumerate(fields)
+                        if index not in counters
+                    ).encode())
+                    digest.update(b'\n')
+        except OSError:
+            digest.update(b'-')
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _read_connectivity_cache(signature, ttl):
+    """
+    Return the NetworkAccess probed for the network signature during
+    the current boot, None if there is none or it is older than ttl.
+    """
+    cached = _network_access_cache.get(signature)
+    if cached is None:
+        try:
+            with open(CONNECTIVITY_CACHE_FILE_PATH, 'r') as cache:
+                record = json.load(cache)
+            if (
+                record['signature'] == signature and
+                record['boot_id'] == _get_boot_id()
+            ):
+                cached = (
+                    float(record['timestamp']),
+                    NetworkAccess(bool(record['ipv4']), bool(record['ipv6']))
+                )
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+    if cached is None or not 0 <= time.time() - cached[0] <= ttl:
+        return None
+    return cached[1]
+
+
+def _write_connectivity_cache(signature, network_access):
+    now = time.time()
+    _network_access_cache.clear()
+    _network_access_cache[signature] = (now, network_access)
+    try:
+        files.write_atomic(CONNECTIVITY_CACHE_FILE_PATH, json.dumps({
+            'signature': signature,
+            'boot_id': _get_boot_id(),
+            'timestamp': now,
+            'ipv4': network_access.ipv4,
+            'ipv6': network_access.ipv6
+        }))
+    except OSError as err:
+        logger.warning('Could not cache the network access: %s', err)
+
+
+def _probe_network_access():
+    """Probe the IPv4 and IPv6 access at the same time."""
+    _import_cloudregister()
+    ipv6 = []
+    probe = threading.Thread(
+        target=lambda: ipv6.append(bool(has_ipv6_access())), daemon=True
+    )
+    probe.start()
+    ipv4 = bool(has_ipv4_access())
+    probe.join()
+    return NetworkAccess(ipv4=ipv4, ipv6=bool(ipv6 and ipv6[0]))
+
+
+def _get_network_access():
+    """
+    Return the NetworkAccess of the instance.
+
+    The probed access is reused in process and across checks for the
+    connectivityCacheTTL, as long as the network interfaces and routes
+    do not change.
+    """
+    ttl = _get_config_float('connectivityCacheTTL', CONNECTIVITY_CACHE_TTL)
+    signature = None
+    if ttl > 0:
+        signature = _get_network_signature()
+        network_access = _read_connectivity_cache(signature, ttl)
+        if network_access:
+            return network_access
+    network_access = _probe_network_access()
+    if signature:
+        _write_connectivity_cache(signature, network_access)
+    return network_access
+
+
+def _has_network_access():
+    """Return True if the instance has IPv4 or IPv6 access."""
+    return any(_get_network_access())
+
+
+def _filter_by_network_access(rmt_ips_addr, network_access):
+    """
+    Return the update server IPs of the IP families the instance has
+    access through, all of them if there are none.
+    """
+    reachable = [
+        rmt_ip_addr for rmt_ip_addr in rmt_ips_addr
+        if (network_access.ipv6 if _is_ipv6(rmt_ip_addr)
+            else network_access.ipv4)
+    ]
+    return reachable or rmt_ips_addr
+
+
+def _get_deadline(timeout=None):
+    """
+    Return the time.monotonic() deadline of a check bound by the
+    timeout, the configured one if None. No deadline without timeout.
+    """
+    if timeout is None:
+        timeout = _get_config_float('timeout', CHECK_TIMEOUT)
+    if timeout:
+        return time.monotonic() + timeout
+    return None
+
+
+def _use_server_answer(flavour, rmt_ip_addr, metadata, identifier):
+    """
+    Return the FlavorResult answered by the update server and cache
+    it. Use the cache if no server answered.
+    """
+    if flavour not in FLAVOUR_CODES:
+        return _use_cache_value()
+    logger.info('Successful server query: %s', flavour)
+    code = FLAVOUR_CODES.get(flavour)
+    _write_cache(
+        flavour,
+        code=code,
+        server=rmt_ip_addr,
+        digest=_get_digest(metadata, identifier)
+    )
+    return FlavorResult(
+        flavour, code, 'server', server=rmt_ip_addr, timestamp=time.time()
+    )
+
+
+def _use_cache_value():
+    """
+    Return the FlavorResult from the cache as last resort, with the
+    code the flavour was cached with. Records of version 0 only hold
+    the flavour, it is returned with its code as before. An unreliable
+    flavour is BYOS with code 12.
+    """
+    record = _get_cache_record()
+    flavour = record.get('flavor')
+    code = 12
+    if record.get('version') == 0:
+        code = FLAVOUR_CODES.get(flavour, 12)
+    elif record.get('version') == CACHE_VERSION and \
+            record.get('code') in (10, 11):
+        code = record['code']
+    if code == 12:
+        flavour = 'BYOS'
+    logger.info('Using cache value: %s', flavour)
+    return FlavorResult(flavour, code, 'fallback')
+
+
+class FlavorChecker:
+    """
+    **Checks the instance flavor again and again**
+    For long running processes asking for the flavor more than once.
+    The last result is kept in memory, a verified answer until it is
+    older than the cacheTTL, like its cache record, and a fallback or
+    unreliable one for recheck_interval seconds, and returned
+    with source cache without touching the disk or the network. An
+    answer older than the cacheRefreshAge is refreshed in the
+    background like a cache record, see check_payg_byos. The HTTP
+    session, the parsed configuration and the probed network access
+    are shared by all checks of the process.
+    Example:
+    .. code:: python
+        checker = FlavorChecker()
+        result = checker.check()
+        if result.verified and result.flavor == 'PAYG':
+            ...
+    :param bool concurrent: query the update servers at the same time
+    :param float recheck_interval: seconds to keep unreliable results
+    """
+    def __init__(self, concurrent=True, recheck_interval=RECHECK_INTERVAL):
+        self.concurrent = concurrent
+        self.recheck_interval = recheck_interval
+        self._result = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def check(self, timeout=None, timings=None, refresh=False):
+        """
+        Return the FlavorResult of the instance, see check_payg_byos.
+        Unless refresh is set, a result kept in memory is returned
+        right away. Checks of several threads run one after another.
+        :param float timeout: seconds the check may take
+        :param metrics.Timings timings: recorder of the check phases
+        :param bool refresh: ask the update server, ignoring the result
+            kept in memory and a fresh cache record
+        :rtype: FlavorResult
+        """
+        start = time.monotonic()
+        with self._lock:
+            if not refresh and self._result and \
+                    time.monotonic() < self._expires:
+                if _is_aging(self._result):
+                    self._refresh_ahead()
+                result = self._result
+                return FlavorResult(
+                    result.flavor, result.code, 'cache',
+                    server=result.server, timestamp=result.timestamp,
+                    elapsed=time.monotonic() - start
+                )
+            result = self._check(timeout, timings, refresh)
+            result.elapsed = time.monotonic() - start
+            self._result = result
+            self._expires = time.monotonic() + self._get_keep_time(result)
+            return result
+
+    def _get_keep_time(self, result):
+        """
+        Return the seconds the result is kept in memory. A verified
+        answer of the update server expires with its cache record, the
+        cacheTTL after it was given, a fallback or unreliable result
+        after recheck_interval seconds.
+        """
+        if not result.verified or result.source == 'fallback':
+            return self.recheck_interval
+        age = 0
+        if result.timestamp is not None:
+            age = max(time.time() - result.timestamp, 0)
+        return max(_get_config_float('cacheTTL', CACHE_TTL) - age, 0)
+
+    def _refresh_ahead(self):
+        """
+        Replace the aging result kept in memory with the cache record
+        once a background refresh renewed it, start the refresh
+        otherwise.
+        """
+        cached = _get_fresh_cache_value()
+        if cached and not _is_aging(cached):
+            self._result = cached
+            self._expires = time.monotonic() + self._get_keep_time(cached)
+        else:
+            _start_refresh()
+
+    def invalidate(self):
+        """Forget the result kept in memory."""
+        with self._lock:
+            self._result = None
+
+    def _check(self, timeout, timings, refresh):
+        log_timings, metrics_file = _get_metrics_config()
+        if timings is None and (log_timings or metrics_file):
+            timings = metrics.Timings()
+        if timings is None:
+            return _check_payg_byos(self.concurrent, timeout, refresh)
+
+        previous = metrics.use(timings)
+        try:
+            with metrics.span('check'):
+                result = _check_payg_byos(self.concurrent, timeout, refresh)
+        finally:
+            metrics.use(previous)
+        timings.result = tuple(result)
+        if log_timings:
+            logger.info('Timings: %s', timings.to_json())
+        if metrics_file:
+            metrics.write_textfile(timings, metrics_file, METRICS_STATE_PATH)
+        return result
+
+
+def check_payg_byos(
+    concurrent=True, timeout=None, timings=None, refresh=False
+):
     """
     Return 'PAYG' OR 'BYOS' and a code
 
@@ -281,33 +1860,418 @@ def check_payg_byos():
 
     When the flavor cannot be reliably determined we declare the instance to be
     BYOS. That the information is not reliable is indicated by the return code.
+
+    With concurrent set, all the RMT server IPs are queried at the same
+    time, see query_rmt_servers. Otherwise they are tried one after
+    another.
+
+    A verified flavour found in a fresh cache record is returned right
+    away, without asking the update server, unless refresh is set. Once
+    the record is older than the cacheRefreshAge of the flavorCheck
+    configuration it is refreshed by a background check, see
+    _start_refresh. The background check returns the cache record
+    without asking if another check renewed it since the refresh was
+    started.
+
+    The timeout bounds the whole check in seconds, it defaults to the
+    timeout of the flavorCheck configuration. When the time is up the
+    cached flavour is returned.
+
+    The phases of the check and the update server request attempts are
+    timed into the given metrics.Timings. Without timings they are only
+    timed if the flavorCheck configuration sets timings, to log them,
+    or metricsFile, to export them.
+
+    Processes checking more than once use a FlavorChecker instead, it
+    keeps the result in memory and tells where it came from.
+    """
+    return tuple(FlavorChecker(concurrent).check(timeout, timings, refresh))
+
+
+def _check_payg_byos(concurrent, timeout, refresh=False):
+    """Check the flavour, see check_payg_byos."""
+    with metrics.span('cache'):
+        cached = None if refresh else _get_fresh_cache_value()
+    if cached:
+        metrics.count('cache_hit')
+        logger.info('Using fresh cache value: %s', cached.flavor)
+        if _is_aging(cached):
+            _start_refresh()
+        return cached
+    metrics.count('cache_miss')
+
+    deadline = _get_deadline(timeout)
+    # checks running at the same time, e.g. at boot, wait for the
+    # first one and use its answer instead of asking again
+    since = time.time()
+    with contextlib.ExitStack() as stack:
+        with metrics.span('lock') as span:
+            locked = stack.enter_context(files.exclusive_lock(
+                LOCK_FILE_PATH, _get_lock_timeout(deadline)
+            ))
+            span['locked'] = locked
+        cached = _get_concurrent_value(locked, since, deadline)
+        if cached:
+            return cached
+        if refresh and locked is not None:
+            cached = _end_refresh()
+            if cached:
+                logger.info('Cache refreshed already: %s', cached.flavor)
+                return cached
+        return _check_flavour(concurrent, deadline)
+
+
+def _get_lock_timeout(deadline):
+    """Return the seconds to wait for a concurrent check."""
+    lock_timeout = LOCK_TIMEOUT
+    time_left = _get_time_left(deadline)
+    if time_left is not None:
+        lock_timeout = min(lock_timeout, time_left)
+    return lock_timeout
+
+
+def _get_concurrent_value(locked, since, deadline):
+    """
+    Return the FlavorResult to use after waiting for the lock, None
+    to check on our own.
+
+    Once a concurrent check finished its answer written since is
+    used. When the lock could not be taken before the deadline the
+    cached flavour is used.
+    """
+    if locked is False:
+        cached = _get_recent_cache_value(since)
+        if cached:
+            logger.info('Using value of a concurrent check: %s', cached.flavor)
+        return cached
+    if locked is None and _is_expired(deadline):
+        logger.warning('Check ran out of time waiting for another check')
+        return _use_cache_value()
+    return None
+
+
+def _is_aging(result):
+    """
+    Return True if the result is a verified answer of the update server
+    older than the cacheRefreshAge of the flavorCheck configuration.
+    """
+    refresh_age = _get_config_float('cacheRefreshAge', CACHE_REFRESH_AGE)
+    if refresh_age <= 0 or not result.verified or result.timestamp is None:
+        return False
+    return time.time() - result.timestamp > refresh_age
+
+
+def _get_refresh_requested():
+    """
+    Return the time.time() the background refresh in flight was
+    started at, None if there is none or it is older than
+    REFRESH_TIMEOUT.
+    """
+    try:
+        with open(REFRESH_FILE_PATH, 'r') as refresh_file:
+            requested = float(refresh_file.read())
+    except (OSError, ValueError):
+        return None
+    if not 0 <= time.time() - requested < REFRESH_TIMEOUT:
+        return None
+    return requested
+
+
+def _end_refresh():
+    """
+    Clear the background refresh in flight, called with the lock held.
+
+    Return the FlavorResult of a verified cache record written since
+    the refresh was started, e.g. by a check whose cache expired
+    meanwhile, None if the update server is still to be asked.
+    """
+    requested = _get_refresh_requested()
+    try:
+        os.unlink(REFRESH_FILE_PATH)
+    except OSError:
+        pass
+    if requested is None:
+        return None
+    cached = _get_recent_cache_value(requested)
+    if cached and cached.verified:
+        return cached
+    return None
+
+
+def _start_refresh():
+    """
+    Refresh the cache in a detached process running REFRESH_COMMAND,
+    unless a check or another refresh is running already.
+
+    The refresh is marked in flight in REFRESH_FILE_PATH under the lock
+    before the process is started, callers finding the cache aging
+    meanwhile do not start another one.
+    """
+    with files.exclusive_lock(LOCK_FILE_PATH, 0) as locked:
+        if not locked or _get_refresh_requested() is not None:
+            return
+        try:
+            files.write_atomic(REFRESH_FILE_PATH, str(time.time()), 0o600)
+            process = subprocess.Popen(
+                REFRESH_COMMAND,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        except OSError as issue:
+            logger.warning('Could not refresh the cache: %s', issue)
+            _end_refresh()
+            return
+    metrics.count('refresh_ahead')
+    logger.info('Refreshing the cache in the background')
+    # reap the process in long running callers
+    threading.Thread(target=process.wait, daemon=True).start()
+
+
+def _get_startup_jitter(deadline=None):
+    """
+    Return the random seconds to wait before asking the update servers,
+    at most the startupJitter of the flavorCheck configuration and half
+    of the time left before the deadline.
     """
+    jitter = _get_config_float('startupJitter', STARTUP_JITTER)
+    if jitter <= 0:
+        return 0
+    jitter = random.uniform(0, jitter)
+    time_left = _get_time_left(deadline)
+    if time_left is not None:
+        jitter = min(jitter, time_left / 2)
+    return jitter
+
+
+def _take_query_budget():
+    """
+    Take one update server check from the budget of the host, return
+    False if the budget is spent.
+
+    The budget is a token bucket kept in BUDGET_FILE_PATH holding up to
+    queryBudget checks, refilled at queryBudget checks per
+    queryBudgetWindow seconds. Without a budget configured every check
+    is allowed.
+    """
+    budget = _get_config_float('queryBudget', QUERY_BUDGET)
+    window = _get_config_float('queryBudgetWindow', QUERY_BUDGET_WINDOW)
+    if budget <= 0 or window <= 0:
+        return True
+    now = time.time()
+    tokens = budget
+    try:
+        with open(BUDGET_FILE_PATH, 'r') as budget_file:
+            state = json.load(budget_file)
+        elapsed = now - float(state['timestamp'])
+        tokens = min(
+            budget, float(state['tokens']) + max(elapsed, 0) * budget / window
+        )
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    if tokens < 1:
+        return False
+    try:
+        files.write_atomic(
+            BUDGET_FILE_PATH,
+            json.dumps({'tokens': tokens - 1, 'timestamp': now})
+        )
+    except OSError as err:
+        logger.warning('Could not save the query budget: %s', err)
+    return True
+
+
+def _check_flavour(concurrent, deadline):
+    """Ask the update server for the flavour, see check_payg_byos."""
     flavour = 'BYOS'
-    if not (has_ipv6_access() or has_ipv4_access()):
+    # the data provider is the slowest part, let it run while probing
+    # the network access and looking up the identifier and the update
+    # server
+    fetch = start_metadata()
+    with metrics.span('network_access'):
+        network_access = _call_until(deadline, _get_network_access)
+    if network_access is _TIMED_OUT:
+        if fetch.call:
+            fetch.call.kill()
+        logger.warning('Check ran out of time probing the network access')
+        return _use_cache_value()
+    if not any(network_access):
         # instance does not have internet access through IPv4 or IPv6
+        if fetch.call:
+            fetch.call.kill()
         _write_cache(flavour)
-        return (flavour, 12)
-    metadata = get_metadata()
-    identifier = get_identifier()
+        return FlavorResult(flavour, 12, 'fallback')
+    with metrics.span('identifier'):
+        identifier = get_identifier()
+    rmt_ips_addr = None
+    if identifier:
+        with metrics.span('rmt_ip_addr'):
+            rmt_ips_addr = _call_until(
+                deadline, get_rmt_ip_addr, network_access
+            )
+    elif fetch.call:
+        fetch.call.kill()
+        fetch = fetch._replace(call=None)
+    if rmt_ips_addr is _TIMED_OUT or _is_expired(deadline):
+        if fetch.call:
+            fetch.call.kill()
+        logger.warning('Check ran out of time looking up the update server')
+        return _use_cache_value()
+    with metrics.span('metadata', cached=fetch.call is None):
+        metadata = get_metadata(deadline, fetch=fetch)
+    if _is_expired(deadline):
+        logger.warning('Check ran out of time fetching the metadata')
+        return _use_cache_value()
     if not metadata or not identifier:
         logger.warning('No instance metadata and identifier')
         _write_cache(flavour)
-        return (flavour, 12)
+        return FlavorResult(flavour, 12, 'fallback')
 
-    rmt_ips_addr = get_rmt_ip_addr()
     if not rmt_ips_addr:
         logger.warning('Instance can be either BYOS or PAYG and not registered')
         _write_cache(flavour)
-        return (flavour, 12)
-
-    code_flavour = {'PAYG': 10, 'BYOS': 11}
-    for rmt_ip_addr in rmt_ips_addr:
-        flavour = make_request(rmt_ip_addr, metadata, identifier)
-        if flavour:
-            logger.info('Successful server query: {}'.format(flavour))
-            _write_cache(flavour)
-            return (flavour, code_flavour.get(flavour))
-
-    flavour = _get_cache_value()
-    logger.info('Using cache value: {}'.format(flavour))
-    return (flavour, code_flavour.get(flavour))
+        return FlavorResult(flavour, 12, 'fallback')
+
+    if not _take_query_budget():
+        metrics.count('budget_spent')
+        logger.warning('Update server query budget spent')
+        return _use_cache_value()
+    jitter = _get_startup_jitter(deadline)
+    if jitter:
+        with metrics.span('jitter'):
+            time.sleep(jitter)
+
+    health = _read_health()
+    rmt_ips_addr = _order_by_health(
+        _filter_by_network_access(rmt_ips_addr, network_access), health
+    )
+    outcomes = {}
+    with metrics.span('query', servers=len(rmt_ips_addr)):
+        if concurrent:
+            flavour, rmt_ip_addr = query_rmt_servers(
+                rmt_ips_addr, metadata, identifier, deadline=deadline,
+                outcomes=outcomes
+            )
+        else:
+            proxies = _get_proxies()
+            query = _get_query(metadata, identifier)
+            mode = _get_request_mode()
+            for rmt_ip_addr in rmt_ips_addr:
+                started = time.monotonic()
+                flavour = _get_valid_flavour(make_request(
+                    rmt_ip_addr, metadata, identifier, deadline=deadline,
+                    proxies=proxies, query=query, mode=mode
+                ), rmt_ip_addr)
+                _record_outcome(
+                    outcomes, rmt_ip_addr, flavour, started,
+                    _is_expired(deadline)
+                )
+                if flavour in FLAVOUR_CODES:
+                    break
+    _write_health(_update_health(health, outcomes))
+
+    return _use_server_answer(flavour, rmt_ip_addr, metadata, identifier)
+
+
+async def check_payg_byos_async(timeout=None):
+    """
+    Asynchronous variant of check_payg_byos, returning the same
+    (flavour, code) results.
+
+    The network access check, the metadata and identifier lookups run
+    at the same time, the update server lookup once the network access
+    is known, the update servers are queried in tasks cancelled once
+    one of them answered. The blocking work runs in the default
+    executor of the event loop. Checks running at the same time take
+    turns on the lock like check_payg_byos.
+    """
+    return tuple(await _check_payg_byos_async(timeout))
+
+
+async def _check_payg_byos_async(timeout):
+    """Check the flavour, see check_payg_byos_async."""
+    cached = _get_fresh_cache_value()
+    if cached:
+        logger.info('Using fresh cache value: %s', cached.flavor)
+        return cached
+
+    deadline = _get_deadline(timeout)
+    # wait for a concurrent check like _check_payg_byos, without
+    # blocking the event loop
+    since = time.time()
+    async with files.AsyncExclusiveLock(
+        LOCK_FILE_PATH, _get_lock_timeout(deadline)
+    ) as locked:
+        cached = _get_concurrent_value(locked, since, deadline)
+        if cached:
+            return cached
+        return await _check_flavour_async(deadline)
+
+
+async def _check_flavour_async(deadline):
+    """Ask the update server for the flavour, see check_payg_byos_async."""
+    import asyncio
+    loop = asyncio.get_event_loop()
+    # the data provider and the identifier lookup run while the
+    # network access is probed, the update server lookup needs it
+    fetch = start_metadata()
+    access = loop.run_in_executor(None, metrics.bind(_get_network_access))
+    metadata = loop.run_in_executor(None, functools.partial(
+        metrics.bind(get_metadata), deadline, fetch=fetch
+    ))
+    identifier = loop.run_in_executor(None, metrics.bind(get_identifier))
+    phases = [access, metadata, identifier]
+    try:
+        done, _ = await asyncio.wait(
+            [access], timeout=_get_time_left(deadline)
+        )
+        if done and not any(access.result()):
+            # instance does not have internet access through IPv4 or IPv6
+            if fetch.call:
+                fetch.call.kill()
+            _write_cache('BYOS')
+            return FlavorResult('BYOS', 12, 'fallback')
+        if done:
+            rmt_ips_addr = loop.run_in_executor(
+                None, metrics.bind(get_rmt_ip_addr), access.result()
+            )
+            phases.append(rmt_ips_addr)
+            done, _ = await asyncio.wait(
+                phases, timeout=_get_time_left(deadline)
+            )
+        if len(done) != len(phases):
+            if fetch.call:
+                fetch.call.kill()
+            logger.warning('Check ran out of time')
+            return _use_cache_value()
+    finally:
+        for phase in phases:
+            phase.cancel()
+
+    metadata = metadata.result()
+    identifier = identifier.result()
+    if not metadata or not identifier:
+        logger.warning('No instance metadata and identifier')
+        _write_cache('BYOS')
+        return FlavorResult('BYOS', 12, 'fallback')
+    rmt_ips_addr = rmt_ips_addr.result()
+    if not rmt_ips_addr:
+        logger.warning('Instance can be either BYOS or PAYG and not registered')
+        _write_cache('BYOS')
+        return FlavorResult('BYOS', 12, 'fallback')
+
+    if not _take_query_budget():
+        logger.warning('Update server query budget spent')
+        return _use_cache_value()
+    await asyncio.sleep(_get_startup_jitter(deadline))
+
+    health = _read_health()
+    outcomes = {}
+    rmt_ips_addr = _filter_by_network_access(rmt_ips_addr, access.result())
+    flavour, rmt_ip_addr = await _query_rmt_servers_async(
+        _order_by_health(rmt_ips_addr, health), metadata, identifier,
+        deadline=deadline, outcomes=outcomes
+    )
+    _write_health(_update_health(health, outcomes))
+    return _use_server_answer(flavour, rmt_ip_addr, metadata, identifier)
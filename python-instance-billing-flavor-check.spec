@@ -49,6 +49,8 @@ BuildRequires:  %{pythons}-pip
 BuildRequires:  %{pythons}-wheel
 %endif
 BuildRequires:  python-rpm-macros
+BuildRequires:  systemd-rpm-macros
+%{?systemd_requires}
 # We need to make sure there is a cloud-regionsrv-client version that is
 # also built with Python 3.11
 %if 0%{?suse_version} > 1315 && 0%{?suse_version} < 1600
@@ -76,11 +78,29 @@ Check if instance is PAYG or BYOS
 %else
 %{pythons} setup.py install --prefix=%{_prefix} --root=%{buildroot}
 %endif
+install -D -m 644 instance-flavor-check.service %{buildroot}%{_unitdir}/instance-flavor-check.service
+install -D -m 644 instance-flavor-check.socket %{buildroot}%{_unitdir}/instance-flavor-check.socket
+
+%pre
+%service_add_pre instance-flavor-check.service instance-flavor-check.socket
+
+%post
+%service_add_post instance-flavor-check.service instance-flavor-check.socket
+
+%preun
+%service_del_preun instance-flavor-check.service instance-flavor-check.socket
+
+%postun
+%service_del_postun instance-flavor-check.service instance-flavor-check.socket
 
 %files
 %doc README.md
 %license LICENSE
+%{_bindir}/instance-flavor-batch-check
 %{_bindir}/instance-flavor-check
+%{_bindir}/instance-flavor-checkd
+%{_unitdir}/instance-flavor-check.service
+%{_unitdir}/instance-flavor-check.socket
 %{python_sitelib}/instance_billing_flavor_check*
 
 %changelog
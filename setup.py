@@ -47,7 +47,9 @@ if __name__ == '__main__':
             '': 'lib',
         },
         scripts=[
-            'instance-flavor-check'
+            'instance-flavor-batch-check',
+            'instance-flavor-check',
+            'instance-flavor-checkd'
         ],
         classifiers=[
             'Development Status :: 4 - Beta',
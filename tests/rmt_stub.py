@@ -0,0 +1,127 @@
+"""
+Local stand-in for the /api/instance/check endpoint of an RMT server.
+
+The server speaks HTTPS with a throw away self-signed certificate,
+answers GET checks and, if enabled, gzip compressed POST checks.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate, return (certfile, keyfile)."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        [
+            shutil.which('openssl') or 'openssl', 'req', '-x509',
+            '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=localhost',
+            '-keyout', keyfile, '-out', certfile
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True
+    )
+    return certfile, keyfile
+
+
+class CheckHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, status, payload=None):
+        body = json.dumps(payload or {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check(self, method, params, size):
+        stub = self.server.stub
+        stub.record(method, params, size)
+        if stub.delay:
+            time.sleep(stub.delay)
+        if stub.status != 200:
+            self._answer(stub.status)
+        elif 'metadata' not in params or 'identifier' not in params:
+            self._answer(422, {'error': 'missing parameter'})
+        else:
+            self._answer(200, {'flavor': stub.flavor})
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/api/instance/check':
+            return self._answer(404)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        self._check('GET', params, len(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/api/instance/check' or not self.server.stub.post:
+            return self._answer(404)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        params = dict(urllib.parse.parse_qsl(body.decode()))
+        self._check('POST', params, length)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # load tests open many connections at once
+    request_queue_size = 128
+
+
+class RMTStub:
+    """
+    **Stand-in RMT server**
+    Answers the instance check with the configured flavor after the
+    configured delay, or with the configured error status. The
+    requests are recorded as (method, params, size) tuples
+    """
+    def __init__(self, flavor='PAYG', post=False, delay=0, status=200):
+        self.flavor = flavor
+        self.post = post
+        self.delay = delay
+        self.status = status
+        self.requests = []
+        self._lock = threading.Lock()
+        self._directory = tempfile.mkdtemp()
+        certfile, keyfile = make_certificate(self._directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.server = StubServer(('127.0.0.1', 0), CheckHandler)
+        self.server.stub = self
+        self.server.socket = context.wrap_socket(
+            self.server.socket, server_side=True
+        )
+        self.port = self.server.server_address[1]
+
+    def record(self, method, params, size):
+        with self._lock:
+            self.requests.append((method, params, size))
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self._directory, ignore_errors=True)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import threading
+import time
+
+from pytest import fixture
+from unittest.mock import patch
+from instance_billing_flavor_check import files, utils
+
+utils.HEALTH_FILE_PATH = '/tmp/instance-billing-flavor-check.health'
+utils.LOCK_FILE_PATH = '/tmp/instance-billing-flavor-check.lock'
+
+IPV4_ADDR = '203.0.113.1'
+IPV6_ADDR = '2001:DB8::1'
+
+
+@fixture(autouse=True)
+def connectivity_cache(tmp_path):
+    """Keep the network access probed by a test to the test."""
+    utils._network_access_cache.clear()
+    with patch.object(
+        utils, 'CONNECTIVITY_CACHE_FILE_PATH', str(tmp_path / 'connectivity')
+    ):
+        yield
+    utils._network_access_cache.clear()
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _slow(result, seconds=0.3):
+    def call(*args, **kwargs):
+        time.sleep(seconds)
+        return result
+    return call
+
+
+@patch('instance_billing_flavor_check.utils._get_network_access')
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_async_concurrent_phases(
+    mock_request, mock_rmt_ip, mock_metadata, mock_identifier, mock_access,
+    tmp_path
+):
+    """Test the lookups run at the same time."""
+    mock_access.side_effect = _slow(utils.NetworkAccess(True, True))
+    mock_metadata.side_effect = _slow('foo')
+    mock_identifier.side_effect = _slow('sles')
+    mock_rmt_ip.side_effect = _slow([IPV4_ADDR])
+    mock_request.return_value = 'PAYG'
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        start = time.monotonic()
+        assert _run(utils.check_payg_byos_async()) == ('PAYG', 10)
+        assert time.monotonic() - start < 0.9
+        record = json.load(open(utils.CACHE_FILE_PATH))
+    assert record['server'] == IPV4_ADDR
+    assert record['code'] == 10
+
+
+@patch('instance_billing_flavor_check.utils._get_network_access')
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_async_passes_network_access(
+    mock_request, mock_rmt_ip, mock_metadata, mock_identifier, mock_access,
+    tmp_path
+):
+    """Test the update server lookup gets the probed network access."""
+    access = utils.NetworkAccess(True, False)
+    mock_access.return_value = access
+    mock_metadata.return_value = 'foo'
+    mock_identifier.return_value = 'sles'
+    mock_rmt_ip.return_value = [IPV4_ADDR]
+    mock_request.return_value = 'BYOS'
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        assert _run(utils.check_payg_byos_async()) == ('BYOS', 11)
+    mock_rmt_ip.assert_called_once_with(access)
+
+
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_check_payg_byos_async_single_flight(mock_metadata, tmp_path):
+    """Test a check waits for a concurrent one and uses its answer."""
+    locked = threading.Event()
+
+    def concurrent_check():
+        with files.exclusive_lock(utils.LOCK_FILE_PATH):
+            locked.set()
+            time.sleep(0.2)
+            utils._write_cache('PAYG', code=10)
+
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        concurrent = threading.Thread(target=concurrent_check)
+        concurrent.start()
+        locked.wait()
+        assert _run(utils.check_payg_byos_async()) == ('PAYG', 10)
+        concurrent.join()
+    assert not mock_metadata.called
+
+
+@patch('instance_billing_flavor_check.utils._get_network_access')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_check_payg_byos_async_no_network(
+    mock_metadata, mock_access, tmp_path
+):
+    """Test no network access is unreliable BYOS."""
+    mock_access.return_value = utils.NetworkAccess(False, False)
+    mock_metadata.return_value = 'foo'
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        assert _run(utils.check_payg_byos_async()) == ('BYOS', 12)
+
+
+@patch('instance_billing_flavor_check.utils._get_network_access')
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+def test_check_payg_byos_async_out_of_time(
+    mock_rmt_ip, mock_metadata, mock_identifier, mock_access, tmp_path
+):
+    """Test the cache is used when a lookup runs out of time."""
+    mock_access.return_value = utils.NetworkAccess(True, False)
+    mock_metadata.side_effect = _slow('foo', 1)
+    mock_identifier.return_value = 'sles'
+    mock_rmt_ip.return_value = [IPV4_ADDR]
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        utils._write_cache('PAYG')
+        start = time.monotonic()
+        assert _run(utils.check_payg_byos_async(timeout=0.2)) == ('BYOS', 12)
+        assert time.monotonic() - start < 0.9
+
+
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_check_payg_byos_async_fresh_cache(mock_metadata, tmp_path):
+    """Test a fresh cache is used right away."""
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        utils._write_cache('BYOS', code=11, digest='foo')
+        with patch.object(utils, '_get_instance_digest', return_value='foo'):
+            assert _run(utils.check_payg_byos_async()) == ('BYOS', 11)
+    assert not mock_metadata.called
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_async_first_answer_wins(mock_request):
+    """Test the first answer wins and the other queries are cancelled."""
+    cancel_events = []
+
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        cancel_events.append(cancel_event)
+        if rmt_ip_addr == IPV6_ADDR:
+            cancel_event.wait(5)
+            return None
+        return 'BYOS'
+
+    mock_request.side_effect = request
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 0.05):
+        assert _run(utils._query_rmt_servers_async(
+            [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+        )) == ('BYOS', IPV4_ADDR)
+    assert all(event.is_set() for event in cancel_events)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_async_unknown_flavour(mock_request):
+    """Test a server answering an unknown flavour does not win."""
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        if rmt_ip_addr == IPV6_ADDR:
+            return 'garbage'
+        time.sleep(0.1)
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 0):
+        assert _run(utils._query_rmt_servers_async(
+            [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+        )) == ('PAYG', IPV4_ADDR)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_async_ipv4_after_ipv6_failed(mock_request):
+    """Test IPv4 is queried right away once all IPv6 queries failed."""
+    mock_request.side_effect = lambda ip_addr, *args, **kwargs: (
+        None if ip_addr == IPV6_ADDR else 'PAYG'
+    )
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 5):
+        start = time.monotonic()
+        assert _run(utils._query_rmt_servers_async(
+            [IPV4_ADDR, IPV6_ADDR], 'foo', 'bar'
+        )) == ('PAYG', IPV4_ADDR)
+        assert time.monotonic() - start < 1
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_async_deadline(mock_request, caplog):
+    """Test the queries are cancelled at the deadline."""
+    event = threading.Event()
+    mock_request.side_effect = lambda *args, **kwargs: event.wait(5)
+    assert _run(utils._query_rmt_servers_async(
+        [IPV4_ADDR], 'foo', 'bar', deadline=time.monotonic() + 0.1
+    )) == (None, None)
+    event.set()
+    assert 'No update server answered in time' in caplog.text
@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+
+from unittest.mock import patch, ANY
+from instance_billing_flavor_check import batch, utils
+
+
+def _line(rmt_ip, identifier='sles', metadata='foo', **extra):
+    record = dict(
+        rmt_ip=rmt_ip, identifier=identifier, metadata=metadata, **extra
+    )
+    return json.dumps(record) + '\n'
+
+
+@patch('instance_billing_flavor_check.utils._get_proxies')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records(mock_request, mock_proxies):
+    """Test every record gets a result."""
+    mock_proxies.return_value = None
+    flavours = {'1.1.1.1': 'PAYG', '2.2.2.2': 'BYOS', '3.3.3.3': None}
+    mock_request.side_effect = lambda ip_addr, *args, **kwargs: (
+        flavours[ip_addr]
+    )
+    lines = [
+        _line('1.1.1.1', id='i-1'), '\n', _line('2.2.2.2'),
+        _line('3.3.3.3'), '{"rmt_ip": "4.4.4.4"}\n', 'garbage\n'
+    ]
+    results = sorted(
+        batch.check_records(iter(lines), workers=2),
+        key=lambda result: result['line']
+    )
+    assert [(r['line'], r['flavor'], r['code']) for r in results] == [
+        (1, 'PAYG', 10), (3, 'BYOS', 11), (4, None, 12),
+        (5, None, 12), (6, None, 12)
+    ]
+    assert results[0]['id'] == 'i-1'
+    assert results[0]['error'] is None
+    assert results[2]['error'] == 'No flavor answered'
+    assert results[3]['error'].startswith('Invalid record')
+    assert results[4]['error'].startswith('Invalid record')
+    assert mock_proxies.call_count == 1
+    mock_request.assert_any_call(
+        '1.1.1.1', 'foo', 'sles', deadline=None, proxies=None, session=ANY
+    )
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_own_session(mock_request):
+    """Test the checks leave the shared session of the process alone."""
+    mock_request.return_value = 'PAYG'
+    shared = utils._get_session()
+    adapter = shared.get_adapter('https://1.1.1.1')
+    results = list(batch.check_records(iter([_line('1.1.1.1')]), workers=64))
+    assert len(results) == 1
+    session = mock_request.call_args[1]['session']
+    assert session is not shared
+    assert session.get_adapter('https://1.1.1.1')._pool_maxsize == 64
+    assert shared.get_adapter('https://1.1.1.1') is adapter
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_closed_early(mock_request):
+    """Test the records left are released once the results are not read."""
+    read = []
+
+    def lines():
+        for number in range(5):
+            read.append(number)
+            yield _line('1.1.1.1')
+
+    mock_request.side_effect = lambda *args, **kwargs: (
+        time.sleep(0.1) or 'PAYG'
+    )
+    results = batch.check_records(lines(), workers=1, per_server=1)
+    assert next(results)['flavor'] == 'PAYG'
+    results.close()
+    for _ in range(100):
+        if len(read) == 5:
+            break
+        time.sleep(0.01)
+    assert len(read) == 5
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_completion_order(mock_request):
+    """Test results are produced as soon as they are checked."""
+    def request(ip_addr, *args, **kwargs):
+        if ip_addr == '1.1.1.1':
+            time.sleep(0.3)
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    results = batch.check_records(
+        iter([_line('1.1.1.1'), _line('2.2.2.2')]), workers=2
+    )
+    assert [result['line'] for result in results] == [2, 1]
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_per_server_limit(mock_request):
+    """Test the requests in flight to one server are limited."""
+    in_flight = {}
+    peak = {}
+    lock = threading.Lock()
+
+    def request(ip_addr, *args, **kwargs):
+        with lock:
+            in_flight[ip_addr] = in_flight.get(ip_addr, 0) + 1
+            peak[ip_addr] = max(peak.get(ip_addr, 0), in_flight[ip_addr])
+        time.sleep(0.05)
+        with lock:
+            in_flight[ip_addr] -= 1
+        return 'BYOS'
+
+    mock_request.side_effect = request
+    lines = [_line('1.1.1.1') for _ in range(12)] + \
+        [_line('2.2.2.2') for _ in range(12)]
+    results = list(batch.check_records(iter(lines), workers=8, per_server=2))
+    assert len(results) == 24
+    assert peak == {'1.1.1.1': 2, '2.2.2.2': 2}
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_bounded_read_ahead(mock_request):
+    """Test the input is not read far ahead of the workers."""
+    release = threading.Event()
+    read = []
+
+    def lines():
+        for number in range(100):
+            read.append(number)
+            yield _line('1.1.1.1')
+
+    mock_request.side_effect = lambda *args, **kwargs: (
+        release.wait(5) and 'PAYG'
+    )
+    results = batch.check_records(lines(), workers=2)
+    checker = threading.Thread(target=lambda: list(results))
+    checker.start()
+    time.sleep(0.2)
+    assert len(read) <= 2 * batch.READ_AHEAD + 1
+    release.set()
+    checker.join()
+    assert len(read) == 100
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_busy_server_does_not_block(mock_request):
+    """Test records of a busy server leave the workers to other servers."""
+    def request(ip_addr, *args, **kwargs):
+        if ip_addr == '1.1.1.1':
+            time.sleep(0.1)
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    lines = [_line('1.1.1.1') for _ in range(4)] + [_line('2.2.2.2')]
+    results = list(
+        batch.check_records(iter(lines), workers=4, per_server=1)
+    )
+    assert results[0]['line'] == 5
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_records_parses_once(mock_request):
+    """Test every input line is parsed once."""
+    mock_request.return_value = 'BYOS'
+    lines = [_line('1.1.1.1'), _line('2.2.2.2'), 'garbage\n']
+    with patch.object(
+        batch.json, 'loads', wraps=json.loads
+    ) as mock_loads:
+        assert len(list(batch.check_records(iter(lines)))) == 3
+    assert mock_loads.call_count == 3
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import time
+
+from pytest import raises
+from instance_billing_flavor_check.command import Command
+
+
+def test_run():
+    """Test running a command in blocking mode."""
+    result = Command.run(['echo', 'foo'])
+    assert result.output == 'foo\n'
+    assert result.error == ''
+    assert result.returncode == 0
+
+
+def test_run_error():
+    """Test a failing command raises unless told not to."""
+    with raises(Exception) as issue:
+        Command.run(['false'])
+    assert 'false: stderr: (no output on stderr)' in str(issue.value)
+    result = Command.run(['false'], raise_on_error=False)
+    assert result.returncode == 1
+    assert result.output == '(no output on stdout)'
+
+
+def test_run_not_found():
+    """Test a missing program raises."""
+    with raises(Exception) as issue:
+        Command.run(['/does/not/exist'])
+    assert 'FileNotFoundError' in str(issue.value)
+
+
+def test_start_poll_wait():
+    """Test running a command in non blocking mode."""
+    call = Command.start(['sh', '-c', 'sleep 0.2; echo foo'])
+    assert call.poll() is None
+    result = call.wait(timeout=5)
+    assert result.output == 'foo\n'
+    assert call.poll() == 0
+
+
+def test_start_wait_timeout():
+    """Test a command running past the timeout is killed."""
+    call = Command.start(['sleep', '10'])
+    start = time.monotonic()
+    with raises(Exception) as issue:
+        call.wait(timeout=0.2)
+    assert 'sleep: timed out after 0.2s' in str(issue.value)
+    assert time.monotonic() - start < 5
+    assert call.poll() is not None
+
+
+def test_start_kill():
+    """Test killing a running command."""
+    call = Command.start(['sleep', '10'])
+    call.kill()
+    assert call.poll() == -9
+    call.kill()
+
+
+def test_wait_async():
+    """Test waiting for a command in an event loop."""
+    async def run():
+        call = Command.start(['sh', '-c', 'sleep 0.2; echo foo'])
+        waiting = asyncio.ensure_future(call.wait_async(timeout=5))
+        assert not waiting.done()
+        return await waiting
+
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert result.output == 'foo\n'
+
+
+def test_run_timeout_kills_process_group():
+    """Test the processes started by a hanging command are killed too."""
+    start = time.monotonic()
+    with raises(Exception) as issue:
+        # the background sleep keeps the pipes open after sh is gone
+        Command.run(['sh', '-c', 'sleep 10 & sleep 10'], timeout=0.3)
+    assert 'timed out after 0.3s' in str(issue.value)
+    assert time.monotonic() - start < 5
+
+
+def _running(command_line):
+    """Return True if a process with the command line is running."""
+    for pid in os.listdir('/proc'):
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as cmdline:
+                if cmdline.read().split(b'\0')[:-1] == command_line:
+                    return True
+        except OSError:
+            continue
+    return False
+
+
+def test_run_timeout_kills_left_behind_processes():
+    """Test processes left behind by an exited command are killed."""
+    with raises(Exception) as issue:
+        # sh exits at once, the background sleep keeps the pipes open
+        Command.run(['sh', '-c', 'sleep 7.77 & echo hi'], timeout=0.5)
+    assert 'timed out after 0.5s' in str(issue.value)
+    time.sleep(0.1)
+    assert not _running([b'sleep', b'7.77'])
+
+
+def test_run_output_limit():
+    """Test a command flooding its output is stopped at the limit."""
+    start = time.monotonic()
+    with raises(Exception) as issue:
+        Command.run(['yes'], max_output=1024 * 1024, timeout=10)
+    assert 'yes: output exceeds 1048576 bytes' in str(issue.value)
+    assert time.monotonic() - start < 5
+
+
+def test_run_output_within_limit():
+    """Test output and error below the limit are returned."""
+    result = Command.run(
+        ['sh', '-c', 'head -c 200000 /dev/zero; echo bar >&2'],
+        max_output=300000
+    )
+    assert len(result.raw_output) == 200000
+    assert result.raw_error == b'bar\n'
+
+
+def test_run_raw_output():
+    """Test the output is kept as bytes and decoded on access."""
+    result = Command.run(['printf', '\\303\\244'])
+    assert result.raw_output == b'\xc3\xa4'
+    assert result.output == '\xe4'
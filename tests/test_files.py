@@ -0,0 +1,103 @@
+import asyncio
+import fcntl
+import os
+import stat
+import threading
+import time
+
+from unittest.mock import patch
+
+import pytest
+
+from instance_billing_flavor_check import files
+
+
+def test_write_atomic(tmp_path):
+    path = tmp_path / 'cache'
+    path.write_text('old')
+    files.write_atomic(str(path), 'new', mode=0o600)
+    assert path.read_text() == 'new'
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o600
+    assert os.listdir(str(tmp_path)) == ['cache']
+
+
+def test_write_atomic_failure_keeps_file(tmp_path):
+    path = tmp_path / 'cache'
+    path.write_text('old')
+    with patch('os.replace', side_effect=OSError('oh no')):
+        with pytest.raises(OSError):
+            files.write_atomic(str(path), 'new')
+    assert path.read_text() == 'old'
+    assert os.listdir(str(tmp_path)) == ['cache']
+
+
+def _hold_lock(path, seconds):
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(descriptor, fcntl.LOCK_EX)
+
+    def release():
+        time.sleep(seconds)
+        os.close(descriptor)
+    thread = threading.Thread(target=release)
+    thread.start()
+    return thread
+
+
+def test_exclusive_lock_free(tmp_path):
+    with files.exclusive_lock(str(tmp_path / 'lock')) as locked:
+        assert locked is True
+
+
+def test_exclusive_lock_waits(tmp_path):
+    path = str(tmp_path / 'lock')
+    holder = _hold_lock(path, 0.2)
+    start = time.monotonic()
+    with files.exclusive_lock(path, timeout=5) as locked:
+        assert locked is False
+        assert time.monotonic() - start >= 0.15
+    holder.join()
+
+
+def test_exclusive_lock_waits_forever(tmp_path):
+    path = str(tmp_path / 'lock')
+    holder = _hold_lock(path, 0.2)
+    with files.exclusive_lock(path) as locked:
+        assert locked is False
+    holder.join()
+
+
+def test_exclusive_lock_timeout(tmp_path):
+    path = str(tmp_path / 'lock')
+    holder = _hold_lock(path, 0.5)
+    with files.exclusive_lock(path, timeout=0.1) as locked:
+        assert locked is None
+    holder.join()
+
+
+def test_exclusive_lock_no_file(tmp_path):
+    path = str(tmp_path / 'missing' / 'lock')
+    with files.exclusive_lock(path) as locked:
+        assert locked is None
+
+
+def _lock_async(path, timeout=None):
+    async def take():
+        async with files.AsyncExclusiveLock(path, timeout) as locked:
+            return locked
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(take())
+    finally:
+        loop.close()
+
+
+def test_async_exclusive_lock(tmp_path):
+    path = str(tmp_path / 'lock')
+    assert _lock_async(path) is True
+    holder = _hold_lock(path, 0.2)
+    assert _lock_async(path, timeout=5) is False
+    holder.join()
+    holder = _hold_lock(path, 0.5)
+    assert _lock_async(path, timeout=0.1) is None
+    holder.join()
+    assert _lock_async(str(tmp_path / 'missing' / 'lock')) is None
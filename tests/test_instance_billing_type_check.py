@@ -12,8 +12,10 @@
 # License along with this library.
 
 import sys
+import threading
+import time
 
-from pytest import raises
+from pytest import fixture, raises
 from unittest import mock
 from unittest.mock import patch, Mock, call
 from requests import exceptions
@@ -22,7 +24,23 @@ from instance_billing_flavor_check import utils
 IPV4_ADDR = '203.0.113.1'
 IPV6_ADDR = '2001:DB8::1'
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+
+@fixture(autouse=True)
+def connectivity_cache(tmp_path):
+    """Keep the network access probed by a test to the test."""
+    utils._network_access_cache.clear()
+    with patch.object(
+        utils, 'CONNECTIVITY_CACHE_FILE_PATH', str(tmp_path / 'connectivity')
+    ):
+        yield
+    utils._network_access_cache.clear()
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv4(mock_request_get):
     """Test make request with IPV4_ADDR without issues."""
     response = Mock()
@@ -35,11 +53,15 @@ def test_make_request_ipv4(mock_request_get):
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6(mock_request_get):
     """Test make request with IPv6 without issues."""
     response = Mock()
@@ -52,10 +74,14 @@ def test_make_request_ipv6(mock_request_get):
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_http_error(mock_request_get, caplog):
     """Test make request with IPv6 when HTTP error exception."""
     response = Mock()
@@ -69,11 +95,15 @@ def test_make_request_ipv6_http_error(mock_request_get, caplog):
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_connection_error(mock_request_get, caplog):
     """Test make request with IPv6 when Connection error exception."""
     response = Mock()
@@ -83,13 +113,17 @@ def test_make_request_ipv6_connection_error(mock_request_get, caplog):
     assert utils.make_request(IPV6_ADDR, 'foo', 'bar') is None
     assert 'Error Connecting:foo' in caplog.text
     mock_request_get.call_args_list == [
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None),
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None),
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None)
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None),
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None),
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None)
     ]
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_timeout_error(mock_request_get, caplog):
     """Test make request with IPv6 when Timeout error exception."""
     response = Mock()
@@ -99,13 +133,17 @@ def test_make_request_ipv6_timeout_error(mock_request_get, caplog):
     assert utils.make_request(IPV6_ADDR, 'foo', 'bar') is None
     assert 'Timeout Error:foo' in caplog.text
     mock_request_get.call_args_list == [
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None),
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None),
-        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params={'metadata': 'foo', 'identifier': 'bar'}, proxies=None)
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None),
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None),
+        call('https://[2001:DB8::1]/api/instance/check', timeout=2, verify=False, params='metadata=foo&identifier=bar', proxies=None)
     ]
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_request_error(mock_request_get, caplog):
     """Test make request with IPv6 when Request error exception."""
     response = Mock()
@@ -119,11 +157,15 @@ def test_make_request_ipv6_request_error(mock_request_get, caplog):
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_unexpected_error(mock_request_get, caplog):
     """Test make request with IPv6 when Request error exception."""
     response = Mock()
@@ -137,11 +179,69 @@ def test_make_request_ipv6_unexpected_error(mock_request_get, caplog):
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
 
-@patch('instance_billing_flavor_check.utils.requests.get')
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('instance_billing_flavor_check.utils._wait')
+@patch('requests.Session.get')
+def test_make_request_retry_after(mock_request_get, mock_wait, caplog):
+    """Test make request asks a busy server again after Retry-After."""
+    busy = Mock()
+    busy.status_code = 503
+    busy.headers = {'Retry-After': '3'}
+    response = Mock()
+    response.status_code = 200
+    response.json.return_value = {'flavor': 'PAYG'}
+    mock_request_get.side_effect = [busy, response]
+    assert utils.make_request(IPV4_ADDR, 'foo', 'bar') == 'PAYG'
+    assert 'is busy' in caplog.text
+    wait = mock_wait.call_args[0][0]
+    assert 3 <= wait <= 3 + utils.BACKOFF_BASE
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('instance_billing_flavor_check.utils._wait')
+@patch('requests.Session.get')
+def test_make_request_retry_after_too_long(mock_request_get, mock_wait):
+    """Test make request gives up a server asking to wait too long."""
+    busy = Mock()
+    busy.status_code = 429
+    busy.headers = {'Retry-After': '3600'}
+    busy.reason = 'Too Many Requests'
+    mock_request_get.return_value = busy
+    assert utils.make_request(IPV4_ADDR, 'foo', 'bar') is None
+    assert mock_request_get.call_count == 1
+    assert not mock_wait.called
+
+
+def test_get_retry_after():
+    """Test the Retry-After header in seconds and as HTTP date."""
+    response = Mock()
+    response.headers = {
+        'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'
+    }
+    assert utils.BACKOFF_BASE >= utils._get_retry_after(response, 1) >= 0
+    response.headers = {'Retry-After': '5'}
+    assert utils._get_retry_after(
+        response, 1, deadline=time.monotonic() + 2
+    ) is None
+    response.headers = {}
+    assert utils._get_retry_after(response, 1) <= utils.BACKOFF_BASE
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_proxies',
+    new=Mock(return_value=None)
+)
+@patch('requests.Session.get')
 def test_make_request_ipv6_request_ok_wrong_status_code(
     mock_request_get,
     caplog
@@ -164,10 +264,46 @@ def test_make_request_ipv6_request_ok_wrong_status_code(
         proxies=None,
         timeout=2,
         verify=False,
-        params={'metadata': 'foo', 'identifier': 'bar'}
+        params='metadata=foo&identifier=bar'
     )
 
 
+@patch('requests.Session.get')
+def test_make_request_reuses_session(mock_session_get):
+    """Test the attempts and servers share one session."""
+    response = Mock()
+    response.status_code = 200
+    response.json.return_value = {'flavor': 'PAYG'}
+    mock_session_get.return_value = response
+    with patch.object(utils, '_session', None):
+        session = utils._get_session()
+        assert utils.make_request(
+            IPV4_ADDR, 'foo', 'bar', proxies={}, query='q'
+        ) == 'PAYG'
+        assert utils.make_request(
+            IPV6_ADDR, 'foo', 'bar', proxies={}, query='q'
+        ) == 'PAYG'
+        assert utils._get_session() is session
+    assert session.verify is False
+    assert [c[1]['params'] for c in mock_session_get.call_args_list] == [
+        'q', 'q'
+    ]
+
+
+@patch('instance_billing_flavor_check.utils._get_proxies')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_prepares_request_once(mock_request, mock_proxies):
+    """Test the proxies and query are looked up once for all servers."""
+    mock_proxies.return_value = {'https_proxy': 'https://proxy'}
+    mock_request.return_value = None
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 0):
+        utils.query_rmt_servers([IPV6_ADDR, IPV4_ADDR], 'f o', 'b&r')
+    assert mock_proxies.call_count == 1
+    for request_call in mock_request.call_args_list:
+        assert request_call[1]['proxies'] == {'https_proxy': 'https://proxy'}
+        assert request_call[1]['query'] == 'metadata=f+o&identifier=b%26r'
+
+
 def test_make_request_not_valid_ip(caplog):
     """
     Test make request with a not valid IP."""
@@ -175,27 +311,58 @@ def test_make_request_not_valid_ip(caplog):
     error_message = 'The RMT IP address foo is not valid.'
     assert error_message in caplog.text
 
-def test_no_etc_hosts_file():
-    file_mock = Mock()
-    with patch('builtins.open', create=True) as mock_open:
-        mock_open.return_value.__enter__.side_effect = [
-            FileNotFoundError, file_mock
-        ]
+def test_no_etc_hosts_file(tmp_path):
+    with patch.object(utils, 'ETC_HOSTS_PATH', str(tmp_path / 'hosts')):
         assert utils._get_ips_from_etc_hosts() is None
 
 
-@patch('instance_billing_flavor_check.utils.ipaddress.ip_address')
-def test_etc_hosts_file_wrong_ip(mock_ip_addr):
-    mock_ip_addr.side_effect = ValueError('wrong ip!')
-    assert utils._get_ips_from_etc_hosts() == []
+def _etc_hosts(tmp_path, content):
+    etc_hosts = tmp_path / 'hosts'
+    etc_hosts.write_text(content)
+    utils._parsed_files.clear()
+    return patch.object(utils, 'ETC_HOSTS_PATH', str(etc_hosts))
+
 
+def test_etc_hosts_file_wrong_ip(tmp_path):
+    with _etc_hosts(tmp_path, 'foo susecloud.net\n'):
+        assert utils._get_ips_from_etc_hosts() == []
 
-def test_etc_hosts_file_valid_ip():
-    foo = '1.1.1.1 susecloud.net'
-    with patch('builtins.open', mock.mock_open(read_data=foo)):
+
+def test_etc_hosts_file_valid_ip(tmp_path):
+    with _etc_hosts(tmp_path, '1.1.1.1 susecloud.net'):
         assert utils._get_ips_from_etc_hosts() == ['1.1.1.1']
 
 
+def test_etc_hosts_file_fields(tmp_path):
+    content = """
+127.0.0.1 localhost
+# 9.9.9.9 smt-azure.susecloud.net
+8.8.8.8 localhost # moved from smt-azure.susecloud.net
+7.7.7.7 notsusecloud.network
+1.1.1.1\tsmt-azure.susecloud.net smt-azure
+2.2.2.2 smt-azure.susecloud.net
+fc00::1 smt-azure.susecloud.net
+1.1.1.1 smt-azure.susecloud.net
+fc00::2 smt-azure.susecloud.net smt-azure
+"""
+    with _etc_hosts(tmp_path, content):
+        assert utils._get_ips_from_etc_hosts() == [
+            'fc00::1', 'fc00::2', '1.1.1.1', '2.2.2.2'
+        ]
+
+
+def test_etc_hosts_file_memo(tmp_path):
+    with _etc_hosts(tmp_path, '1.1.1.1 smt-gce.susecloud.net\n'):
+        assert utils._get_ips_from_etc_hosts() == ['1.1.1.1']
+        with patch('builtins.open') as mock_open:
+            assert utils._get_ips_from_etc_hosts() == ['1.1.1.1']
+            assert not mock_open.called
+        (tmp_path / 'hosts').write_text(
+            '1.1.1.1 smt-gce.susecloud.net\n2.2.2.2 smt-gce.susecloud.net\n'
+        )
+        assert utils._get_ips_from_etc_hosts() == ['1.1.1.1', '2.2.2.2']
+
+
 @patch('instance_billing_flavor_check.utils.get_smt')
 @patch('instance_billing_flavor_check.utils.has_ipv4_access')
 @patch('instance_billing_flavor_check.utils.has_ipv6_access')
@@ -262,3 +429,177 @@ def test_get_rmt_ip_addr_no_ips(
     mock_ips_from_etc_hosts.return_value = None
     mock_ips_from_cloudreg.return_value = []
     assert utils.get_rmt_ip_addr() is None
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_first_answer_wins(mock_request):
+    """Test the first server answering with a flavour wins."""
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        if rmt_ip_addr == IPV6_ADDR:
+            return None
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    assert utils.query_rmt_servers(
+        [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+    ) == ('PAYG', IPV4_ADDR)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_ipv6_first(mock_request):
+    """Test IPv4 servers are only queried after the IPv6 stagger delay."""
+    mock_request.return_value = 'BYOS'
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 5):
+        assert utils.query_rmt_servers(
+            [IPV4_ADDR, IPV6_ADDR], 'foo', 'bar'
+        ) == ('BYOS', IPV6_ADDR)
+    assert mock_request.call_args_list[0][0][0] == IPV6_ADDR
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_cancel_pending(mock_request):
+    """Test the queries in flight are cancelled once a server answered."""
+    cancel_events = []
+
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        cancel_events.append(cancel_event)
+        if rmt_ip_addr == IPV6_ADDR:
+            cancel_event.wait(5)
+            return None
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 0):
+        assert utils.query_rmt_servers(
+            [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+        ) == ('PAYG', IPV4_ADDR)
+    assert all(event.is_set() for event in cancel_events)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_unknown_flavour(mock_request):
+    """Test a server answering an unknown flavour does not win."""
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        if rmt_ip_addr == IPV6_ADDR:
+            return 'garbage'
+        time.sleep(0.1)
+        return 'PAYG'
+
+    mock_request.side_effect = request
+    with patch.object(utils, 'IPV4_STAGGER_DELAY', 0):
+        assert utils.query_rmt_servers(
+            [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+        ) == ('PAYG', IPV4_ADDR)
+    mock_request.side_effect = None
+    mock_request.return_value = 'garbage'
+    assert utils.query_rmt_servers(
+        [IPV6_ADDR, IPV4_ADDR], 'foo', 'bar'
+    ) == (None, None)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_no_answer(mock_request):
+    """Test no flavour when no server answers."""
+    mock_request.return_value = None
+    assert utils.query_rmt_servers(
+        ['[{}]'.format(IPV6_ADDR), IPV4_ADDR], 'foo', 'bar'
+    ) == (None, None)
+    assert mock_request.call_count == 2
+
+
+def test_send_check_get_fallback_timeout():
+    """Test the GET after a rejected POST only gets the time left."""
+    session = Mock()
+    session.post.return_value = Mock(status_code=405)
+    deadline = time.monotonic() + 1.5
+    with patch.object(utils, '_post_unsupported', {}), \
+            patch.object(utils.time, 'monotonic', return_value=deadline - 1):
+        utils._send_check(
+            session, IPV4_ADDR, 'https://foo', 'q', b'body', 1.5, {},
+            deadline=deadline
+        )
+    assert session.post.call_args[1]['timeout'] == 1.5
+    assert session.get.call_args[1]['timeout'] == 1
+
+
+def test_send_check_get_fallback_expired():
+    """Test no GET is sent once the POST used up the time left."""
+    session = Mock()
+    session.post.return_value = Mock(status_code=405)
+    deadline = time.monotonic()
+    with patch.object(utils, '_post_unsupported', {}):
+        with raises(exceptions.Timeout):
+            utils._send_check(
+                session, IPV4_ADDR, 'https://foo', 'q', b'body', 1, {},
+                deadline=deadline
+            )
+    assert not session.get.called
+
+
+@patch('instance_billing_flavor_check.utils.time.sleep')
+@patch('requests.Session.get')
+def test_make_request_cancelled(mock_request_get, mock_sleep):
+    """Test no further attempt is made once the request is cancelled."""
+    cancel_event = threading.Event()
+    mock_request_get.side_effect = exceptions.Timeout('foo')
+    cancel_event.set()
+    assert utils.make_request(
+        IPV4_ADDR, 'foo', 'bar', cancel_event=cancel_event
+    ) is None
+    assert not mock_request_get.called
+    assert not mock_sleep.called
+
+
+@patch('instance_billing_flavor_check.utils.time.sleep')
+@patch('requests.Session.get')
+def test_make_request_backoff(mock_request_get, mock_sleep):
+    """Test the wait between attempts grows and the last one is not waited."""
+    mock_request_get.side_effect = exceptions.Timeout('foo')
+    with patch.object(utils, '_get_proxies', return_value=None):
+        assert utils.make_request(IPV4_ADDR, 'foo', 'bar') is None
+    assert mock_request_get.call_count == 3
+    waits = [c[0][0] for c in mock_sleep.call_args_list]
+    assert len(waits) == 2
+    assert 0.5 <= waits[0] <= 1
+    assert 1 <= waits[1] <= 2
+
+
+def test_get_backoff_capped_by_deadline():
+    """Test the backoff never goes past the deadline."""
+    deadline = time.monotonic() + 0.1
+    assert utils._get_backoff(4, deadline) <= 0.1
+    assert 4 <= utils._get_backoff(4) <= 8
+    assert 4 <= utils._get_backoff(10) <= 8
+
+
+@patch('requests.Session.get')
+def test_make_request_deadline(mock_request_get, caplog):
+    """Test a request attempt does not run past the deadline."""
+    def get(url, timeout, **kwargs):
+        time.sleep(timeout)
+        raise exceptions.Timeout('foo')
+
+    mock_request_get.side_effect = get
+    deadline = time.monotonic() + 0.2
+    assert utils.make_request(
+        IPV4_ADDR, 'foo', 'bar', deadline=deadline
+    ) is None
+    assert time.monotonic() - deadline < 0.1
+    assert mock_request_get.call_args_list[0][1]['timeout'] <= 0.2
+    assert 'the check ran out of time' in caplog.text
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_query_rmt_servers_deadline(mock_request):
+    """Test no server answering in time cancels the queries."""
+    cancel_events = []
+
+    def request(rmt_ip_addr, metadata, identifier, cancel_event, **kwargs):
+        cancel_events.append(cancel_event)
+        cancel_event.wait(5)
+
+    mock_request.side_effect = request
+    assert utils.query_rmt_servers(
+        [IPV4_ADDR], 'foo', 'bar', deadline=time.monotonic() + 0.1
+    ) == (None, None)
+    assert cancel_events[0].is_set()
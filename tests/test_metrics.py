@@ -0,0 +1,132 @@
+import json
+import threading
+
+from instance_billing_flavor_check import metrics
+
+
+def _check_timings(duration=0.3, server='1.1.1.1'):
+    timings = metrics.Timings()
+    timings.add('check', 0, duration)
+    timings.add('request', 0, 0.07, {'server': server, 'outcome': 200})
+    timings.count('cache_miss')
+    timings.count('retries', 2)
+    timings.result = ('PAYG', 10)
+    return timings
+
+
+def test_span_records_attributes():
+    timings = metrics.Timings()
+    with timings.span('request', server='1.1.1.1') as span:
+        span['outcome'] = 200
+    assert len(timings.spans) == 1
+    assert timings.spans[0]['name'] == 'request'
+    assert timings.spans[0]['server'] == '1.1.1.1'
+    assert timings.spans[0]['outcome'] == 200
+    assert timings.spans[0]['duration'] >= 0
+
+
+def test_use_installs_recorder():
+    timings = metrics.Timings()
+    with metrics.span('dropped'):
+        pass
+    metrics.count('dropped')
+    previous = metrics.use(timings)
+    try:
+        with metrics.span('identifier'):
+            pass
+        metrics.count('cache_miss')
+    finally:
+        metrics.use(previous)
+    with metrics.span('dropped'):
+        pass
+    assert previous is None
+    assert [span['name'] for span in timings.spans] == ['identifier']
+    assert timings.counters == {'cache_miss': 1}
+
+
+def test_bind_keeps_recorder_of_check():
+    first = metrics.Timings()
+    second = metrics.Timings()
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def request():
+        started.set()
+        proceed.wait(5)
+        metrics.count('retries')
+
+    previous = metrics.use(first)
+    try:
+        # a request thread left running by the first check
+        thread = threading.Thread(target=metrics.bind(request))
+        thread.start()
+    finally:
+        metrics.use(previous)
+    started.wait(5)
+    previous = metrics.use(second)
+    try:
+        proceed.set()
+        thread.join()
+        metrics.count('cache_miss')
+    finally:
+        metrics.use(previous)
+    assert first.counters == {'retries': 1}
+    assert second.counters == {'cache_miss': 1}
+
+
+def test_use_is_per_thread():
+    timings = metrics.Timings()
+    previous = metrics.use(timings)
+    try:
+        thread = threading.Thread(target=metrics.count, args=('dropped',))
+        thread.start()
+        thread.join()
+    finally:
+        metrics.use(previous)
+    assert timings.counters == {}
+
+
+def test_to_json():
+    result = json.loads(_check_timings().to_json())
+    assert result['flavor'] == 'PAYG'
+    assert result['code'] == 10
+    assert result['counters'] == {'cache_miss': 1, 'retries': 2}
+    assert [span['name'] for span in result['spans']] == ['check', 'request']
+
+
+def test_write_textfile_accumulates(tmp_path):
+    textfile = str(tmp_path / 'flavor.prom')
+    state = str(tmp_path / 'metrics.state')
+    metrics.write_textfile(_check_timings(), textfile, state)
+    metrics.write_textfile(_check_timings(duration=3), textfile, state)
+    with open(textfile) as prom:
+        lines = prom.read().splitlines()
+    assert '# TYPE instance_flavor_check_checks_total counter' in lines
+    assert 'instance_flavor_check_checks_total{code="10"} 2' in lines
+    assert 'instance_flavor_check_cache_misses_total 2' in lines
+    assert 'instance_flavor_check_retries_total 4' in lines
+    assert (
+        'instance_flavor_check_requests_total'
+        '{outcome="200",server="1.1.1.1"} 2'
+    ) in lines
+    assert 'instance_flavor_check_duration_seconds_bucket{le="0.5"} 1' in lines
+    assert 'instance_flavor_check_duration_seconds_bucket{le="5"} 2' in lines
+    assert 'instance_flavor_check_duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'instance_flavor_check_duration_seconds_count 2' in lines
+    assert (
+        'instance_flavor_check_request_duration_seconds_bucket'
+        '{server="1.1.1.1",le="0.1"} 2'
+    ) in lines
+    assert (
+        'instance_flavor_check_request_duration_seconds_count'
+        '{server="1.1.1.1"} 2'
+    ) in lines
+
+
+def test_write_textfile_unwritable(tmp_path, caplog):
+    metrics.write_textfile(
+        _check_timings(),
+        str(tmp_path / 'missing' / 'flavor.prom'),
+        str(tmp_path / 'metrics.state')
+    )
+    assert 'Could not write the metrics' in caplog.text
@@ -0,0 +1,127 @@
+import os
+import socket
+import threading
+
+from unittest.mock import patch
+from instance_billing_flavor_check import client, service, utils
+
+
+def _start_server(socket_path):
+    server = service.FlavorCheckServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_query_service(mock_check, tmp_path):
+    """Test the service answers and keeps a verified result."""
+    socket_path = str(tmp_path / 'flavor.sock')
+    mock_check.return_value = utils.FlavorResult('PAYG', 10, 'server')
+    server = _start_server(socket_path)
+    try:
+        assert client.query_service(socket_path) == ('PAYG', 10)
+        assert client.query_service(socket_path) == ('PAYG', 10)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert mock_check.call_count == 1
+    assert oct(os.stat(socket_path).st_mode & 0o777) == '0o600'
+
+
+@patch('instance_billing_flavor_check.service.RECHECK_INTERVAL', 0)
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_query_service_unreliable_result(mock_check, tmp_path):
+    """Test an unreliable result is checked again once expired."""
+    socket_path = str(tmp_path / 'flavor.sock')
+    mock_check.side_effect = [
+        utils.FlavorResult('BYOS', 12, 'fallback'),
+        utils.FlavorResult('BYOS', 11, 'server')
+    ]
+    server = _start_server(socket_path)
+    try:
+        assert client.query_service(socket_path) == ('BYOS', 12)
+        assert client.query_service(socket_path) == ('BYOS', 11)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_query_service_silent_client(mock_check, tmp_path):
+    """Test a client not sending its query does not hold a thread."""
+    socket_path = str(tmp_path / 'flavor.sock')
+    mock_check.return_value = utils.FlavorResult('PAYG', 10, 'server')
+    with patch.object(service.FlavorCheckHandler, 'timeout', 0.2):
+        server = _start_server(socket_path)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as silent:
+                silent.settimeout(5)
+                silent.connect(socket_path)
+                assert silent.recv(1) == b''
+            assert client.query_service(socket_path) == ('PAYG', 10)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_listen_socket(tmp_path):
+    """Test the socket passed in is listened on, no other one is left."""
+    socket_path = str(tmp_path / 'flavor.sock')
+    listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listen_socket.bind(socket_path)
+    listen_socket.listen(1)
+    with patch.object(service.socket.socket, 'close', autospec=True) \
+            as mock_close:
+        server = service.FlavorCheckServer(socket_path, listen_socket)
+    assert server.socket is listen_socket
+    assert mock_close.call_count == 1
+    assert mock_close.call_args[0][0] is not listen_socket
+    server.server_close()
+
+
+def test_query_service_not_running(tmp_path):
+    """Test no answer without the service."""
+    assert client.query_service(str(tmp_path / 'missing.sock')) is None
+
+
+def test_query_service_bad_answer(tmp_path):
+    """Test no answer when the service sends garbage."""
+    socket_path = str(tmp_path / 'flavor.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def answer():
+        connection, _ = listener.accept()
+        connection.sendall(b'foo\n')
+        connection.close()
+
+    thread = threading.Thread(target=answer, daemon=True)
+    thread.start()
+    try:
+        assert client.query_service(socket_path) is None
+    finally:
+        listener.close()
+
+
+def test_get_activation_socket_not_activated():
+    """Test no socket without socket activation."""
+    with patch.dict(os.environ, {'LISTEN_PID': '1', 'LISTEN_FDS': '1'}):
+        assert service.get_activation_socket() is None
+    with patch.dict(
+        os.environ, {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '0'}
+    ):
+        assert service.get_activation_socket() is None
+
+
+@patch('instance_billing_flavor_check.service.socket.socket')
+def test_get_activation_socket(mock_socket):
+    """Test the socket passed by systemd is used."""
+    with patch.dict(
+        os.environ, {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '1'}
+    ):
+        assert service.get_activation_socket() == mock_socket.return_value
+    mock_socket.assert_called_once_with(
+        socket.AF_UNIX, socket.SOCK_STREAM, fileno=3
+    )
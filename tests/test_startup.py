@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+
+from unittest.mock import patch
+from instance_billing_flavor_check import utils
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'lib')
+# Import time budget of the utils module in microseconds, generous on
+# purpose to be stable on loaded build hosts
+IMPORT_BUDGET_US = 150000
+HEAVY_MODULES = ['requests', 'lxml', 'urllib3', 'cloudregister', 'asyncio']
+
+
+def _import_utils():
+    code = (
+        'import json, logging, sys\n'
+        'import instance_billing_flavor_check.utils\n'
+        'print(json.dumps({\n'
+        '    "modules": sorted(sys.modules),\n'
+        '    "handlers": len(logging.getLogger().handlers)\n'
+        '}))\n'
+    )
+    env = dict(os.environ, PYTHONPATH=LIB_PATH)
+    return subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        check=True
+    )
+
+
+def test_import_utils_is_light():
+    """Test importing utils pulls in no heavy module and sets up nothing."""
+    result = json.loads(_import_utils().stdout.decode())
+    for module in HEAVY_MODULES:
+        assert module not in result['modules']
+    assert result['handlers'] == 0
+
+
+def test_import_utils_budget():
+    """Test the import time of utils stays within the budget."""
+    cumulative = None
+    for line in _import_utils().stderr.decode().splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and \
+                fields[2].strip() == 'instance_billing_flavor_check.utils':
+            cumulative = int(fields[1])
+    assert cumulative is not None
+    assert cumulative < IMPORT_BUDGET_US
+
+
+def test_fresh_cache_check_is_light(tmp_path):
+    """Test answering from a fresh cache imports no heavy module."""
+    paths = {
+        'REGION_SRV_CLIENT_CONFIG_PATH': str(tmp_path / 'regionserverclnt.cfg'),
+        'BASEPRODUCT_PATH': str(tmp_path / 'baseproduct'),
+        'METADATA_CACHE_FILE_PATH': str(tmp_path / 'cache.metadata'),
+        'IDENTIFIER_CACHE_FILE_PATH': str(tmp_path / 'cache.identifier'),
+        'CACHE_FILE_PATH': str(tmp_path / 'cache'),
+    }
+    (tmp_path / 'regionserverclnt.cfg').write_text(
+        '[instance]\ndataProvider = /bin/true\n'
+    )
+    (tmp_path / 'baseproduct').write_text('<product/>')
+    # the caches left behind by a previous check
+    with patch.multiple(utils, **paths):
+        utils._write_metadata_cache('/bin/true', '<document/>')
+        utils._write_identifier_cache(
+            utils._get_file_signature(paths['BASEPRODUCT_PATH']), 'SLES'
+        )
+        utils._write_cache(
+            'PAYG', code=10, digest=utils._get_digest('<document/>', 'SLES')
+        )
+    code = (
+        'import json, sys\n'
+        'from instance_billing_flavor_check import utils\n'
+        'for name, path in json.loads(sys.argv[1]).items():\n'
+        '    setattr(utils, name, path)\n'
+        'print(json.dumps({\n'
+        '    "result": utils.check_payg_byos(),\n'
+        '    "modules": sorted(sys.modules)\n'
+        '}))\n'
+    )
+    env = dict(os.environ, PYTHONPATH=LIB_PATH)
+    result = json.loads(subprocess.run(
+        [sys.executable, '-c', code, json.dumps(paths)],
+        stdout=subprocess.PIPE,
+        env=env,
+        check=True
+    ).stdout.decode())
+    assert result['result'] == ['PAYG', 10]
+    for module in HEAVY_MODULES:
+        assert module not in result['modules']
@@ -0,0 +1,103 @@
+import gzip
+import logging
+import shutil
+
+from pytest import fixture, mark
+from unittest.mock import patch
+from instance_billing_flavor_check import utils
+
+from rmt_stub import RMTStub
+
+LOCALHOST = '127.0.0.1'
+METADATA = '<document>{}</document>'.format('signed instance data ' * 200)
+
+pytestmark = mark.skipif(
+    not shutil.which('openssl'), reason='openssl needed for the stand-in'
+)
+
+
+@fixture
+def rmt_stub_factory():
+    stubs = []
+
+    def start(**kwargs):
+        stub = RMTStub(**kwargs).__enter__()
+        stubs.append(stub)
+        return stub
+
+    with patch.object(utils, '_post_unsupported', {}), \
+            patch.object(utils, '_get_proxies', return_value={}):
+        yield start
+    for stub in stubs:
+        stub.__exit__()
+
+
+def test_make_request_get(rmt_stub_factory):
+    """Test the instance check sent with GET."""
+    stub = rmt_stub_factory(flavor='BYOS')
+    with patch.object(utils, 'RMT_HTTPS_PORT', stub.port):
+        assert utils.make_request(LOCALHOST, METADATA, 'sles') == 'BYOS'
+    method, params, _ = stub.requests[0]
+    assert method == 'GET'
+    assert params == {'metadata': METADATA, 'identifier': 'sles'}
+
+
+def test_make_request_compressed_post(rmt_stub_factory, caplog):
+    """Test the instance check sent as compressed POST."""
+    stub = rmt_stub_factory(post=True)
+    caplog.set_level(logging.DEBUG)
+    with patch.object(utils, 'RMT_HTTPS_PORT', stub.port):
+        assert utils.make_request(
+            LOCALHOST, METADATA, 'sles', mode='post'
+        ) == 'PAYG'
+    method, params, size = stub.requests[0]
+    assert method == 'POST'
+    assert params == {'metadata': METADATA, 'identifier': 'sles'}
+    query = utils._get_query(METADATA, 'sles')
+    assert size == len(gzip.compress(query.encode()))
+    assert size < len(query)
+    assert '{} bytes saved'.format(len(query) - size) in caplog.text
+
+
+def test_make_request_post_fallback(rmt_stub_factory):
+    """Test servers not supporting POST are sent GET from then on."""
+    stub = rmt_stub_factory(post=False)
+    with patch.object(utils, 'RMT_HTTPS_PORT', stub.port):
+        assert utils.make_request(
+            LOCALHOST, METADATA, 'sles', mode='post'
+        ) == 'PAYG'
+        assert utils.make_request(
+            LOCALHOST, METADATA, 'sles', mode='post'
+        ) == 'PAYG'
+    assert [request[0] for request in stub.requests] == ['GET', 'GET']
+    assert LOCALHOST in utils._post_unsupported
+
+
+def test_make_request_post_retried(rmt_stub_factory):
+    """Test POST is tried again once the retry interval passed."""
+    stub = rmt_stub_factory(post=True)
+    utils._post_unsupported[LOCALHOST] = 0
+    with patch.object(utils, 'RMT_HTTPS_PORT', stub.port), \
+            patch.object(utils, 'POST_RETRY_INTERVAL', 0):
+        assert utils.make_request(
+            LOCALHOST, METADATA, 'sles', mode='post'
+        ) == 'PAYG'
+    assert [request[0] for request in stub.requests] == ['POST']
+    assert LOCALHOST not in utils._post_unsupported
+
+
+def test_make_request_server_error(rmt_stub_factory):
+    """Test no flavour when the server fails the check."""
+    stub = rmt_stub_factory(status=500)
+    with patch.object(utils, 'RMT_HTTPS_PORT', stub.port):
+        assert utils.make_request(LOCALHOST, METADATA, 'sles') is None
+
+
+@patch('instance_billing_flavor_check.utils._get_config_string')
+def test_get_request_mode(mock_config_string, caplog):
+    """Test the configured request mode is used if known."""
+    mock_config_string.return_value = 'POST'
+    assert utils._get_request_mode() == 'post'
+    mock_config_string.return_value = 'carrier-pigeon'
+    assert utils._get_request_mode() == 'get'
+    assert "Unknown requestMode 'carrier-pigeon'" in caplog.text
@@ -1,43 +1,114 @@
+import base64
+import json
+import logging
 import os
+import threading
+import time
 
+from pytest import fixture, raises
 from unittest import mock
-from unittest.mock import patch
-from instance_billing_flavor_check import utils
+from unittest.mock import patch, Mock
+from instance_billing_flavor_check import files, metrics, utils
 
 CACHE_FILE_PATH = '/tmp/instance-billing-flavor-check'
+utils.LOCK_FILE_PATH = '/tmp/instance-billing-flavor-check.lock'
+utils.HEALTH_FILE_PATH = '/tmp/instance-billing-flavor-check.health'
+utils.BUDGET_FILE_PATH = '/tmp/instance-billing-flavor-check.budget'
+utils.REFRESH_FILE_PATH = '/tmp/instance-billing-flavor-check.refresh'
+utils.CONNECTIVITY_CACHE_TTL = 0
 FAKE_PROXY = {'http_proxy': 'foo', 'https_proxy': 'bar', 'no_proxy': 'foobar'}
 
+
+@fixture(autouse=True)
+def connectivity_cache(tmp_path):
+    """Keep the network access probed by a test to the test."""
+    utils._network_access_cache.clear()
+    with patch.object(
+        utils, 'CONNECTIVITY_CACHE_FILE_PATH', str(tmp_path / 'connectivity')
+    ):
+        yield
+    utils._network_access_cache.clear()
+
+
 @patch.dict(os.environ, FAKE_PROXY, clear=True)
 def test_get_proxies():
     """Test proxy settings are the same as environment, if any."""
     assert not utils._get_proxies()
 
 
-def test_get_proxies_no_proxy_env_no_proxy_file():
-    """Test proxy value is the same as set on the proxy file."""
-    with patch('builtins.open', create=True) as mock_open:
-        mock_open.side_effect = FileNotFoundError('oh no')
+def test_get_proxies_no_proxy_env_no_proxy_file(tmp_path):
+    """Test there are no proxies without proxy file."""
+    with patch.object(utils, 'PROXY_CONFIG_PATH', str(tmp_path / 'proxy')):
         assert not utils._get_proxies()
 
 
-
-def test_get_proxies_no_proxy_env_proxy_file(caplog):
+@patch.dict(os.environ, {}, clear=True)
+def test_get_proxies_no_proxy_env_proxy_file(tmp_path):
     """Test proxy value is the same as set on the file."""
-    with patch('builtins.open', create=True) as mock_open:
-        proxy_content = """
+    proxy_file = tmp_path / 'proxy'
+    proxy_file.write_text("""
+        ## Type: string
+        # Example: HTTP_PROXY="http://proxy.example.com:3128/"
         HTTP_PROXY="http://foo.com"
         HTTPS_PROXY="https://foo.com"
+        FTP_PROXY=""
         NO_PROXY="localhost, 127.0.0.1"
-        """
-        with mock.patch(
-            'builtins.open',
-            mock.mock_open(read_data=proxy_content)
-        ):
-            assert utils._get_proxies() == {
-                'http_proxy': 'http://foo.com',
-                'https_proxy': 'https://foo.com',
-                'no_proxy': 'localhost, 127.0.0.1'
-            }
+        """)
+    with patch.object(utils, 'PROXY_CONFIG_PATH', str(proxy_file)):
+        assert utils._get_proxies() == {
+            'http_proxy': 'http://foo.com',
+            'https_proxy': 'https://foo.com',
+            'no_proxy': 'localhost, 127.0.0.1'
+        }
+        # the parsed file is shared, the proxies handed out are copies
+        utils._get_proxies().clear()
+        assert utils._get_proxies()['http_proxy'] == 'http://foo.com'
+
+
+@patch.dict(os.environ, {}, clear=True)
+def test_get_proxies_disabled(tmp_path):
+    """Test there are no proxies if disabled in the file."""
+    proxy_file = tmp_path / 'proxy'
+    proxy_file.write_text(
+        'HTTP_PROXY="http://foo.com"\nPROXY_ENABLED="no"\n'
+    )
+    with patch.object(utils, 'PROXY_CONFIG_PATH', str(proxy_file)):
+        assert utils._get_proxies() is None
+
+
+def test_get_config_snapshot(tmp_path, caplog):
+    """Check the configuration is only read again once it changed"""
+    config = tmp_path / 'regionserverclnt.cfg'
+    config.write_text(
+        '[instance]\ndataProvider = /usr/bin/azuremetadata\n'
+        '[flavorCheck]\ncacheTTL = 60\ntimings = yes\ntimeout = foo\n'
+    )
+    with patch.object(utils, 'REGION_SRV_CLIENT_CONFIG_PATH', str(config)):
+        assert utils.get_instance_data_command() == '/usr/bin/azuremetadata'
+        with patch('builtins.open') as mock_open:
+            assert utils._get_config_float('cacheTTL', 3600) == 60
+            assert utils._get_config_float('metadataCacheTTL', 3600) == 3600
+            assert utils._get_config_float('timeout', 0) == 0
+            assert utils._get_config_boolean('timings', False) is True
+            assert utils._get_config_string('requestMode', 'get') == 'get'
+            assert not mock_open.called
+        assert 'Could not parse' in caplog.text
+
+        config.write_text('[flavorCheck]\ncacheTTL = 120\n')
+        assert utils._get_config_float('cacheTTL', 3600) == 120
+        assert utils.get_instance_data_command() is None
+
+
+def test_get_config_snapshot_broken(tmp_path, caplog):
+    """Check a broken or missing configuration is logged"""
+    config = tmp_path / 'regionserverclnt.cfg'
+    with patch.object(utils, 'REGION_SRV_CLIENT_CONFIG_PATH', str(config)):
+        assert utils.get_instance_data_command() is None
+        assert 'Could not read file' in caplog.text
+        config.write_text('dataProvider = foo\n')
+        assert utils.get_instance_data_command() is None
+        assert utils._get_config_float('cacheTTL', 3600) == 3600
+        assert 'File contains no section headers' in caplog.text
 
 
 def test_check_payg_byos_no_network():
@@ -48,7 +119,7 @@ def test_check_payg_byos_no_network():
     result = utils.check_payg_byos()
     assert(result[0] == 'BYOS')
     assert(result[1] == 12)
-    assert(open(CACHE_FILE_PATH).read() == 'BYOS')
+    assert(_cached_flavour() == 'BYOS')
     os.unlink(CACHE_FILE_PATH)
 
 
@@ -66,7 +137,7 @@ def test_check_payg_byos_no_instance_data(
     result = utils.check_payg_byos()
     assert(result[0] == 'BYOS')
     assert(result[1] == 12)
-    assert(open(CACHE_FILE_PATH).read() == 'BYOS')
+    assert(_cached_flavour() == 'BYOS')
     assert('No instance metadata and identifier' in caplog.text)
     os.unlink(CACHE_FILE_PATH)
 
@@ -87,7 +158,7 @@ def test_check_payg_byos_no_server_ip(
     result = utils.check_payg_byos()
     assert(result[0] == 'BYOS')
     assert(result[1] == 12)
-    assert(open(CACHE_FILE_PATH).read() == 'BYOS')
+    assert(_cached_flavour() == 'BYOS')
     assert('Instance can be either' in caplog.text)
     os.unlink(CACHE_FILE_PATH)
 
@@ -110,7 +181,7 @@ def test_check_payg_byos_is_payg(
     result = utils.check_payg_byos()
     assert(result[0] == 'PAYG')
     assert(result[1] == 10)
-    assert(open(CACHE_FILE_PATH).read() == 'PAYG')
+    assert(_cached_flavour() == 'PAYG')
     os.unlink(CACHE_FILE_PATH)
 
 
@@ -132,7 +203,7 @@ def test_check_payg_byos_is_byos(
     result = utils.check_payg_byos()
     assert(result[0] == 'BYOS')
     assert(result[1] == 11)
-    assert(open(CACHE_FILE_PATH).read() == 'BYOS')
+    assert(_cached_flavour() == 'BYOS')
     os.unlink(CACHE_FILE_PATH)
 
 
@@ -157,10 +228,956 @@ def test_check_payg_byos_use_cache(
     result = utils.check_payg_byos()
     assert(result[0] == 'PAYG')
     assert(result[1] == 10)
-    assert(open(CACHE_FILE_PATH).read() == 'PAYG')
+    assert(_cached_flavour() == 'PAYG')
+    os.unlink(CACHE_FILE_PATH)
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_sequential(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier, tmp_path
+):
+    """Check the servers are tried one after another when not concurrent"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _has_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1', '2.2.2.2']
+    mock_request.side_effect = [None, 'PAYG']
+    with patch.object(utils, 'HEALTH_FILE_PATH', str(tmp_path / 'health')):
+        result = utils.check_payg_byos(concurrent=False)
+    assert(result == ('PAYG', 10))
+    assert([c[0][0] for c in mock_request.call_args_list] == [
+        '1.1.1.1', '2.2.2.2'
+    ])
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_sequential_unknown_flavour(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier, tmp_path
+):
+    """Check the next server is tried after an unknown flavour answer"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _has_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1', '2.2.2.2']
+    mock_request.side_effect = ['garbage', 'BYOS']
+    with patch.object(utils, 'HEALTH_FILE_PATH', str(tmp_path / 'health')):
+        result = utils.check_payg_byos(concurrent=False)
+        assert(utils._read_health()['1.1.1.1']['failures'] == 1)
+    assert(result == ('BYOS', 11))
+    assert(mock_request.call_count == 2)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_health_order(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier, tmp_path
+):
+    """Check the server answering last time is asked first"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _has_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1', '2.2.2.2']
+    mock_request.side_effect = [None, 'PAYG', 'PAYG']
+    with patch.object(utils, 'HEALTH_FILE_PATH', str(tmp_path / 'health')):
+        utils.check_payg_byos(concurrent=False)
+        os.unlink(CACHE_FILE_PATH)
+        health = utils._read_health()
+        assert(health['1.1.1.1']['failures'] == 1)
+        assert(health['2.2.2.2']['failures'] == 0)
+        assert(utils.check_payg_byos(concurrent=False) == ('PAYG', 10))
+    assert([c[0][0] for c in mock_request.call_args_list] == [
+        '1.1.1.1', '2.2.2.2', '2.2.2.2'
+    ])
+    os.unlink(CACHE_FILE_PATH)
+
+
+def _network_state(tmp_path, route_use='0'):
+    route = tmp_path / 'route'
+    route.write_text(
+        'Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\n'
+        'eth0\t00000000\t010200C0\t0003\t0\t{}\t0\n'.format(route_use)
+    )
+    return patch.object(utils, 'NETWORK_STATE_FILES', (
+        (str(route), (4, 5)), (str(tmp_path / 'ipv6_route'), (6, 7))
+    ))
+
+
+def test_network_signature(tmp_path):
+    """Check the signature changes with the routes only"""
+    with _network_state(tmp_path):
+        signature = utils._get_network_signature()
+    with _network_state(tmp_path, route_use='42'):
+        assert(utils._get_network_signature() == signature)
+    (tmp_path / 'ipv6_route').write_text('fe80 40 eth0\n')
+    with _network_state(tmp_path):
+        assert(utils._get_network_signature() != signature)
+
+
+def test_get_network_access_cached(tmp_path):
+    """Check the network access is probed once per network state"""
+    probe_v4 = Mock(return_value=True)
+    probe_v6 = Mock(return_value=False)
+    utils._network_access_cache.clear()
+    with _network_state(tmp_path), patch.multiple(
+        utils,
+        CONNECTIVITY_CACHE_TTL=60,
+        CONNECTIVITY_CACHE_FILE_PATH=str(tmp_path / 'connectivity'),
+        has_ipv4_access=probe_v4,
+        has_ipv6_access=probe_v6
+    ):
+        access = utils._get_network_access()
+        assert(access == utils.NetworkAccess(ipv4=True, ipv6=False))
+        assert(utils._get_network_access() == access)
+        # a new process uses the cache on disk
+        utils._network_access_cache.clear()
+        assert(utils._get_network_access() == access)
+        assert(probe_v4.call_count == 1)
+        assert(probe_v6.call_count == 1)
+
+        (tmp_path / 'ipv6_route').write_text('fe80 40 eth0\n')
+        probe_v6.return_value = True
+        assert(utils._get_network_access() == (True, True))
+        assert(probe_v6.call_count == 2)
+
+
+def test_filter_by_network_access():
+    """Check only the reachable IP families are queried"""
+    rmt_ips_addr = ['fc00::1', '[fc00::2]', '1.1.1.1']
+    assert(utils._filter_by_network_access(
+        rmt_ips_addr, utils.NetworkAccess(ipv4=True, ipv6=False)
+    ) == ['1.1.1.1'])
+    assert(utils._filter_by_network_access(
+        rmt_ips_addr, utils.NetworkAccess(ipv4=False, ipv6=True)
+    ) == ['fc00::1', '[fc00::2]'])
+    assert(utils._filter_by_network_access(
+        ['fc00::1'], utils.NetworkAccess(ipv4=True, ipv6=False)
+    ) == ['fc00::1'])
+
+
+def test_order_by_health():
+    """Check servers are ordered by health, failing ones skipped"""
+    now = time.time()
+    health = {
+        '1.1.1.1': {'failures': 0, 'latency': 0.5},
+        '2.2.2.2': {'failures': 0, 'latency': 0.1},
+        '3.3.3.3': {'failures': 1, 'latency': 0.01, 'last_failure': now},
+        '4.4.4.4': {'failures': 3, 'last_failure': now},
+        '5.5.5.5': {'failures': 3, 'last_failure': now - 600},
+    }
+    assert(utils._order_by_health(
+        ['5.5.5.5', '4.4.4.4', '3.3.3.3', '6.6.6.6', '1.1.1.1', '2.2.2.2'],
+        health
+    ) == ['2.2.2.2', '1.1.1.1', '6.6.6.6', '3.3.3.3', '5.5.5.5'])
+    # all skipped, ask them anyway
+    assert(utils._order_by_health(['4.4.4.4'], health) == ['4.4.4.4'])
+
+
+def test_update_health():
+    """Check answer times are averaged and failures counted"""
+    health = {
+        '1.1.1.1': {'failures': 2, 'latency': 1.0, 'last_failure': 1},
+        'gone': {'failures': 0, 'latency': 1.0, 'last_success': 1},
+    }
+    utils._update_health(health, {'1.1.1.1': 0.0, '2.2.2.2': None})
+    assert(health['1.1.1.1']['failures'] == 0)
+    assert(health['1.1.1.1']['latency'] == 1 - utils.HEALTH_LATENCY_WEIGHT)
+    assert(health['2.2.2.2']['failures'] == 1)
+    assert('gone' not in health)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_timings(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier
+):
+    """Check the phases of the check are timed into the given timings"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1']
+    mock_request.return_value = 'PAYG'
+    timings = metrics.Timings()
+    result = utils.check_payg_byos(timings=timings)
+    assert(result == ('PAYG', 10))
+    assert(timings.result == ('PAYG', 10))
+    assert(timings.counters == {'cache_miss': 1})
+    assert([span['name'] for span in timings.spans] == [
+        'cache', 'lock', 'network_access', 'identifier', 'rmt_ip_addr',
+        'metadata', 'query', 'write_cache', 'check'
+    ])
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_instance_digest',
+    Mock(return_value='foo')
+)
+def test_check_payg_byos_timings_configured(tmp_path, caplog):
+    """Check the configured timings are logged and exported"""
+    config = tmp_path / 'regionserverclnt.cfg'
+    textfile = tmp_path / 'flavor.prom'
+    config.write_text(
+        '[flavorCheck]\ntimings = yes\nmetricsFile = {}\n'.format(textfile)
+    )
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    with patch.object(
+        utils, 'REGION_SRV_CLIENT_CONFIG_PATH', str(config)
+    ), patch.object(
+        utils, 'METRICS_STATE_PATH', str(tmp_path / 'metrics')
+    ), caplog.at_level('INFO'):
+        result = utils.check_payg_byos()
+    assert(result == ('PAYG', 10))
+    assert('Timings: {' in caplog.text)
+    assert(
+        'instance_flavor_check_cache_hits_total 1' in textfile.read_text()
+    )
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_single_flight(mock_request, mock_metadata):
+    """Check a check waits for a concurrent one and uses its answer"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('BYOS')
+    locked = threading.Event()
+
+    def concurrent_check():
+        with files.exclusive_lock(utils.LOCK_FILE_PATH):
+            locked.set()
+            time.sleep(0.2)
+            utils._write_cache('BYOS', code=12)
+
+    concurrent = threading.Thread(target=concurrent_check)
+    concurrent.start()
+    locked.wait()
+    result = utils.check_payg_byos()
+    concurrent.join()
+    assert(result == ('BYOS', 12))
+    assert(not mock_metadata.called)
+    assert(not mock_request.called)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_lock_timeout(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier, caplog
+):
+    """Check the cache is used when a concurrent check takes too long"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG')
+    with files.exclusive_lock(utils.LOCK_FILE_PATH):
+        result = utils.check_payg_byos(timeout=0.1)
+    assert(result == ('BYOS', 12))
+    assert(not mock_request.called)
+    assert('waiting for another check' in caplog.text)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_instance_digest',
+    Mock(return_value='foo')
+)
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_check_payg_byos_fresh_cache(mock_metadata):
+    """Check a fresh cache record is used without any network access"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    result = utils.check_payg_byos()
+    assert(result == ('PAYG', 10))
+    assert(not mock_metadata.called)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_get_fresh_cache_value_other_instance(mock_metadata):
+    """Check a cache record of other metadata or identifier is not used"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    with patch.object(utils, '_get_instance_digest', return_value='bar'):
+        assert(utils._get_fresh_cache_value() is None)
+    with patch.object(utils, '_get_instance_digest', return_value=None):
+        assert(utils._get_fresh_cache_value() is None)
+    assert(not mock_metadata.called)
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_get_instance_digest(tmp_path):
+    """Check the digest is taken from the cached metadata"""
+    config = tmp_path / 'regionserverclnt.cfg'
+    config.write_text('[instance]\ndataProvider = /bin/true\n')
+    with patch.object(
+        utils, 'REGION_SRV_CLIENT_CONFIG_PATH', str(config)
+    ), patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ), patch.object(utils, 'get_identifier', return_value='SLES'):
+        assert(utils._get_instance_digest() is None)
+        utils._write_metadata_cache('/bin/true', '<document/>')
+        assert(
+            utils._get_instance_digest() ==
+            utils._get_digest('<document/>', 'SLES')
+        )
+
+
+@patch(
+    'instance_billing_flavor_check.utils._get_instance_digest',
+    Mock(return_value='foo')
+)
+@patch('instance_billing_flavor_check.utils.CACHE_REFRESH_AGE', 0.001)
+@patch('instance_billing_flavor_check.utils.subprocess.Popen')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_check_payg_byos_refresh_ahead(mock_metadata, mock_popen):
+    """Check an aging cache record is used and refreshed in the background"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    time.sleep(0.01)
+    timings = metrics.Timings()
+    assert(utils.check_payg_byos(timings=timings) == ('PAYG', 10))
+    assert(not mock_metadata.called)
+    assert(mock_popen.call_args[0][0] == utils.REFRESH_COMMAND)
+    assert(timings.counters['refresh_ahead'] == 1)
+    # a check holding the lock refreshes the cache already
+    mock_popen.reset_mock()
+    with files.exclusive_lock(utils.LOCK_FILE_PATH):
+        assert(utils.check_payg_byos() == ('PAYG', 10))
+    assert(not mock_popen.called)
+    # nor while the started refresh is in flight
+    assert(utils.check_payg_byos() == ('PAYG', 10))
+    assert(not mock_popen.called)
+    os.unlink(utils.REFRESH_FILE_PATH)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.subprocess.Popen')
+def test_start_refresh_once(mock_popen):
+    """Check callers at the same time start a single refresh"""
+    threads = [
+        threading.Thread(target=utils._start_refresh) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(mock_popen.call_count == 1)
+    requested = utils._get_refresh_requested()
+    assert(requested is not None)
+    # a refresh that died is replaced after the timeout
+    with patch.object(utils, 'REFRESH_TIMEOUT', 0):
+        assert(utils._get_refresh_requested() is None)
+        utils._start_refresh()
+    assert(mock_popen.call_count == 2)
+    os.unlink(utils.REFRESH_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_refresh_done_already(mock_request):
+    """Check a refresh does not ask again for a record renewed since"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    files.write_atomic(utils.REFRESH_FILE_PATH, str(time.time()))
+    utils._write_cache('BYOS', code=11, server='1.1.1.1')
+    result = utils.FlavorChecker().check(refresh=True)
+    assert(tuple(result) == ('BYOS', 11))
+    assert(result.source == 'cache')
+    assert(not mock_request.called)
+    assert(not os.path.exists(utils.REFRESH_FILE_PATH))
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.subprocess.Popen')
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_refresh(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier, mock_popen
+):
+    """Check a refresh asks the update server despite a fresh cache"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1']
+    mock_request.return_value = 'BYOS'
+    assert(utils.check_payg_byos(refresh=True) == ('BYOS', 11))
+    assert(utils._read_cache()['flavor'] == 'BYOS')
+    assert(not mock_popen.called)
+    os.unlink(CACHE_FILE_PATH)
+
+@patch('instance_billing_flavor_check.utils.QUERY_BUDGET', 2)
+@patch('instance_billing_flavor_check.utils.QUERY_BUDGET_WINDOW', 100)
+def test_take_query_budget(tmp_path):
+    """Check the budget is spent and refilled over time"""
+    budget_path = str(tmp_path / 'budget')
+    with patch.object(utils, 'BUDGET_FILE_PATH', budget_path):
+        assert(utils._take_query_budget())
+        assert(utils._take_query_budget())
+        assert(not utils._take_query_budget())
+        with open(budget_path) as budget_file:
+            state = json.load(budget_file)
+        state['timestamp'] -= 50
+        files.write_atomic(budget_path, json.dumps(state))
+        assert(utils._take_query_budget())
+        assert(not utils._take_query_budget())
+
+
+@patch('instance_billing_flavor_check.utils._take_query_budget')
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_budget_spent(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier,
+        mock_take_budget
+):
+    """Check the cached flavour is used once the budget is spent"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=12)
+    mock_identifier.return_value = True
+    mock_metadata.return_value = True
+    mock_rmt_ip.return_value = ['1.1.1.1']
+    mock_take_budget.return_value = False
+    timings = metrics.Timings()
+    assert(utils.check_payg_byos(timings=timings) == ('BYOS', 12))
+    assert(not mock_request.called)
+    assert(timings.counters['budget_spent'] == 1)
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_get_startup_jitter():
+    """Check the jitter is opt-in and bounded by the deadline"""
+    assert(utils._get_startup_jitter() == 0)
+    with patch.object(utils, 'STARTUP_JITTER', 10):
+        assert(0 <= utils._get_startup_jitter() <= 10)
+        assert(utils._get_startup_jitter(time.monotonic() + 1) <= 0.5)
+
+@patch(
+    'instance_billing_flavor_check.utils._get_instance_digest',
+    Mock(return_value='foo')
+)
+@patch('instance_billing_flavor_check.utils.get_metadata')
+def test_flavor_checker_fresh_cache(mock_metadata):
+    """Check the checker tells a cached answer and where it came from"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10, server='1.1.1.1', digest='foo')
+    result = utils.FlavorChecker().check()
+    assert(tuple(result) == ('PAYG', 10))
+    assert(result.source == 'cache')
+    assert(result.server == '1.1.1.1')
+    assert(result.verified)
+    assert(result.elapsed >= 0)
+    assert(not mock_metadata.called)
     os.unlink(CACHE_FILE_PATH)
 
-    
+
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_flavor_checker_keeps_result(mock_check):
+    """Check results are kept in memory until they expire"""
+    mock_check.side_effect = [
+        utils.FlavorResult('PAYG', 10, 'server', server='1.1.1.1'),
+        utils.FlavorResult('BYOS', 12, 'fallback'),
+        utils.FlavorResult('BYOS', 11, 'server', server='1.1.1.1'),
+        utils.FlavorResult('BYOS', 11, 'server', server='2.2.2.2'),
+    ]
+    checker = utils.FlavorChecker(recheck_interval=0)
+    result = checker.check()
+    assert(result.source == 'server')
+    result = checker.check()
+    assert(tuple(result) == ('PAYG', 10))
+    assert(result.source == 'cache')
+    assert(result.server == '1.1.1.1')
+    assert(mock_check.call_count == 1)
+    # unreliable results are checked again after the recheck interval
+    checker.invalidate()
+    assert(checker.check().source == 'fallback')
+    result = checker.check()
+    assert(tuple(result) == ('BYOS', 11))
+    assert(result.source == 'server')
+    assert(checker.check().source == 'cache')
+    assert(checker.check(refresh=True).server == '2.2.2.2')
+    assert(mock_check.call_count == 4)
+
+
+@patch('instance_billing_flavor_check.utils.CACHE_TTL', 100)
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_flavor_checker_keeps_result_until_record_expires(mock_check):
+    """Check a cached answer is kept until its cache record expires"""
+    mock_check.side_effect = [
+        utils.FlavorResult(
+            'PAYG', 10, 'cache', timestamp=time.time() - 99.9
+        ),
+        utils.FlavorResult('PAYG', 10, 'fallback'),
+        utils.FlavorResult('PAYG', 10, 'server', timestamp=time.time()),
+    ]
+    checker = utils.FlavorChecker(recheck_interval=0)
+    assert(checker.check().source == 'cache')
+    time.sleep(0.2)
+    # the record expired, a verified fallback is kept like an unreliable one
+    assert(checker.check().source == 'fallback')
+    assert(checker.check().source == 'server')
+    assert(checker.check().source == 'cache')
+    assert(mock_check.call_count == 3)
+
+
+@patch('instance_billing_flavor_check.utils.CACHE_REFRESH_AGE', 10)
+@patch('instance_billing_flavor_check.utils._start_refresh')
+@patch('instance_billing_flavor_check.utils._get_fresh_cache_value')
+@patch('instance_billing_flavor_check.utils._check_payg_byos')
+def test_flavor_checker_refresh_ahead(
+        mock_check, mock_fresh_cache, mock_start_refresh
+):
+    """Check an aging result kept in memory is refreshed"""
+    mock_check.return_value = utils.FlavorResult(
+        'PAYG', 10, 'server', timestamp=time.time() - 20
+    )
+    mock_fresh_cache.return_value = None
+    checker = utils.FlavorChecker()
+    checker.check()
+    assert(checker.check().source == 'cache')
+    assert(mock_start_refresh.call_count == 1)
+    # the refreshed record replaces the result kept in memory
+    mock_fresh_cache.return_value = utils.FlavorResult(
+        'BYOS', 11, 'cache', timestamp=time.time()
+    )
+    assert(tuple(checker.check()) == ('BYOS', 11))
+    assert(tuple(checker.check()) == ('BYOS', 11))
+    assert(mock_start_refresh.call_count == 1)
+    assert(mock_check.call_count == 1)
+
+
+def test_flavor_result():
+    """Check the result unpacks to the flavor and code"""
+    flavour, code = utils.FlavorResult('BYOS', 12, 'fallback')
+    assert((flavour, code) == ('BYOS', 12))
+    assert(not utils.FlavorResult('BYOS', 12, 'fallback').verified)
+    assert('source=\'fallback\'' in repr(
+        utils.FlavorResult('BYOS', 12, 'fallback')
+    ))
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_expired_cache(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier
+):
+    """Check the update server is asked when the cache record expired"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    record = utils._write_cache('PAYG', code=10)
+    record['timestamp'] -= utils.CACHE_TTL + 1
+    _write_record(record)
+    mock_identifier.return_value = 'sles'
+    mock_metadata.return_value = 'foo'
+    mock_rmt_ip.return_value = ['1.1.1.1']
+    mock_request.return_value = 'BYOS'
+    result = utils.check_payg_byos()
+    assert(result == ('BYOS', 11))
+    record = json.load(open(CACHE_FILE_PATH))
+    assert(record['code'] == 11)
+    assert(record['server'] == '1.1.1.1')
+    assert(record['digest'] == utils._get_digest('foo', 'sles'))
+    assert(record['boot_id'] == utils._get_boot_id())
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_get_fresh_cache_value_other_boot():
+    """Check a cache record from another boot is not fresh"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    record = utils._write_cache('PAYG', code=10)
+    record['boot_id'] = 'foo'
+    _write_record(record)
+    assert(utils._get_fresh_cache_value() is None)
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_get_fresh_cache_value_unreliable():
+    """Check an unreliable cache record is not fresh"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('BYOS')
+    assert(utils._get_fresh_cache_value() is None)
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_get_fresh_cache_value_legacy():
+    """Check a cache holding only the flavour is read but not fresh"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    with open(CACHE_FILE_PATH, 'w') as cache:
+        cache.write('PAYG')
+    assert(utils._get_fresh_cache_value() is None)
+    assert(utils._get_cache_value() == 'PAYG')
+
+
+def test_use_cache_value(tmp_path):
+    """Check the fallback keeps the code the flavour was cached with"""
+    with patch.object(utils, 'CACHE_FILE_PATH', str(tmp_path / 'cache')):
+        utils._write_cache('PAYG', code=10)
+        result = utils._use_cache_value()
+        assert(tuple(result) == ('PAYG', 10))
+        assert(result.source == 'fallback')
+        utils._write_cache('BYOS')
+        assert(not utils._use_cache_value().verified)
+        # an unreliable flavour is BYOS
+        utils._write_cache('PAYG')
+        assert(tuple(utils._use_cache_value()) == ('BYOS', 12))
+        # records of version 0 only hold the flavour
+        (tmp_path / 'cache').write_text('PAYG')
+        assert(tuple(utils._use_cache_value()) == ('PAYG', 10))
+        (tmp_path / 'cache').write_text('garbage')
+        assert(tuple(utils._use_cache_value()) == ('BYOS', 12))
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils._get_config_float')
+def test_get_fresh_cache_value_ttl(mock_config_float):
+    """Check the cacheTTL from the configuration is honoured"""
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=10)
+    mock_config_float.return_value = 0
+    time.sleep(0.01)
+    assert(utils._get_fresh_cache_value() is None)
+    mock_config_float.assert_called_once_with('cacheTTL', utils.CACHE_TTL)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+def test_check_payg_byos_deadline(
+        mock_rmt_ip, mock_metadata, mock_identifier, caplog
+):
+    """Check the cache is used when the check runs out of time"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('PAYG', code=12)
+    mock_identifier.return_value = 'sles'
+
+    mock_rmt_ip.return_value = ['1.1.1.1']
+
+    def metadata(deadline, fetch):
+        time.sleep(0.1)
+        return 'foo'
+
+    mock_metadata.side_effect = metadata
+    with patch.object(utils, 'make_request') as mock_request:
+        result = utils.check_payg_byos(timeout=0.05)
+        assert(not mock_request.called)
+    assert(result == ('BYOS', 12))
+    assert('ran out of time fetching the metadata' in caplog.text)
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_instance_data_command')
+def test_get_metadata_timeout(mock_command, caplog):
+    """Check a hanging data provider is stopped at the deadline"""
+    mock_command.return_value = 'sleep 10'
+    start = time.monotonic()
+    assert(utils.get_metadata(deadline=start + 0.2) is None)
+    assert(time.monotonic() - start < 5)
+    assert('timed out' in caplog.text)
+
+
+@patch('instance_billing_flavor_check.utils.Command.start')
+@patch('instance_billing_flavor_check.utils.get_instance_data_command')
+def test_get_metadata_cached(mock_command, mock_run, tmp_path):
+    """Check the metadata is fetched once and reused from the cache"""
+    mock_command.return_value = 'foo --bar'
+    mock_run.return_value.wait.return_value = Mock(
+        returncode=0, output='metadata'
+    )
+    with patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ):
+        assert(utils.get_metadata() == 'metadata')
+        assert(utils.get_metadata() == 'metadata')
+        assert(mock_run.call_count == 1)
+        mode = os.stat(utils.METADATA_CACHE_FILE_PATH).st_mode
+        assert(mode & 0o777 == 0o600)
+
+        mock_command.return_value = 'foo --baz'
+        assert(utils.get_metadata() == 'metadata')
+        assert(mock_run.call_count == 2)
+
+        utils.invalidate_metadata_cache()
+        utils.invalidate_metadata_cache()
+        assert(utils.get_metadata() == 'metadata')
+        assert(mock_run.call_count == 3)
+
+
+@patch('instance_billing_flavor_check.utils._get_boot_id')
+@patch('instance_billing_flavor_check.utils.Command.start')
+@patch('instance_billing_flavor_check.utils.get_instance_data_command')
+def test_get_metadata_cache_other_boot(
+        mock_command, mock_run, mock_boot_id, tmp_path
+):
+    """Check metadata cached during another boot is fetched again"""
+    mock_command.return_value = 'foo'
+    mock_run.return_value.wait.return_value = Mock(
+        returncode=0, output='metadata'
+    )
+    with patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ):
+        mock_boot_id.return_value = 'boot-1'
+        utils.get_metadata()
+        mock_boot_id.return_value = 'boot-2'
+        utils.get_metadata()
+    assert(mock_run.call_count == 2)
+
+
+@patch('instance_billing_flavor_check.utils._get_config_float')
+@patch('instance_billing_flavor_check.utils.Command.start')
+@patch('instance_billing_flavor_check.utils.get_instance_data_command')
+def test_get_metadata_cache_disabled(
+        mock_command, mock_run, mock_config_float, tmp_path
+):
+    """Check no metadata is cached with metadataCacheTTL set to 0"""
+    mock_command.return_value = 'foo'
+    mock_run.return_value.wait.return_value = Mock(
+        returncode=0, output='metadata'
+    )
+    mock_config_float.return_value = 0
+    with patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ):
+        utils.get_metadata()
+        assert(not os.path.exists(utils.METADATA_CACHE_FILE_PATH))
+    mock_config_float.assert_called_once_with(
+        'metadataCacheTTL', utils.METADATA_CACHE_TTL
+    )
+
+
+def test_write_metadata_cache_signed_expiry(tmp_path):
+    """Check the metadata cache expires ahead of the signed document"""
+    expiry = time.time() + 1000
+    metadata = '<identity>{}</identity>'.format(_jwt({'exp': expiry}))
+    with patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ):
+        utils._write_metadata_cache('foo', metadata)
+        record = json.load(open(utils.METADATA_CACHE_FILE_PATH))
+        assert(record['expires'] == expiry - utils.METADATA_REFRESH_MARGIN)
+        assert(utils._get_cached_metadata('foo') == metadata)
+
+        # signed document about to expire, do not cache it
+        os.unlink(utils.METADATA_CACHE_FILE_PATH)
+        metadata = _jwt({'exp': time.time() + 10})
+        utils._write_metadata_cache('foo', metadata)
+        assert(not os.path.exists(utils.METADATA_CACHE_FILE_PATH))
+
+
+def test_get_metadata_expiry():
+    """Check the earliest expiry of the signed documents is found"""
+    metadata = '{} {} {}'.format(
+        _jwt({'exp': 2000}), _jwt({'exp': 1000}), _jwt({'iss': 'foo'})
+    )
+    assert(utils._get_metadata_expiry(metadata) == 1000)
+    assert(utils._get_metadata_expiry('no.signed.document') is None)
+
+
+BASEPRODUCT = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- product definition -->
+<product schemeversion="0">
+  <vendor>SUSE</vendor>
+  <upgrades>
+    <upgrade><name>foo</name></upgrade>
+  </upgrades>
+  <name>SLES</name>
+  <version>15.6</version>
+</product>
+"""
+
+
+def test_get_identifier(tmp_path):
+    """Check the product name is read from the baseproduct"""
+    baseproduct = tmp_path / 'baseproduct'
+    baseproduct.write_text(BASEPRODUCT)
+    with _identifier_paths(tmp_path):
+        assert(utils.get_identifier() == 'sles')
+
+
+@patch('instance_billing_flavor_check.utils._parse_identifier')
+def test_get_identifier_cached(mock_parse, tmp_path):
+    """Check the baseproduct is only parsed again once it changed"""
+    baseproduct = tmp_path / 'baseproduct'
+    baseproduct.write_text(BASEPRODUCT)
+    mock_parse.return_value = 'sles'
+    with _identifier_paths(tmp_path):
+        assert(utils.get_identifier() == 'sles')
+        assert(utils.get_identifier() == 'sles')
+        assert(mock_parse.call_count == 1)
+
+        # a new process uses the cache on disk
+        utils._parsed_files.clear()
+        assert(utils.get_identifier() == 'sles')
+        assert(mock_parse.call_count == 1)
+
+        baseproduct.write_text(BASEPRODUCT.replace('SLES', 'SLES_SAP'))
+        mock_parse.return_value = 'sles_sap'
+        assert(utils.get_identifier() == 'sles_sap')
+        assert(mock_parse.call_count == 2)
+
+
+def test_get_identifier_no_file(tmp_path, caplog):
+    """Check a missing baseproduct is logged"""
+    with _identifier_paths(tmp_path):
+        assert(utils.get_identifier() is None)
+    assert('Could not open' in caplog.text)
+
+
+def test_get_identifier_malformed(tmp_path, caplog):
+    """Check a malformed baseproduct is logged"""
+    baseproduct = tmp_path / 'baseproduct'
+    baseproduct.write_text('<product><name>SLES</nam')
+    with _identifier_paths(tmp_path):
+        assert(utils.get_identifier() is None)
+        assert('Could not parse' in caplog.text)
+        baseproduct.write_text('<product><vendor>SUSE</vendor></product>')
+        assert(utils.get_identifier() is None)
+        assert('No product name' in caplog.text)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_instance_data_command')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_overlaps_metadata(
+        mock_request, mock_rmt_ip, mock_command, mock_identifier, tmp_path
+):
+    """Check the data provider runs while looking up the update server"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    provider = tmp_path / 'provider'
+    provider.write_text('#!/bin/sh\nsleep 0.3\necho foo\n')
+    provider.chmod(0o755)
+    mock_command.return_value = str(provider)
+    mock_identifier.return_value = 'sles'
+
+    def rmt_ip_addr(network_access=None):
+        time.sleep(0.3)
+        return ['1.1.1.1']
+
+    mock_rmt_ip.side_effect = rmt_ip_addr
+    mock_request.return_value = 'PAYG'
+    with patch.object(
+        utils, 'METADATA_CACHE_FILE_PATH', str(tmp_path / 'metadata')
+    ):
+        start = time.monotonic()
+        assert(utils.check_payg_byos() == ('PAYG', 10))
+        assert(time.monotonic() - start < 0.55)
+    assert(mock_request.call_args[0][1] == 'foo\n')
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.start_metadata')
+def test_check_payg_byos_no_identifier_stops_metadata(
+        mock_start, mock_identifier
+):
+    """Check the data provider is stopped without identifier"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    call = Mock()
+    mock_start.return_value = utils.MetadataFetch('foo', None, call)
+    mock_identifier.return_value = None
+    assert(utils.check_payg_byos() == ('BYOS', 12))
+    call.kill.assert_called_once_with()
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.start_metadata')
+def test_check_payg_byos_no_network_stops_metadata(mock_start):
+    """Check the data provider started up front is stopped without network"""
+    utils.has_ipv4_access = _no_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    call = Mock()
+    mock_start.return_value = utils.MetadataFetch('foo', None, call)
+    assert(utils.check_payg_byos() == ('BYOS', 12))
+    call.kill.assert_called_once_with()
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.start_metadata')
+def test_check_payg_byos_slow_network_probe(mock_start):
+    """Check the deadline bounds the network access probe"""
+    utils.has_ipv4_access = _slow_ip
+    utils.has_ipv6_access = _slow_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('BYOS', code=11)
+    call = Mock()
+    mock_start.return_value = utils.MetadataFetch('foo', None, call)
+    start = time.monotonic()
+    assert(utils.check_payg_byos(timeout=0.2) == ('BYOS', 11))
+    assert(time.monotonic() - start < 0.5)
+    call.kill.assert_called_once_with()
+    os.unlink(CACHE_FILE_PATH)
+
+
+@patch('instance_billing_flavor_check.utils.get_identifier')
+@patch('instance_billing_flavor_check.utils.get_metadata')
+@patch('instance_billing_flavor_check.utils.get_rmt_ip_addr')
+@patch('instance_billing_flavor_check.utils.make_request')
+def test_check_payg_byos_slow_server_lookup(
+        mock_request, mock_rmt_ip, mock_metadata, mock_identifier
+):
+    """Check the deadline bounds the update server lookup"""
+    utils.has_ipv4_access = _has_ip
+    utils.has_ipv6_access = _no_ip
+    utils.CACHE_FILE_PATH = CACHE_FILE_PATH
+    utils._write_cache('BYOS', code=11)
+    mock_identifier.return_value = 'sles'
+    mock_rmt_ip.side_effect = lambda *args: time.sleep(1) or ['1.1.1.1']
+    start = time.monotonic()
+    assert(utils.check_payg_byos(timeout=0.2) == ('BYOS', 11))
+    assert(time.monotonic() - start < 0.5)
+    assert(not mock_request.called)
+    os.unlink(CACHE_FILE_PATH)
+
+
+def test_call_until():
+    """Check a call is given up at the deadline and errors are raised"""
+    assert(utils._call_until(None, max, 1, 2) == 2)
+    assert(utils._call_until(time.monotonic() + 1, max, 1, 2) == 2)
+    assert(
+        utils._call_until(time.monotonic() + 0.1, time.sleep, 1) is
+        utils._TIMED_OUT
+    )
+    with raises(ValueError):
+        utils._call_until(time.monotonic() + 1, int, 'foo')
+
+
 ## Test helpers
 def _no_ip():
     return False
@@ -168,3 +1185,55 @@ def _no_ip():
 
 def _has_ip():
     return True
+
+
+def _slow_ip():
+    time.sleep(1)
+    return True
+
+
+def _cached_flavour():
+    return json.load(open(CACHE_FILE_PATH))['flavor']
+
+
+def _jwt(claims):
+    def encode(data):
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode()
+        ).decode().rstrip('=')
+    return '{}.{}.c2lnbmF0dXJlLXNpZ25hdHVyZQ'.format(
+        encode({'alg': 'RS256', 'typ': 'JWT'}), encode(claims)
+    )
+
+
+def _identifier_paths(tmp_path):
+    utils._parsed_files.clear()
+    return patch.multiple(
+        utils,
+        BASEPRODUCT_PATH=str(tmp_path / 'baseproduct'),
+        IDENTIFIER_CACHE_FILE_PATH=str(tmp_path / 'identifier')
+    )
+
+
+def _write_record(record):
+    with open(CACHE_FILE_PATH, 'w') as cache:
+        json.dump(record, cache)
+
+
+@patch('instance_billing_flavor_check.utils.atexit.register')
+def test_setup_logging(mock_register, tmp_path):
+    """Check the log records are written by the listener thread"""
+    log_path = tmp_path / 'flavor.log'
+    root = logging.getLogger()
+    level = root.level
+    try:
+        with patch.object(root, 'handlers', []):
+            utils.setup_logging(str(log_path))
+            assert(isinstance(root.handlers[0], logging.handlers.QueueHandler))
+            utils.logger.debug('Not written %s', 'at INFO')
+            utils.logger.info('Using cache value: %s', 'PAYG')
+            mock_register.assert_called_once_with(utils._log_listener.stop)
+            utils._log_listener.stop()
+    finally:
+        root.setLevel(level)
+    assert(log_path.read_text().endswith(': Using cache value: PAYG\n'))